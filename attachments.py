@@ -0,0 +1,231 @@
+"""Хранилище вложений: файлы по хэшу содержимого (SHA-256)
+
+Клиент считает хэш файла до загрузки и передаёт файл кусками не больше
+CHUNK_SIZE байт. Незавершённая загрузка хранится в partial/<хэш> и
+продолжается с его текущего размера (например, после переподключения).
+Загрузки принадлежат соединению: одновременно у него не больше
+MAX_PARTIAL_PER_OWNER незавершённых файлов, а после отключения его
+загрузки удаляются, если их не продолжили за RESUME_GRACE. Фоновый поток
+раз в REAP_INTERVAL удаляет такие загрузки и брошенные дольше PARTIAL_TTL.
+Завершённый файл проверяется по хэшу и переносится в objects/<xx>/<хэш>;
+файл, загруженный повторно, уже есть в хранилище и не передаётся заново.
+Сообщения несут только ссылку (хэш, имя, размер, тип), а содержимое
+отдаётся по HTTP прямо с диска.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class AttachmentStore:
+    """Файлы вложений на диске, адресуемые SHA-256 содержимого"""
+
+    CHUNK_SIZE = 64 * 1024             # максимальный размер куска загрузки
+    MAX_SIZE = 20 * 1024 * 1024        # максимальный размер файла
+    PARTIAL_TTL = 24 * 3600            # незавершённые загрузки старше удаляются (секунды)
+    MAX_PARTIAL_PER_OWNER = 4          # одновременных незавершённых загрузок на соединение
+    RESUME_GRACE = 300.0               # сколько ждать продолжения загрузки после отключения (секунды)
+    REAP_INTERVAL = 60.0               # период удаления брошенных загрузок (секунды)
+
+    def __init__(self, root="attachments"):
+        """Создание каталогов хранилища и запуск удаления брошенных загрузок"""
+        self.objects = os.path.join(root, "objects")
+        self.partial = os.path.join(root, "partial")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.partial, exist_ok=True)
+        self.logger = logging.getLogger("ChatServer")
+        # Блокировки загрузок по хэшу: один файл не пишется двумя обработчиками сразу
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # Незавершённые загрузки: хэш -> владельцы, владелец -> хэши,
+        # хэш без владельцев -> срок, после которого загрузка удаляется
+        self._owners = {}
+        self._uploads = {}
+        self._orphaned = {}
+        self._owners_lock = threading.Lock()
+        self.reap()
+        threading.Thread(target=self._reap_loop, name="AttachmentReaper", daemon=True).start()
+
+    def path(self, digest):
+        """Путь к файлу с хэшем digest или None, если файла нет (или хэш недопустим)"""
+        if not isinstance(digest, str) or not HASH_PATTERN.fullmatch(digest):
+            return None
+        path = os.path.join(self.objects, digest[:2], digest)
+        return path if os.path.isfile(path) else None
+
+    def size(self, digest):
+        """Размер сохранённого файла или None"""
+        path = self.path(digest)
+        return os.path.getsize(path) if path else None
+
+    def begin(self, digest, size, owner=None):
+        """Начало или продолжение загрузки: смещение, с которого клиенту передавать данные.
+
+        Смещение, равное size, означает, что файл уже есть в хранилище.
+        Загрузка записывается за владельцем owner (sid соединения).
+        """
+        self._check(digest, size)
+        stored = self.size(digest)
+        if stored is not None:
+            if stored != size:
+                raise ValueError("размер не совпадает с сохранённым файлом")
+            return size
+        self._claim(digest, owner)
+        try:
+            return min(os.path.getsize(self._partial_path(digest)), size)
+        except FileNotFoundError:
+            return 0
+
+    def write(self, digest, size, offset, data, owner=None):
+        """Запись куска data по смещению offset. Возвращает смещение следующего куска.
+
+        Кусок не с текущего конца загрузки не записывается: в ответ приходит
+        смещение, с которого нужно продолжить. После последнего куска файл
+        проверяется по хэшу и переносится в хранилище.
+        """
+        self._check(digest, size)
+        if len(data) > self.CHUNK_SIZE:
+            raise ValueError("слишком большой кусок")
+        if self.path(digest):
+            return size
+        # Владелец записывается до создания блокировки: отклонённый кусок её не оставляет
+        self._claim(digest, owner)
+        with self._lock(digest):
+            if self.path(digest):
+                return size
+            partial = self._partial_path(digest)
+            try:
+                current = os.path.getsize(partial)
+            except FileNotFoundError:
+                current = 0
+            if offset != current or current + len(data) > size:
+                self._drop_lock(digest)
+                if offset != current:
+                    return current
+                raise ValueError("данных больше заявленного размера")
+            with open(partial, "ab") as file:
+                file.write(data)
+            current += len(data)
+            if current == size:
+                try:
+                    self._commit(digest, partial)
+                finally:
+                    self._forget(digest)
+                    with self._locks_lock:
+                        self._locks.pop(digest, None)
+            return current
+
+    def release(self, owner, now=None):
+        """Отключение владельца: его загрузки без других владельцев удаляются через RESUME_GRACE"""
+        deadline = (time.monotonic() if now is None else now) + self.RESUME_GRACE
+        with self._owners_lock:
+            for digest in self._uploads.pop(owner, ()):
+                owners = self._owners.get(digest)
+                if owners is None:
+                    continue
+                owners.discard(owner)
+                if not owners:
+                    del self._owners[digest]
+                    self._orphaned[digest] = deadline
+
+    def reap(self, now=None):
+        """Удаление загрузок, не продолженных за RESUME_GRACE после отключения, и брошенных дольше PARTIAL_TTL"""
+        now = time.monotonic() if now is None else now
+        with self._owners_lock:
+            expired = [digest for digest, deadline in self._orphaned.items() if deadline <= now]
+            owned = set(self._owners)
+        stale = time.time() - self.PARTIAL_TTL
+        for entry in os.scandir(self.partial):
+            if entry.is_file() and entry.name not in owned and entry.stat().st_mtime < stale:
+                expired.append(entry.name)
+        for digest in expired:
+            with self._lock(digest):
+                with self._owners_lock:
+                    if digest in self._owners:
+                        continue
+                    self._orphaned.pop(digest, None)
+                try:
+                    os.remove(self._partial_path(digest))
+                except FileNotFoundError:
+                    pass
+            with self._locks_lock:
+                self._locks.pop(digest, None)
+
+    def uploads(self, owner):
+        """Число незавершённых загрузок владельца"""
+        with self._owners_lock:
+            return len(self._uploads.get(owner, ()))
+
+    def _check(self, digest, size):
+        if not isinstance(digest, str) or not HASH_PATTERN.fullmatch(digest):
+            raise ValueError("недопустимый хэш")
+        if not isinstance(size, int) or not 0 < size <= self.MAX_SIZE:
+            raise ValueError(f"размер файла должен быть от 1 байта до {self.MAX_SIZE // (1024 * 1024)} МБ")
+
+    def _claim(self, digest, owner):
+        """Запись загрузки за владельцем с проверкой MAX_PARTIAL_PER_OWNER"""
+        if owner is None:
+            return
+        with self._owners_lock:
+            uploads = self._uploads.setdefault(owner, set())
+            if digest in uploads:
+                return
+            if len(uploads) >= self.MAX_PARTIAL_PER_OWNER:
+                raise ValueError("слишком много незавершённых загрузок")
+            uploads.add(digest)
+            self._owners.setdefault(digest, set()).add(owner)
+            self._orphaned.pop(digest, None)
+
+    def _forget(self, digest):
+        """Снятие завершённой (или отклонённой) загрузки со всех владельцев"""
+        with self._owners_lock:
+            for owner in self._owners.pop(digest, ()):
+                uploads = self._uploads.get(owner)
+                if uploads is not None:
+                    uploads.discard(digest)
+                    if not uploads:
+                        del self._uploads[owner]
+            self._orphaned.pop(digest, None)
+
+    def _lock(self, digest):
+        with self._locks_lock:
+            return self._locks.setdefault(digest, threading.Lock())
+
+    def _drop_lock(self, digest):
+        """Удаление блокировки загрузки, у которой нет ни владельцев, ни файла"""
+        with self._owners_lock:
+            if digest in self._owners:
+                return
+        if not os.path.exists(self._partial_path(digest)):
+            with self._locks_lock:
+                self._locks.pop(digest, None)
+
+    def _partial_path(self, digest):
+        return os.path.join(self.partial, digest)
+
+    def _commit(self, digest, partial):
+        """Проверка хэша загруженного файла и перенос в хранилище"""
+        hasher = hashlib.sha256()
+        with open(partial, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                hasher.update(block)
+        if hasher.hexdigest() != digest:
+            os.remove(partial)
+            raise ValueError("содержимое не совпадает с хэшем")
+        directory = os.path.join(self.objects, digest[:2])
+        os.makedirs(directory, exist_ok=True)
+        os.replace(partial, os.path.join(directory, digest))
+
+    def _reap_loop(self):
+        """Фоновый поток: раз в REAP_INTERVAL - удаление брошенных загрузок"""
+        while True:
+            time.sleep(self.REAP_INTERVAL)
+            try:
+                self.reap()
+            except OSError as e:
+                self.logger.error("Ошибка удаления брошенных загрузок вложений: %s", e)
@@ -0,0 +1,139 @@
+"""Сравнение рассылки по одному событию и пачками message_batch
+
+Для каждого режима запускается server.py (без пачек и с --batch-ms), к нему
+подключаются N клиентов, после чего S отправителей пишут с заданной
+частотой. Измеряются пакеты в секунду, полученные клиентами, процессорное
+время сервера на доставленное сообщение и задержка доставки.
+
+Запуск:
+    python benchmarks/bench_batching.py [--clients 200] [--senders 10] [--rate 20] [--duration 5]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import socketio
+
+from bench_engines import free_port, percentile, start_server
+
+PREFIX = "batch:"
+
+
+def process_cpu(pid):
+    """Процессорное время процесса (user + system), секунды"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run_clients(url, args):
+    """Подключение клиентов, рассылка и подсчёт пакетов и задержек"""
+    counters = {"packets": 0}
+    latencies = []
+    bots = []
+
+    def record(data):
+        if data.get("type") == "message" and data["text"].startswith(PREFIX):
+            latencies.append(time.time() - float(data["text"][len(PREFIX):]))
+
+    async def connect(i):
+        bot = socketio.AsyncClient(reconnection=False)
+
+        @bot.on("message")
+        async def on_message(data):
+            counters["packets"] += 1
+            record(data)
+
+        @bot.on("message_batch")
+        async def on_message_batch(data):
+            counters["packets"] += 1
+            for event in data["events"]:
+                record(event)
+
+        await bot.connect(url, transports=["websocket"])
+        await bot.emit("join", {"username": f"bot-{i}"})
+        bots.append(bot)
+
+    semaphore = asyncio.Semaphore(100)
+
+    async def limited(i):
+        async with semaphore:
+            await connect(i)
+
+    await asyncio.gather(*(limited(i) for i in range(args.clients)))
+    await asyncio.sleep(2)
+    counters["packets"] = 0
+
+    async def send(bot):
+        interval = 1.0 / args.rate
+        sent = 0
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            await bot.emit("send_message", {"text": f"{PREFIX}{time.time()}"})
+            sent += 1
+            await asyncio.sleep(interval)
+        return sent
+
+    start = time.perf_counter()
+    sent = sum(await asyncio.gather(*(send(bot) for bot in bots[:args.senders])))
+    expected = sent * len(bots)
+    deadline = time.monotonic() + 10
+    while len(latencies) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    await asyncio.gather(*(bot.disconnect() for bot in bots), return_exceptions=True)
+    return {
+        "clients": len(bots),
+        "sent": sent,
+        "delivered": len(latencies),
+        "packets": counters["packets"],
+        "elapsed": elapsed,
+        "latencies": latencies,
+    }
+
+
+def bench(batch_ms, args):
+    """Замер одного режима: batch_ms = 0 - без пачек"""
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        extra = ["--batch-ms", str(batch_ms)] if batch_ms else []
+        process = start_server(args.engine, port, os.path.join(directory, "history.db"), *extra)
+        try:
+            cpu_before = process_cpu(process.pid)
+            result = asyncio.run(run_clients(f"http://127.0.0.1:{port}", args))
+            cpu = process_cpu(process.pid) - cpu_before
+        finally:
+            process.terminate()
+            process.wait()
+    result["cpu_ms_per_message"] = cpu * 1000 / max(result["delivered"], 1)
+    result["packets_per_sec"] = result["packets"] / result["elapsed"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=20.0, help="сообщений в секунду на отправителя")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--batch-ms", type=float, nargs="+", default=[0, 10, 25])
+    parser.add_argument("--engine", default="threading")
+    args = parser.parse_args()
+
+    print(f"{'пачка, мс':>9} | {'доставлено':>10} | {'пакетов/с':>9} | {'сообщ./пакет':>12} | "
+          f"{'CPU мкс/сообщ.':>14} | {'p50, мс':>8} | {'p99, мс':>8}")
+    print("-" * 90)
+    for batch_ms in args.batch_ms:
+        result = bench(batch_ms, args)
+        per_packet = result["delivered"] / max(result["packets"], 1)
+        print(f"{batch_ms:>9g} | {result['delivered']:>10} | {result['packets_per_sec']:>9.0f} | "
+              f"{per_packet:>12.1f} | {result['cpu_ms_per_message'] * 1000:>14.1f} | "
+              f"{percentile(result['latencies'], 50) * 1000:>8.2f} | "
+              f"{percentile(result['latencies'], 99) * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
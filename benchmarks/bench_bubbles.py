@@ -0,0 +1,140 @@
+"""Стоимость отрисовки пузырей сообщений: прежняя разметка и текущая
+
+Поток сообщений, как в оживлённой комнате (авторы пишут сериями по
+несколько сообщений подряд), превращается в элементы списка двумя
+способами:
+
+- прежний - вложенные Container/Column с разделителями и стилями,
+  создаваемыми для каждого сообщения (копия прежнего _create_message_bubble);
+- текущий - TelegramChatApp._build_message_control: общие объекты стилей,
+  плоский пузырь и группировка сообщений одного автора.
+
+Для каждого способа замеряются пузыри в секунду (создание элементов и
+построение команд Flet, как при добавлении в страницу), число элементов и
+размер команд Flet в JSON на пузырь.
+
+Запуск:
+    python benchmarks/bench_bubbles.py [--messages 20000] [--run 3]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flet as ft
+from flet.core.protocol import CommandEncoder
+
+from client import TelegramChatApp
+
+
+def legacy_bubble(app, username, text, is_current_user, timestamp):
+    """Пузырь сообщения в прежней разметке"""
+    if is_current_user:
+        return ft.Container(
+            content=ft.Column([
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text(text, color=app.COLORS["text"], selectable=True),
+                        ft.Container(height=4),
+                        ft.Text(timestamp, color=app.COLORS["timestamp_user"], size=12, text_align=ft.TextAlign.RIGHT)
+                    ]),
+                    bgcolor=app.COLORS["user_msg"],
+                    padding=12,
+                    border_radius=ft.border_radius.only(top_left=12, top_right=12, bottom_left=12, bottom_right=3),
+                    width=300
+                )
+            ]),
+            margin=ft.margin.only(left=50, right=10, top=5, bottom=5),
+            alignment=ft.alignment.center_right
+        )
+    return ft.Container(
+        content=ft.Column([
+            ft.Container(
+                content=ft.Column([
+                    ft.Text(username, style=ft.TextStyle(weight=ft.FontWeight.BOLD, color=app.COLORS["accent"])),
+                    ft.Container(height=4),
+                    ft.Text(text, color=app.COLORS["text"], selectable=True),
+                    ft.Container(height=4),
+                    ft.Text(timestamp, color=app.COLORS["timestamp_other"], size=12, text_align=ft.TextAlign.RIGHT)
+                ]),
+                bgcolor=app.COLORS["other_msg"],
+                padding=12,
+                border_radius=ft.border_radius.only(top_left=12, top_right=12, bottom_left=3, bottom_right=12),
+                width=300
+            )
+        ]),
+        margin=ft.margin.only(left=10, right=50, top=5, bottom=5),
+        alignment=ft.alignment.center_left
+    )
+
+
+def make_records(count, run):
+    """Записи сообщений: авторы сменяются сериями в среднем по run сообщений"""
+    rng = random.Random(1)
+    authors = ["me"] + [f"user-{i}" for i in range(20)]
+    author = rng.choice(authors)
+    records = []
+    for i in range(count):
+        if rng.random() < 1 / run:
+            author = rng.choice(authors)
+        records.append(("message", author, f"Сообщение №{i} 🙂 {'текст ' * rng.randint(1, 12)}", "12:34", None))
+    return records
+
+
+def count_controls(control):
+    return 1 + sum(count_controls(child) for child in control._get_children())
+
+
+def measure(build, records):
+    """Пузыри в секунду, элементов и байт команд Flet на пузырь"""
+    begin = time.perf_counter()
+    controls = []
+    commands = []
+    previous = None
+    for record in records:
+        control = build(record, previous)
+        commands.extend(control._build_add_commands())
+        controls.append(control)
+        previous = record
+    elapsed = time.perf_counter() - begin
+    size = len(json.dumps(commands, cls=CommandEncoder, separators=(",", ":")).encode("utf-8"))
+    total = sum(count_controls(control) for control in controls)
+    return len(records) / elapsed, total / len(records), size / len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--run", type=float, default=3, help="средняя длина серии сообщений одного автора")
+    args = parser.parse_args()
+
+    app = TelegramChatApp()
+    app.username = "me"
+    records = make_records(args.messages, args.run)
+
+    def build_legacy(record, previous):
+        _, username, text, timestamp, _ = record
+        return legacy_bubble(app, username, text, username == app.username, timestamp)
+
+    variants = (("прежний", build_legacy), ("текущий", app._build_message_control))
+    print(f"{'вариант':>8} | {'пузырей/с':>10} | {'элементов':>9} | {'байт/пузырь':>11}")
+    print("-" * 48)
+    results = {}
+    for name, build in variants:
+        # Лучший из трёх прогонов: меньше влияние сборки мусора и прогрева
+        runs = [measure(build, records) for _ in range(3)]
+        results[name] = max(runs, key=lambda result: result[0])
+        rate, controls, size = results[name]
+        print(f"{name:>8} | {rate:>10.0f} | {controls:>9.2f} | {size:>11.0f}")
+
+    old, new = results["прежний"], results["текущий"]
+    print()
+    print(f"скорость: x{new[0] / old[0]:.2f}, элементов: {new[1] / old[1]:.0%}, байт: {new[2] / old[2]:.0%} от прежнего")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Сравнение транспортов сервера: threading (Flask-SocketIO) и asyncio (AsyncServer)
+
+Для каждого режима запускается отдельный процесс server.py, к нему
+подключаются N клиентов (socketio.AsyncClient в одном цикле событий),
+после чего один из них рассылает сообщения. Измеряются число успешных
+подключений, память и потоки процесса сервера, а также задержка доставки
+рассылки до каждого получателя.
+
+Запуск:
+    python benchmarks/bench_engines.py [--clients 500] [--messages 50]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    """Свободный TCP-порт на localhost"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(engine, port, history_path, *extra_args, root=ROOT):
+    """Запуск server.py из каталога root в отдельном процессе и ожидание открытия порта.
+
+    Ограничение частоты сообщений отключается: боты пишут быстрее людей.
+    Рабочий каталог процесса - каталог history_path, чтобы файлы сервера
+    (например, хранилище вложений) не появлялись в текущем каталоге.
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(root, "server.py"), "--engine", engine,
+         "--host", "127.0.0.1", "--port", str(port), "--history", history_path, "--no-rate-limit",
+         *extra_args],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(history_path))
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Сервер в режиме {engine} не запустился")
+
+
+def process_stats(pid):
+    """RSS (МБ) и число потоков процесса по /proc"""
+    rss, threads = 0.0, 0
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def percentile(values, q):
+    """Перцентиль q (0-100) по отсортированной копии значений"""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+async def run_clients(url, clients, messages):
+    """Подключение клиентов, рассылка и сбор задержек доставки"""
+    latencies = []
+    bots = []
+
+    def make_handler():
+        async def on_message(data):
+            if data.get("type") == "message" and data["text"].startswith("bench:"):
+                latencies.append(time.time() - float(data["text"][6:]))
+        return on_message
+
+    async def connect(i):
+        bot = socketio.AsyncClient(reconnection=False)
+        bot.on("message", make_handler())
+        try:
+            await bot.connect(url, transports=["websocket"])
+            await bot.emit("join", {"username": f"bot-{i}"})
+            bots.append(bot)
+        except Exception:
+            pass
+
+    semaphore = asyncio.Semaphore(100)
+
+    async def limited(i):
+        async with semaphore:
+            await connect(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(clients)))
+    connect_time = time.perf_counter() - start
+    # Даём серверу и клиентам разобрать события входа
+    await asyncio.sleep(3)
+
+    if bots:
+        sender = bots[0]
+        for _ in range(messages):
+            await sender.emit("send_message", {"text": f"bench:{time.time()}"})
+            await asyncio.sleep(0.05)
+        # Ждём доставки последних рассылок
+        expected = len(bots) * messages
+        deadline = time.monotonic() + 10
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    connected = len(bots)
+    await asyncio.gather(*(bot.disconnect() for bot in bots), return_exceptions=True)
+    return connected, connect_time, latencies
+
+
+def bench(engine, clients, messages):
+    """Замер одного режима"""
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        process = start_server(engine, port, os.path.join(directory, "history.db"))
+        try:
+            idle_rss, idle_threads = process_stats(process.pid)
+            connected, connect_time, latencies = asyncio.run(
+                run_clients(f"http://127.0.0.1:{port}", clients, messages)
+            )
+            rss, threads = process_stats(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    return {
+        "engine": engine,
+        "connected": connected,
+        "connect_time": connect_time,
+        "rss_per_client_kb": (rss - idle_rss) * 1024 / max(connected, 1),
+        "threads": threads - idle_threads,
+        "delivered": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--engines", nargs="+", default=["threading", "asyncio"])
+    args = parser.parse_args()
+
+    print(f"{'режим':>10} | {'клиентов':>8} | {'подкл., с':>9} | {'КБ/клиент':>9} | {'+потоков':>8} | "
+          f"{'доставлено':>10} | {'p50, мс':>8} | {'p99, мс':>8}")
+    print("-" * 96)
+    for engine in args.engines:
+        result = bench(engine, args.clients, args.messages)
+        print(f"{result['engine']:>10} | {result['connected']:>8} | {result['connect_time']:>9.2f} | "
+              f"{result['rss_per_client_kb']:>9.1f} | {result['threads']:>8} | {result['delivered']:>10} | "
+              f"{result['p50_ms']:>8.2f} | {result['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Бенчмарк пропускной способности записи истории сообщений
+
+Измеряет скорость HistoryStore.append (то, что видит обработчик сообщения)
+и время, за которое все сообщения оказываются на диске, для разных размеров
+пачки записи.
+
+Запуск:
+    python benchmarks/bench_history.py [--messages 200000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history import HistoryStore
+
+BATCH_SIZES = [1, 32, 256, 1024]
+
+
+def bench(total, batch_size):
+    """Добавление total сообщений и ожидание их записи"""
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore(os.path.join(directory, "history.db"), batch_size=batch_size)
+        text = "Привет всем! Как дела? 🙂 " * 3
+
+        start = time.perf_counter()
+        for i in range(total):
+            store.append(f"user-{i % 100}", text)
+        appended = time.perf_counter() - start
+        store.flush()
+        durable = time.perf_counter() - start
+        store.close()
+    return total / appended, total / durable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"{'пачка':>6} | {'append, сообщ/с':>16} | {'на диске, сообщ/с':>18}")
+    print("-" * 47)
+    for batch_size in BATCH_SIZES:
+        # Запись по одному сообщению слишком медленная для полного объёма
+        total = args.messages if batch_size > 1 else min(args.messages, 2_000)
+        appended, durable = bench(total, batch_size)
+        print(f"{batch_size:>6} | {appended:>16,.0f} | {durable:>18,.0f}")
+
+
+if __name__ == "__main__":
+    main()
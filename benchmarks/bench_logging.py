@@ -0,0 +1,127 @@
+"""Задержка обработчика события при медленном stdout: синхронный лог и logpipe
+
+Обработчик, как _handle_connect сервера, пишет одну строку лога на событие.
+Вывод идёт в канал (pipe), который читает медленный сборщик: он забирает
+данные блоками и периодически замирает (--stall), как сборщик логов под
+нагрузкой. Когда буфер канала заполняется, синхронный StreamHandler
+блокирует обработчик до освобождения места; в logpipe обработчик только
+кладёт запись в очередь. Сравниваются задержки вызова обработчика:
+
+- синхронный - StreamHandler(stdout), как было до logpipe;
+- logpipe - очередь и фоновый поток вывода;
+- logpipe + выборка - то же с выборкой категории connect 1 из 10.
+
+Дополнительно замеряется стоимость отключённой по уровню записи с f-строкой
+и в %-стиле.
+
+Запуск:
+    python benchmarks/bench_logging.py [--rate 3000] [--duration 3] [--stall 0.3]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logpipe
+
+
+def slow_collector(read_fd, stall, stop):
+    """Чтение канала блоками по 4 КБ с паузой stall каждую секунду"""
+    next_stall = time.monotonic() + 1
+    while True:
+        data = os.read(read_fd, 4096)
+        if not data and stop.is_set():
+            return
+        if time.monotonic() >= next_stall:
+            time.sleep(stall)
+            next_stall = time.monotonic() + 1
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def run(mode, args):
+    """Прогон обработчика в режиме mode: задержки вызовов, секунды"""
+    read_fd, write_fd = os.pipe()
+    stop = threading.Event()
+    collector = threading.Thread(target=slow_collector, args=(read_fd, args.stall, stop), daemon=True)
+    collector.start()
+    stream = os.fdopen(write_fd, "w", buffering=1, encoding="utf-8")
+
+    root = logging.getLogger()
+    handler = None
+    if mode == "синхронный":
+        output = logging.StreamHandler(stream)
+        output.setFormatter(logging.Formatter(logpipe.TEXT_FORMAT))
+        root.handlers = [output]
+        root.setLevel(logging.INFO)
+    else:
+        sampling = {"connect": 10} if "выборка" in mode else None
+        handler = logpipe.setup(sampling=sampling, stream=stream)
+    logger = logging.getLogger("ChatServer")
+
+    def handle_connect(sid):
+        logger.info("Клиент подключился: %s", sid, extra={"category": "connect"})
+
+    latencies = []
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    for i in range(int(args.rate * args.duration)):
+        # Равномерный поток событий с заданной частотой
+        delay = start + i * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        begin = time.perf_counter()
+        handle_connect(f"sid-{i:08d}-{'x' * 40}")
+        latencies.append(time.perf_counter() - begin)
+
+    logpipe.stop()
+    root.handlers = []
+    stop.set()
+    stream.close()
+    collector.join()
+    os.close(read_fd)
+    return latencies, handler.dropped if handler else 0
+
+
+def formatting_cost():
+    """Стоимость записи, отключённой по уровню: f-строка и %-стиль, мкс"""
+    logger = logging.getLogger("bench.disabled")
+    logger.setLevel(logging.WARNING)
+    value = {"sid": "abc", "rooms": ["general", "dev"]}
+    number = 200_000
+    eager = min(timeit.repeat(lambda: logger.info(f"Событие {value} обработано"), number=number, repeat=3))
+    lazy = min(timeit.repeat(lambda: logger.info("Событие %s обработано", value), number=number, repeat=3))
+    return eager / number * 1e6, lazy / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=3000, help="событий в секунду")
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--stall", type=float, default=0.3, help="пауза сборщика раз в секунду, с")
+    args = parser.parse_args()
+
+    print(f"{'режим':>18} | {'p50, мкс':>9} | {'p99, мкс':>9} | {'p99.9, мс':>9} | {'max, мс':>8} | "
+          f"{'> 1 мс':>6} | {'отброшено':>9}")
+    print("-" * 88)
+    for mode in ("синхронный", "logpipe", "logpipe + выборка"):
+        latencies, dropped = run(mode, args)
+        slow = sum(1 for latency in latencies if latency > 0.001)
+        print(f"{mode:>18} | {percentile(latencies, 50) * 1e6:>9.1f} | {percentile(latencies, 99) * 1e6:>9.1f} | "
+              f"{percentile(latencies, 99.9) * 1000:>9.2f} | {max(latencies) * 1000:>8.1f} | {slow:>6} | {dropped:>9}")
+
+    eager, lazy = formatting_cost()
+    print()
+    print(f"запись ниже уровня: f-строка {eager:.3f} мкс, %-стиль {lazy:.3f} мкс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Микробенчмарк стоимости входа пользователя в зависимости от числа подключенных
+
+Сравнивает прежнюю проверку уникальности (`username in users.values()`)
+с резервированием имени в UserRegistry.
+
+Запуск:
+    python benchmarks/bench_registry.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registry import UserRegistry
+
+POPULATIONS = [10, 100, 1_000, 10_000, 100_000]
+JOINS = 2_000
+
+
+def bench_dict_scan(population):
+    """Вход с линейной проверкой по значениям словаря"""
+    users = {f"sid-{i}": f"user-{i}" for i in range(population)}
+    names = [f"new-{i}" for i in range(JOINS)]
+
+    def run():
+        for i, name in enumerate(names):
+            if name not in users.values():
+                users[f"new-sid-{i}"] = name
+        for i in range(JOINS):
+            users.pop(f"new-sid-{i}", None)
+
+    return min(timeit.repeat(run, number=1, repeat=3)) / JOINS
+
+
+def bench_registry(population):
+    """Вход через резервирование имени в реестре"""
+    registry = UserRegistry()
+    for i in range(population):
+        registry.reserve(f"sid-{i}", f"user-{i}")
+    names = [f"new-{i}" for i in range(JOINS)]
+
+    def run():
+        for i, name in enumerate(names):
+            registry.reserve(f"new-sid-{i}", name)
+        for i in range(JOINS):
+            registry.release(f"new-sid-{i}")
+
+    return min(timeit.repeat(run, number=1, repeat=3)) / JOINS
+
+
+def main():
+    print(f"{'пользователей':>14} | {'dict scan, мкс':>15} | {'registry, мкс':>14}")
+    print("-" * 50)
+    for population in POPULATIONS:
+        scan = bench_dict_scan(population) * 1e6
+        registry = bench_registry(population) * 1e6
+        print(f"{population:>14} | {scan:>15.2f} | {registry:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Задержка поиска по истории: обратный индекс на корпусе из 1 000 000 сообщений
+
+Корпус - синтетические сообщения из русских и английских слов с частотами
+по закону Ципфа, в нескольких комнатах и от сотен авторов. Измеряются
+время построения SearchIndex, прирост памяти процесса и задержки p50/p99
+типичных запросов; для сравнения несколько запросов выполняются полным
+перебором сообщений.
+
+Запуск:
+    python benchmarks/bench_search.py [--messages 1000000] [--queries 200]
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex, tokenize
+
+SYLLABLES = ["при", "вет", "ка", "ло", "да", "ми", "ре", "ну", "ст", "ор", "ёж", "за", "пол", "ник", "ра"]
+ENGLISH = ["deploy", "release", "test", "build", "merge", "review", "bug", "fix", "ok", "lol"]
+ROOMS = [f"room-{i}" for i in range(20)]
+USERS = [f"Пользователь-{i}" for i in range(500)]
+
+
+def vocabulary(size):
+    """Словарь из size слов: английские и составленные из слогов кириллические"""
+    words = list(ENGLISH)
+    for length in itertools.count(2):
+        for combination in itertools.product(SYLLABLES, repeat=length):
+            words.append("".join(combination))
+            if len(words) == size:
+                return words
+
+
+def corpus(total, words, seed=1):
+    """Сообщения корпуса с распределением слов по закону Ципфа"""
+    rng = random.Random(seed)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    start = 1_700_000_000.0
+    for i in range(total):
+        text = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 12)))
+        if i % 7 == 0:
+            text = text.capitalize() + "!"
+        yield {
+            "id": i + 1, "ts": start + i, "room": ROOMS[i % len(ROOMS)],
+            "username": USERS[rng.randrange(len(USERS))], "text": text,
+        }
+
+
+def process_rss():
+    """Резидентная память процесса, байты"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def scan(messages, query, room, limit=20):
+    """Поиск полным перебором: все слова запроса среди слов сообщения"""
+    tokens = set(tokenize(query))
+    found = []
+    for message in reversed(messages):
+        if message["room"] == room and tokens.issubset(tokenize(message["text"])):
+            found.append(message["id"])
+            if len(found) == limit:
+                break
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--words", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    words = vocabulary(args.words)
+    messages = list(corpus(args.messages, words))
+    index = SearchIndex()
+    rss_before = process_rss()
+    start = time.perf_counter()
+    for message in messages:
+        index.add(message)
+    build = time.perf_counter() - start
+    memory = (process_rss() - rss_before) / 2 ** 20
+    print(f"сообщений: {len(index):,}, построение: {build:.1f} с "
+          f"({len(index) / build:,.0f} сообщ/с), память индекса: ~{memory:.0f} МБ")
+
+    rng = random.Random(2)
+    last_ts = messages[-1]["ts"]
+    cases = {
+        "частое слово": lambda: (rng.choice(words[:10]), {}),
+        "среднее слово": lambda: (rng.choice(words[100:1000]), {}),
+        "редкое слово": lambda: (rng.choice(words[-5000:]), {}),
+        "два слова": lambda: (f"{rng.choice(words[:50])} {rng.choice(words[10:50]).upper()}", {}),
+        "слово + автор": lambda: (rng.choice(words[:100]), {"username": rng.choice(USERS).lower()}),
+        "слово + время": lambda: (rng.choice(words[:100]), {"since": last_ts - 86400 * 3, "until": last_ts - 86400}),
+        "2-я страница": lambda: (rng.choice(words[:100]), {"before_id": rng.randint(1, len(messages))}),
+        "только автор": lambda: ("", {"username": rng.choice(USERS)}),
+    }
+
+    print()
+    print(f"{'запрос':>14} | {'p50, мс':>8} | {'p99, мс':>8} | {'найдено':>8}")
+    print("-" * 48)
+    for name, make in cases.items():
+        latencies = []
+        found = 0
+        for _ in range(args.queries):
+            query, filters = make()
+            room = rng.choice(ROOMS)
+            start = time.perf_counter()
+            ids, _ = index.search(query, room, **filters)
+            latencies.append(time.perf_counter() - start)
+            found += len(ids)
+        print(f"{name:>14} | {percentile(latencies, 50) * 1000:>8.3f} | "
+              f"{percentile(latencies, 99) * 1000:>8.3f} | {found / args.queries:>8.1f}")
+
+    print()
+    print(f"{'перебор':>14} | {'индекс, мс':>10} | {'перебор, мс':>11} | совпадают")
+    print("-" * 56)
+    for name, query in (("среднее слово", words[500]), ("редкое слово", words[-1])):
+        start = time.perf_counter()
+        ids, _ = index.search(query, ROOMS[0])
+        indexed = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = scan(messages, query, ROOMS[0])
+        scanned = time.perf_counter() - start
+        print(f"{name:>14} | {indexed * 1000:>10.3f} | {scanned * 1000:>11.1f} | {ids == expected}")
+
+
+if __name__ == "__main__":
+    main()
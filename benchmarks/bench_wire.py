@@ -0,0 +1,93 @@
+"""Размер событий на проводе и стоимость кодирования: JSON и msgpack
+
+Сравниваются три формата пакета Socket.IO на типичных событиях чата с
+кириллицей и эмодзи:
+
+- JSON - формат по умолчанию (python-socketio экранирует не-ASCII как \\uXXXX);
+- msgpack - стандартный MsgPackPacket python-socketio (имена событий строками);
+- компактный - wire.DualPacket: msgpack с числовыми кодами событий и типов.
+
+Запуск:
+    python benchmarks/bench_wire.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from socketio import packet
+from socketio.msgpack_packet import MsgPackPacket
+
+import wire
+
+TEXTS = [
+    "Привет! Как дела? 🙂",
+    "Созвонимся завтра в 10:00, я пришлю ссылку 📎",
+    "Ахахах 😂😂😂 это лучшее, что я видел сегодня",
+    "Ок 👍",
+    "Напоминаю: релиз в пятницу, тесты должны быть зелёными ✅ до четверга вечером",
+]
+NAMES = ["Алиса", "Борис", "Вера 🌸", "Григорий", "Дарья"]
+
+
+def chat_message(i):
+    return {
+        "type": "message", "id": 100000 + i, "seq": 200000 + i, "ts": 1792300000.123456 + i,
+        "username": NAMES[i % len(NAMES)], "text": TEXTS[i % len(TEXTS)],
+    }
+
+
+EVENTS = {
+    "message": ["message", chat_message(0)],
+    "join": ["message", {"type": "join", "username": "Вера 🌸", "seq": 200001, "ts": 1792300000.5}],
+    "batch x20": ["message_batch", {"events": [chat_message(i) for i in range(20)]}],
+    "snapshot x200": ["user_list", {
+        "type": "snapshot", "users": [f"{NAMES[i % len(NAMES)]} {i}" for i in range(200)], "version": 4242,
+    }],
+}
+
+FORMATS = {
+    "JSON": (packet.Packet, lambda pkt: pkt.encode()),
+    "msgpack": (MsgPackPacket, lambda pkt: pkt.encode()),
+    "компактный": (wire.DualPacket, lambda pkt: wire.DualPacket.encode_compact(pkt, cache=False)),
+}
+
+
+def measure(packet_class, encode, data, number):
+    """Размер в байтах и время кодирования и декодирования, мкс"""
+    # Сервер собирает пакет один раз на рассылку, поэтому замеряется только кодирование
+    pkt = packet_class(packet.EVENT, data=data, namespace="/")
+    encoded = encode(pkt)
+    size = len(encoded.encode("utf-8")) if isinstance(encoded, str) else len(encoded)
+
+    def run_encode():
+        encode(pkt)
+
+    def run_decode():
+        packet_class(encoded_packet=encoded)
+
+    encode_us = min(timeit.repeat(run_encode, number=number, repeat=3)) / number * 1e6
+    decode_us = min(timeit.repeat(run_decode, number=number, repeat=3)) / number * 1e6
+    return size, encode_us, decode_us
+
+
+def main():
+    if not wire.available():
+        print("msgpack не установлен")
+        return
+    print(f"{'событие':>14} | {'формат':>10} | {'байт':>6} | {'% от JSON':>9} | "
+          f"{'encode, мкс':>11} | {'decode, мкс':>11}")
+    print("-" * 78)
+    for name, data in EVENTS.items():
+        number = 200 if name.endswith("x200") or name.endswith("x20") else 5000
+        json_size = None
+        for format_name, (packet_class, encode) in FORMATS.items():
+            size, encode_us, decode_us = measure(packet_class, encode, data, number)
+            json_size = json_size or size
+            print(f"{name:>14} | {format_name:>10} | {size:>6} | {size * 100 / json_size:>8.0f}% | "
+                  f"{encode_us:>11.2f} | {decode_us:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Проверка кластерного режима: концентратор и K процессов server.py
+
+Запускается концентратор (cluster.py) и K серверов с --cluster. Клиенты
+распределяются по серверам по кругу, после чего несколько отправителей на
+разных серверах одновременно рассылают сообщения. Проверяется, что:
+
+- каждый клиент получил каждое сообщение ровно один раз;
+- все клиенты видят рассылки в одном и том же порядке seq;
+- одно имя нельзя занять одновременно на двух разных серверах.
+
+Запуск:
+    python benchmarks/cluster_fanout.py [--workers 3] [--clients 60] [--messages 30]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import socketio
+
+from bench_engines import ROOT, free_port, percentile, process_stats, start_server
+
+
+def start_hub(path):
+    """Запуск концентратора и ожидание появления его сокета"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "cluster.py"), "--socket", path],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("Концентратор не запустился")
+        time.sleep(0.05)
+    return process
+
+
+async def run_clients(urls, clients, messages, senders):
+    """Подключение клиентов к серверам по кругу, рассылка и сбор полученных событий"""
+    received = {}
+    latencies = []
+    bots = []
+
+    async def connect(i):
+        bot = socketio.AsyncClient(reconnection=False)
+        log = received.setdefault(i, [])
+
+        @bot.on("message")
+        async def on_message(data):
+            if data.get("type") == "message" and data["text"].startswith("fanout:"):
+                log.append((data["seq"], data["text"]))
+                latencies.append(time.time() - float(data["text"].split(":")[2]))
+
+        await bot.connect(urls[i % len(urls)], transports=["websocket"])
+        await bot.emit("join", {"username": f"bot-{i}"})
+        bots.append(bot)
+
+    await asyncio.gather(*(connect(i) for i in range(clients)))
+    await asyncio.sleep(2)
+
+    # Отправители - первые клиенты, то есть по одному на разных серверах
+    async def send(sender_index):
+        for n in range(messages):
+            await bots[sender_index].emit("send_message", {"text": f"fanout:{sender_index}-{n}:{time.time()}"})
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(send(i) for i in range(min(senders, len(bots)))))
+    expected = min(senders, len(bots)) * messages
+    deadline = time.monotonic() + 15
+    while any(len(log) < expected for log in received.values()) and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+    await asyncio.gather(*(bot.disconnect() for bot in bots), return_exceptions=True)
+    return received, expected, latencies
+
+
+async def check_unique_names(urls):
+    """Одновременный вход под одним именем на двух серверах: имя получает только один"""
+    errors = []
+    bots = []
+    for url in urls[:2]:
+        bot = socketio.AsyncClient(reconnection=False)
+
+        @bot.on("message")
+        async def on_message(data):
+            if data.get("type") == "error":
+                errors.append(data["text"])
+
+        await bot.connect(url, transports=["websocket"])
+        bots.append(bot)
+    await asyncio.gather(*(bot.emit("join", {"username": "Дубликат"}) for bot in bots))
+    await asyncio.sleep(1)
+    await asyncio.gather(*(bot.disconnect() for bot in bots), return_exceptions=True)
+    return len(errors) == len(bots) - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=60)
+    parser.add_argument("--messages", type=int, default=30)
+    parser.add_argument("--senders", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        hub_path = os.path.join(directory, "hub.sock")
+        hub = start_hub(hub_path)
+        workers = []
+        try:
+            urls = []
+            for i in range(args.workers):
+                port = free_port()
+                workers.append(start_server(
+                    "threading", port, os.path.join(directory, f"history-{i}.db"), "--cluster", hub_path
+                ))
+                urls.append(f"http://127.0.0.1:{port}")
+
+            received, expected, latencies = asyncio.run(
+                run_clients(urls, args.clients, args.messages, args.senders)
+            )
+            unique = asyncio.run(check_unique_names(urls))
+            rss = [process_stats(worker.pid)[0] for worker in workers]
+        finally:
+            for process in workers + [hub]:
+                process.terminate()
+                process.wait()
+
+    orders = {tuple(log) for log in received.values()}
+    complete = all(len(log) == expected and len(set(log)) == expected for log in received.values())
+    ordered = len(orders) == 1 and all(list(log) == sorted(log) for log in orders)
+
+    print(f"процессов: {args.workers}, клиентов: {len(received)}, ожидалось сообщений на клиента: {expected}")
+    print(f"доставлено всего: {sum(len(log) for log in received.values())} из {expected * len(received)}")
+    print(f"задержка доставки: p50 {percentile(latencies, 50) * 1000:.2f} мс, "
+          f"p99 {percentile(latencies, 99) * 1000:.2f} мс")
+    print(f"RSS процессов, МБ: {', '.join(f'{value:.1f}' for value in rss)}")
+    print(f"доставка без потерь и дублей: {'OK' if complete else 'FAIL'}")
+    print(f"единый порядок seq: {'OK' if ordered else 'FAIL'}")
+    print(f"уникальность имён между процессами: {'OK' if unique else 'FAIL'}")
+    sys.exit(0 if complete and ordered and unique else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Нагрузочный тест сервера чата с безголовыми клиентами
+
+Запускает server.py (или использует уже запущенный, --url) и M ботов на
+socketio.Client без интерфейса Flet. Боты входят под уникальными именами,
+отправляют сообщения с заданной частотой и измеряют задержку доставки по
+времени отправки, вложенному в текст сообщения.
+
+Сценарии:
+    join_storm      - одновременный вход M ботов: задержка входа и входов/с
+    chatty          - S отправителей пишут с частотой rate в течение duration:
+                      задержка доставки p50/p95/p99 и доставленных сообщений/с
+    mass_disconnect - одновременное отключение M ботов: время, за которое
+                      наблюдатель получит все уведомления о выходе
+
+Результаты печатаются таблицей, а с --json сохраняются в файл (или "-" для
+stdout) для сравнения между ревизиями.
+
+Запуск:
+    python benchmarks/loadgen.py [--scenario all] [--clients 100] [--senders 5] [--rate 10] [--duration 5]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+
+from bench_engines import free_port, percentile, process_stats, start_server
+
+# Префикс текста нагрузочных сообщений: "load:<время отправки>"
+PREFIX = "load:"
+
+
+class Bot:
+    """Безголовый клиент чата"""
+
+    def __init__(self, url, username):
+        self.url = url
+        self.username = username
+        self.client = socketio.Client(reconnection=False)
+        self.joined = threading.Event()
+        self.join_latency = None
+        self.latencies = []
+        self.leaves = 0
+        self.all_left = threading.Event()
+        self.expected_leaves = None
+        self.client.on("message", self._handle_message)
+        self.client.on("user_list", self._handle_user_list)
+
+    def join(self, timeout=30):
+        """Подключение и вход; задержка входа - до получения снимка списка пользователей"""
+        start = time.perf_counter()
+        self.client.connect(self.url, wait_timeout=timeout)
+        self.client.emit("join", {"username": self.username})
+        if self.joined.wait(timeout):
+            self.join_latency = time.perf_counter() - start
+        return self.join_latency is not None
+
+    def send(self):
+        """Отправка нагрузочного сообщения с текущим временем"""
+        self.client.emit("send_message", {"text": f"{PREFIX}{time.time()}"})
+
+    def disconnect(self):
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+
+    def _handle_user_list(self, data):
+        if data.get("type") == "snapshot":
+            self.joined.set()
+
+    def _handle_message(self, data):
+        kind = data.get("type")
+        if kind == "message" and data.get("text", "").startswith(PREFIX):
+            self.latencies.append(time.time() - float(data["text"][len(PREFIX):]))
+        elif kind == "leave":
+            self.leaves += 1
+            if self.expected_leaves is not None and self.leaves >= self.expected_leaves:
+                self.all_left.set()
+
+
+def join_bots(url, count, prefix, workers=64):
+    """Параллельный вход count ботов. Возвращает вошедших ботов и время входа всех"""
+    bots = [Bot(url, f"{prefix}-{i}") for i in range(count)]
+
+    def join(bot):
+        try:
+            return bot.join()
+        except Exception:
+            return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        joined = list(pool.map(join, bots))
+    elapsed = time.perf_counter() - start
+    for bot, ok in zip(bots, joined):
+        if not ok:
+            bot.disconnect()
+    return [bot for bot, ok in zip(bots, joined) if ok], elapsed
+
+
+def disconnect_all(bots, workers=64):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(Bot.disconnect, bots))
+
+
+def latency_summary(latencies):
+    """p50/p95/p99 в миллисекундах"""
+    return {
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def scenario_join_storm(url, args):
+    bots, elapsed = join_bots(url, args.clients, "storm")
+    result = {
+        "clients": args.clients,
+        "joined": len(bots),
+        "joins_per_sec": len(bots) / elapsed if elapsed else 0.0,
+        "join": latency_summary([bot.join_latency for bot in bots]),
+    }
+    disconnect_all(bots)
+    return result
+
+
+def scenario_chatty(url, args):
+    bots, _ = join_bots(url, args.clients, "chatty")
+    # Даём серверу разослать уведомления о входе
+    time.sleep(1)
+    senders = bots[:args.senders]
+    interval = 1.0 / args.rate
+
+    def send_loop(bot):
+        sent = 0
+        next_send = time.perf_counter()
+        deadline = next_send + args.duration
+        while next_send < deadline:
+            bot.send()
+            sent += 1
+            next_send += interval
+            time.sleep(max(0.0, next_send - time.perf_counter()))
+        return sent
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(senders) or 1) as pool:
+        sent = sum(pool.map(send_loop, senders))
+    # Ждём доставки хвоста рассылок
+    expected = sent * len(bots)
+    deadline = time.monotonic() + 10
+    while sum(len(bot.latencies) for bot in bots) < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    latencies = [value for bot in bots for value in bot.latencies]
+    result = {
+        "clients": len(bots),
+        "senders": len(senders),
+        "sent": sent,
+        "sent_per_sec": sent / args.duration,
+        "delivered": len(latencies),
+        "expected": expected,
+        "delivered_per_sec": len(latencies) / elapsed,
+        "fanout": latency_summary(latencies),
+    }
+    disconnect_all(bots)
+    return result
+
+
+def scenario_mass_disconnect(url, args):
+    bots, _ = join_bots(url, args.clients, "leaver")
+    observer = Bot(url, "observer")
+    observer.join()
+    observer.expected_leaves = len(bots)
+    start = time.perf_counter()
+    disconnect_all(bots)
+    drained = observer.all_left.wait(30)
+    result = {
+        "clients": len(bots),
+        "leaves_seen": observer.leaves,
+        "drain_sec": time.perf_counter() - start if drained else None,
+    }
+    observer.disconnect()
+    return result
+
+
+SCENARIOS = {
+    "join_storm": scenario_join_storm,
+    "chatty": scenario_chatty,
+    "mass_disconnect": scenario_mass_disconnect,
+}
+
+
+def run_scenario(name, args):
+    """Запуск сценария на свежем сервере (или на --url) с замером памяти сервера"""
+    if args.url:
+        result = SCENARIOS[name](args.url, args)
+        result["server_rss_mb"] = None
+        return result
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        process = start_server(args.engine, port, os.path.join(directory, "history.db"))
+        try:
+            idle_rss, _ = process_stats(process.pid)
+            peak_rss = idle_rss
+            stop = threading.Event()
+
+            def sample():
+                nonlocal peak_rss
+                while not stop.wait(0.1):
+                    peak_rss = max(peak_rss, process_stats(process.pid)[0])
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+            result = SCENARIOS[name](f"http://127.0.0.1:{port}", args)
+            stop.set()
+            sampler.join()
+        finally:
+            process.terminate()
+            process.wait()
+    result["server_rss_mb"] = {"idle": idle_rss, "peak": peak_rss}
+    return result
+
+
+def format_row(name, result):
+    """Краткая строка результата для консоли"""
+    if name == "join_storm":
+        join = result["join"]
+        return (f"вошли {result['joined']}/{result['clients']}, {result['joins_per_sec']:.1f} входов/с, "
+                f"вход p50/p95/p99 {join['p50_ms']:.1f}/{join['p95_ms']:.1f}/{join['p99_ms']:.1f} мс")
+    if name == "chatty":
+        fanout = result["fanout"]
+        return (f"отправлено {result['sent']} ({result['sent_per_sec']:.1f}/с), доставлено "
+                f"{result['delivered']}/{result['expected']} ({result['delivered_per_sec']:.0f}/с), "
+                f"p50/p95/p99 {fanout['p50_ms']:.1f}/{fanout['p95_ms']:.1f}/{fanout['p99_ms']:.1f} мс")
+    drain = result["drain_sec"]
+    return (f"отключились {result['clients']}, наблюдатель получил {result['leaves_seen']} выходов"
+            + (f" за {drain:.2f} с" if drain is not None else " (не все)"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--clients", type=int, default=100, help="число ботов M")
+    parser.add_argument("--senders", type=int, default=5, help="число отправителей в сценарии chatty")
+    parser.add_argument("--rate", type=float, default=10.0, help="сообщений в секунду на отправителя")
+    parser.add_argument("--duration", type=float, default=5.0, help="длительность сценария chatty, с")
+    parser.add_argument("--engine", default="threading", help="транспорт запускаемого сервера")
+    parser.add_argument("--url", help="адрес уже запущенного сервера (сервер не запускается)")
+    parser.add_argument("--json", help="файл для результатов в JSON ('-' - stdout)")
+    args = parser.parse_args()
+
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    report = {
+        "timestamp": time.time(),
+        "engine": None if args.url else args.engine,
+        "params": {key: getattr(args, key) for key in ("clients", "senders", "rate", "duration")},
+        "scenarios": {},
+    }
+    for name in names:
+        result = run_scenario(name, args)
+        report["scenarios"][name] = result
+        rss = result["server_rss_mb"]
+        rss_text = f", RSS {rss['idle']:.1f} -> {rss['peak']:.1f} МБ" if rss else ""
+        print(f"{name:>16}: {format_row(name, result)}{rss_text}", file=sys.stderr if args.json == "-" else sys.stdout)
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""Воспроизведение записанного трафика и сравнение ревизий сервера
+
+Журнал записывает сервер, запущенный с --record (см. recorder.py): время,
+номер соединения и обезличенные события connect, join, send_message и
+disconnect. Каждое соединение журнала воспроизводит отдельный безголовый
+клиент socketio.Client в своём потоке, сохраняя паузы между событиями:
+в реальном времени (--speed 1), ускоренно (--speed N) или без пауз
+(--speed 0; отключения тогда откладываются до конца прогона, иначе
+клиенты уходят раньше, чем получат рассылки). Текст сообщения - "replay:<время отправки>", дополненный до
+записанной длины, по нему замеряется задержка доставки.
+
+Без --url сервер запускается на свободном порту со свежей историей. С
+--rev журнал воспроизводится на сервере каждой указанной ревизии git
+(ревизия извлекается во временный git worktree), и печатается сравнение
+пропускной способности и задержек с первой ревизией.
+
+Сервер ревизии запускается с ключами REQUIRED_OPTIONS (--engine, --port,
+--history, --no-rate-limit), поэтому самая старая поддерживаемая ревизия -
+коммит, добавивший ограничение частоты сообщений и ключ --no-rate-limit
+("Rate-limit send_message with token buckets per sid and username").
+Более старый server.py не разбирает аргументы и всегда слушает порт 4000;
+такая ревизия отклоняется до запуска с сообщением о недостающих ключах.
+
+Запуск:
+    python server.py --record traffic.jsonl
+    python benchmarks/replay.py traffic.jsonl [--speed 1] [--rev main --rev HEAD] [--json result.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_engines import ROOT, free_port, process_stats, start_server
+from loadgen import latency_summary
+from recorder import FORMAT, VERSION
+
+# Префикс текста воспроизводимых сообщений: "replay:<время отправки>"
+PREFIX = "replay:"
+
+# Максимальная длина текста (как ChatServer.MAX_MESSAGE_LENGTH)
+MAX_TEXT_LENGTH = 1000
+
+# Ключи командной строки server.py, с которыми его запускает start_server
+REQUIRED_OPTIONS = ("--engine", "--port", "--history", "--no-rate-limit")
+
+# Ожидание входа и доставки хвоста рассылок (секунды)
+JOIN_TIMEOUT = 10.0
+DRAIN_TIMEOUT = 2.0
+
+
+def load_log(path):
+    """Чтение журнала: события по номерам соединений и длительность записи"""
+    with open(path, encoding="utf-8") as log:
+        header = json.loads(log.readline())
+        if header.get("format") != FORMAT or header.get("version") != VERSION:
+            raise ValueError(f"{path}: не журнал трафика {FORMAT} версии {VERSION}")
+        connections = {}
+        duration = 0.0
+        for line in log:
+            if not line.strip():
+                continue
+            t, client, event, *data = json.loads(line)
+            connections.setdefault(client, []).append((t, event, data[0] if data else None))
+            duration = max(duration, t)
+    return connections, duration
+
+
+class ReplayClient:
+    """Безголовый клиент, воспроизводящий события одного соединения журнала"""
+
+    def __init__(self, url, events):
+        self.url = url
+        self.events = events
+        self.client = socketio.Client(reconnection=False)
+        self.joined = threading.Event()
+        self.connected = False
+        self.join_latencies = []
+        self.latencies = []
+        self.sent = 0
+        self.errors = 0
+        self.client.on("message", self._handle_message)
+        self.client.on("message_batch", self._handle_batch)
+        self.client.on("user_list", self._handle_user_list)
+
+    def run(self, start, speed):
+        """Воспроизведение событий с паузами журнала, ускоренными в speed раз (0 - без пауз)"""
+        for t, event, data in self.events:
+            if speed:
+                time.sleep(max(0.0, start + t / speed - time.perf_counter()))
+            elif event == "disconnect":
+                continue
+            try:
+                getattr(self, f"_replay_{event}")(data)
+            except Exception:
+                self.errors += 1
+                if not self.connected:
+                    return
+
+    def disconnect(self):
+        if self.connected:
+            self.connected = False
+            try:
+                self.client.disconnect()
+            except Exception:
+                pass
+
+    def _replay_connect(self, data):
+        self.client.connect(self.url, wait_timeout=JOIN_TIMEOUT)
+        self.connected = True
+
+    def _replay_join(self, data):
+        """Вход; задержка входа - до получения снимка списка пользователей"""
+        self.joined.clear()
+        begin = time.perf_counter()
+        self.client.emit("join", data)
+        if self.joined.wait(JOIN_TIMEOUT):
+            self.join_latencies.append(time.perf_counter() - begin)
+        else:
+            self.errors += 1
+
+    def _replay_send_message(self, data):
+        """Отправка сообщения записанной длины с текущим временем в начале текста"""
+        text = f"{PREFIX}{time.time()}"
+        length = min(data.get("length", 0), MAX_TEXT_LENGTH)
+        if length > len(text) + 1:
+            text = f"{text} {'x' * (length - len(text) - 1)}"
+        message = {"text": text}
+        if "room" in data:
+            message["room"] = data["room"]
+        self.client.emit("send_message", message)
+        self.sent += 1
+
+    def _replay_disconnect(self, data):
+        self.disconnect()
+
+    def _handle_user_list(self, data):
+        if data.get("type") == "snapshot":
+            self.joined.set()
+
+    def _handle_message(self, data):
+        text = data.get("text", "")
+        if data.get("type") == "message" and text.startswith(PREFIX):
+            self.latencies.append(time.time() - float(text[len(PREFIX):].split(" ", 1)[0]))
+
+    def _handle_batch(self, data):
+        for event in data.get("events", ()):
+            self._handle_message(event)
+
+
+def replay(url, connections, speed):
+    """Воспроизведение журнала на сервере url. Возвращает сводку прогона"""
+    clients = [ReplayClient(url, events) for _, events in sorted(connections.items())]
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client.run, args=(start, speed), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Соединения, не закрытые в журнале (или при --speed 0), ждут хвост рассылок
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    delivered = -1
+    while time.monotonic() < deadline:
+        current = sum(len(client.latencies) for client in clients)
+        if current == delivered:
+            break
+        delivered = current
+        time.sleep(0.2)
+    for client in clients:
+        client.disconnect()
+
+    latencies = [value for client in clients for value in client.latencies]
+    sent = sum(client.sent for client in clients)
+    return {
+        "connections": len(clients),
+        "joins": sum(len(client.join_latencies) for client in clients),
+        "errors": sum(client.errors for client in clients),
+        "sent": sent,
+        "delivered": len(latencies),
+        "elapsed_sec": elapsed,
+        "sent_per_sec": sent / elapsed if elapsed else 0.0,
+        "delivered_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "fanout": latency_summary(latencies),
+        "join": latency_summary([value for client in clients for value in client.join_latencies]),
+    }
+
+
+def run_local(root, connections, args):
+    """Воспроизведение на сервере из каталога root с замером пиковой памяти"""
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        process = start_server(args.engine, port, os.path.join(directory, "history.db"), root=root)
+        try:
+            peak_rss = process_stats(process.pid)[0]
+            stop = threading.Event()
+
+            def sample():
+                nonlocal peak_rss
+                while not stop.wait(0.1):
+                    peak_rss = max(peak_rss, process_stats(process.pid)[0])
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+            result = replay(f"http://127.0.0.1:{port}", connections, args.speed)
+            stop.set()
+            sampler.join()
+        finally:
+            process.terminate()
+            process.wait()
+    result["server_rss_mb"] = peak_rss
+    return result
+
+
+def check_revision(revision, root):
+    """Проверка, что server.py ревизии принимает ключи REQUIRED_OPTIONS"""
+    with open(os.path.join(root, "server.py"), encoding="utf-8") as server:
+        source = server.read()
+    missing = [option for option in REQUIRED_OPTIONS if f'"{option}"' not in source]
+    if missing:
+        raise RuntimeError(
+            f"ревизия {revision} не поддерживается: server.py не принимает {', '.join(missing)} "
+            f"(нужна ревизия не старше коммита с ключом --no-rate-limit)"
+        )
+
+
+def run_revision(revision, connections, args):
+    """Воспроизведение на сервере ревизии git, извлечённой во временный worktree"""
+    with tempfile.TemporaryDirectory() as directory:
+        worktree = os.path.join(directory, "src")
+        added = subprocess.run(
+            ["git", "-C", ROOT, "worktree", "add", "--detach", worktree, revision],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        if added.returncode:
+            raise RuntimeError(f"ревизия {revision}: {added.stderr.strip()}")
+        try:
+            check_revision(revision, worktree)
+            try:
+                return run_local(worktree, connections, args)
+            except RuntimeError as e:
+                raise RuntimeError(f"ревизия {revision}: {e}") from e
+        finally:
+            subprocess.run(["git", "-C", ROOT, "worktree", "remove", "--force", worktree], check=False)
+
+
+# Показатели сравнения: (название, извлечение из сводки, больше - лучше)
+METRICS = (
+    ("отправлено/с", lambda result: result["sent_per_sec"], True),
+    ("доставлено/с", lambda result: result["delivered_per_sec"], True),
+    ("доставка p50, мс", lambda result: result["fanout"]["p50_ms"], False),
+    ("доставка p95, мс", lambda result: result["fanout"]["p95_ms"], False),
+    ("доставка p99, мс", lambda result: result["fanout"]["p99_ms"], False),
+    ("вход p50, мс", lambda result: result["join"]["p50_ms"], False),
+    ("вход p99, мс", lambda result: result["join"]["p99_ms"], False),
+    ("RSS сервера, МБ", lambda result: result["server_rss_mb"], False),
+)
+
+
+def format_row(result):
+    """Краткая строка результата прогона для консоли"""
+    fanout, join = result["fanout"], result["join"]
+    return (f"соединений {result['connections']}, входов {result['joins']}, ошибок {result['errors']}, "
+            f"отправлено {result['sent']} ({result['sent_per_sec']:.1f}/с), доставлено {result['delivered']} "
+            f"({result['delivered_per_sec']:.0f}/с), доставка p50/p95/p99 "
+            f"{fanout['p50_ms']:.1f}/{fanout['p95_ms']:.1f}/{fanout['p99_ms']:.1f} мс, "
+            f"вход p50/p99 {join['p50_ms']:.1f}/{join['p99_ms']:.1f} мс")
+
+
+def print_comparison(results, output):
+    """Таблица показателей ревизий и изменение относительно первой (+ - лучше)"""
+    names = list(results)
+    base = results[names[0]]
+    width = max(12, *map(len, names))
+    print(f"{'показатель':>18} | " + " | ".join(f"{name:>{width}}" for name in names) + " | изменение",
+          file=output)
+    print("-" * (32 + (width + 3) * len(names)), file=output)
+    for label, value, higher_is_better in METRICS:
+        values = [value(results[name]) for name in names]
+        if value(base) is None or values[-1] is None:
+            continue
+        row = " | ".join(f"{item:>{width}.1f}" for item in values)
+        change = (values[-1] - values[0]) / values[0] if values[0] else float("nan")
+        better = change if higher_is_better else -change
+        print(f"{label:>18} | {row} | {change:>+8.1%} ({'лучше' if better > 0 else 'хуже' if better < 0 else '='})",
+              file=output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", help="журнал трафика (server.py --record)")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение: 1 - реальное время, 0 - без пауз")
+    parser.add_argument("--engine", default="threading", help="транспорт запускаемого сервера")
+    parser.add_argument("--url", help="адрес уже запущенного сервера (сервер не запускается)")
+    parser.add_argument("--rev", action="append", help="ревизия git для сравнения (можно указать несколько раз)")
+    parser.add_argument("--json", help="файл для результатов в JSON ('-' - stdout)")
+    args = parser.parse_args()
+    if args.url and args.rev:
+        parser.error("--url и --rev несовместимы")
+    if args.speed < 0:
+        parser.error("--speed не может быть отрицательным")
+
+    connections, duration = load_log(args.log)
+    output = sys.stderr if args.json == "-" else sys.stdout
+    events = sum(map(len, connections.values()))
+    print(f"журнал: {len(connections)} соединений, {events} событий за {duration:.1f} с, "
+          f"скорость {'без пауз' if not args.speed else f'x{args.speed:g}'}", file=output)
+
+    results = {}
+    if args.url:
+        results["url"] = replay(args.url, connections, args.speed)
+        results["url"]["server_rss_mb"] = None
+    elif args.rev:
+        try:
+            for revision in args.rev:
+                results[revision] = run_revision(revision, connections, args)
+        except RuntimeError as e:
+            parser.exit(1, f"{parser.prog}: {e}\n")
+    else:
+        results["worktree"] = run_local(ROOT, connections, args)
+    for name, result in results.items():
+        rss = result["server_rss_mb"]
+        print(f"{name:>12}: {format_row(result)}" + (f", RSS {rss:.1f} МБ" if rss else ""), file=output)
+
+    if len(results) > 1:
+        print(file=output)
+        print_comparison(results, output)
+
+    report = {
+        "timestamp": time.time(),
+        "log": os.path.abspath(args.log),
+        "speed": args.speed,
+        "engine": None if args.url else args.engine,
+        "revisions": results,
+    }
+    if args.json == "-":
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
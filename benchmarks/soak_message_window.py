@@ -0,0 +1,68 @@
+"""Проверка потребления памяти списком сообщений клиента при длительной работе
+
+Через TelegramChatApp без подключения к серверу и без окна прогоняется
+поток сообщений, а объём памяти, выделенной Python, снимается через
+tracemalloc. При ограниченном окне объём должен выйти на плато, а не расти
+вместе с числом сообщений.
+
+Запуск:
+    python benchmarks/soak_message_window.py [--messages 100000]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import RenderScheduler, TelegramChatApp
+
+CHECKPOINTS = 10
+
+
+def soak(total):
+    """Добавление total сообщений с замером памяти в контрольных точках"""
+    app = TelegramChatApp()
+    app.username = "me"
+    app.active = app._create_channel(app.DEFAULT_ROOM)
+    # Без окна отправлять изменения некуда: применяем их пачками по кадрам вручную
+    app.renderer = RenderScheduler(lambda controls: None, 0)
+    frame = 20
+
+    step = max(1, total // CHECKPOINTS)
+    tracemalloc.start()
+    samples = []
+    for i in range(1, total + 1):
+        username = "me" if i % 3 == 0 else f"user-{i % 50}"
+        app._add_chat_message(username, f"Сообщение №{i} 🙂 тест нагрузки", "12:00")
+        if i % frame == 0:
+            app.renderer.flush_pending()
+        if i % step == 0:
+            current, _ = tracemalloc.get_traced_memory()
+            samples.append((i, current, len(app.active.message_list.controls)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return samples, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    args = parser.parse_args()
+
+    samples, peak = soak(args.messages)
+    print(f"{'сообщений':>10} | {'память, МБ':>10} | {'элементов':>9}")
+    print("-" * 36)
+    for count, current, controls in samples:
+        print(f"{count:>10} | {current / 2**20:>10.2f} | {controls:>9}")
+    print(f"пик: {peak / 2**20:.2f} МБ")
+
+    # После заполнения хранилища рост памяти должен прекратиться
+    settled = [current for count, current, _ in samples if count > TelegramChatApp.MAX_STORED_MESSAGES]
+    if len(settled) >= 2:
+        growth = (settled[-1] - settled[0]) / settled[0] * 100
+        print(f"рост после заполнения хранилища: {growth:+.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,344 @@
 import flet as ft
 import socketio
+import collections
+import contextlib
+import functools
+import hashlib
+import itertools
+import mimetypes
+import queue
+import threading
 import time
 import datetime
 import logging
-import sys
+import os
+import random
+import re
 import traceback
 
+import requests
+
+import logpipe
+import wire
+from localcache import LocalCache
+from ratelimit import TokenBucket
+
+try:
+    from PIL import Image
+except ImportError:  # без Pillow изображения показываются из исходного файла
+    Image = None
+
+
+class MessageWindow:
+    """Ограниченное хранилище сообщений с окном отображаемых элементов
+    
+    Хранит не более max_records лёгких записей о сообщениях, из которых в дереве
+    элементов находятся только последние max_visible. Более старые записи
+    возвращаются страницами по page_size при прокрутке вверх.
+    """
+    
+    def __init__(self, max_records, max_visible, page_size):
+        self.records = collections.deque(maxlen=max_records)
+        self.max_visible = max_visible
+        self.page_size = page_size
+        # Количество последних записей, для которых есть элементы в списке
+        self.visible = 0
+    
+    def append(self, record, trim=True):
+        """Добавление записи. Возвращает число старейших элементов, которые нужно убрать из списка"""
+        stale = 0
+        if len(self.records) == self.records.maxlen and self.visible == len(self.records):
+            # Вытесняется запись, которая сейчас отображается
+            stale = 1
+        else:
+            self.visible += 1
+        self.records.append(record)
+        if trim:
+            stale += self.trim()
+        return stale
+    
+    def prepend(self, records):
+        """Добавление более старых записей в начало хранилища.
+        
+        Возвращает записи, для которых нужно создать элементы в начале списка:
+        если в хранилище есть неотображаемые записи, новые тоже не отображаются.
+        """
+        room = self.records.maxlen - len(self.records)
+        accepted = records[max(0, len(records) - room):]
+        all_visible = self.visible == len(self.records)
+        self.records.extendleft(reversed(accepted))
+        if not all_visible:
+            return []
+        self.visible += len(accepted)
+        return accepted
+    
+    def trim(self):
+        """Сокращение окна до max_visible. Возвращает число убранных элементов"""
+        excess = max(0, self.visible - self.max_visible)
+        self.visible -= excess
+        return excess
+    
+    def older_page(self):
+        """Следующая страница записей, предшествующих первому отображаемому элементу"""
+        end = len(self.records) - self.visible
+        start = max(0, end - self.page_size)
+        page = list(itertools.islice(self.records, start, end))
+        self.visible += len(page)
+        return page
+
+
+class Channel:
+    """Открытая комната или личный диалог: сообщения, участники и курсор истории
+    
+    У диалога peer - имя собеседника, а room - ключ вида "@имя".
+    """
+    
+    def __init__(self, room, message_list, users_list, message_window, peer=None):
+        self.room = room
+        self.peer = peer
+        self.message_list = message_list
+        self.users_list = users_list
+        # Записи сообщений и окно отображаемых элементов
+        self.message_window = message_window
+        
+        # Элементы боковой панели по имени пользователя и версия списка на сервере
+        self.user_items = {}
+        self.presence_version = None
+        # Изменился ли список участников после последнего сохранения в кэш
+        self.members_dirty = False
+        
+        # Курсор истории: id самого старого и самого нового полученных сообщений
+        self.oldest_message_id = None
+        self.newest_message_id = None
+        self.history_exhausted = False
+        self.history_requested = False
+        
+        # Эфемерное состояние: кто печатает (имя -> время окончания показа),
+        # кто до какого id прочитал и какая отметка прочтения уже отправлена
+        self.typing = {}
+        self.reads = {}
+        self.read_sent_id = None
+
+
+class RenderScheduler:
+    """Планировщик обновлений интерфейса с объединением изменений по кадрам
+    
+    Изменения элементов передаются в submit() из любого потока и применяются
+    в фоновом потоке пачкой, после чего выполняется одна отправка изменений
+    в Flet - не чаще одного раза за interval секунд.
+    """
+    
+    def __init__(self, flush, interval):
+        # flush(controls) отправляет изменения: None - вся страница, иначе - только эти элементы
+        self._flush = flush
+        self.interval = interval
+        self._pending = collections.deque()
+        self._wakeup = threading.Event()
+        # Пока открыт блок hold(), накопленные изменения не отправляются
+        self._hold_lock = threading.Lock()
+        self._holds = 0
+        self._last_flush = 0.0
+        self._thread = None
+        self.logger = logging.getLogger("TelegramChat")
+        
+        # Счётчики: получено изменений и выполнено отправок
+        self.events_received = 0
+        self.flushes_performed = 0
+    
+    def start(self):
+        """Запуск фонового потока отправки изменений"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="RenderScheduler", daemon=True)
+            self._thread.start()
+    
+    def submit(self, mutation=None, *controls):
+        """Постановка изменения в очередь.
+        
+        mutation выполняется в потоке планировщика, controls - элементы,
+        которые оно затрагивает (без них обновляется вся страница).
+        """
+        self._pending.append((mutation, controls))
+        self.events_received += 1
+        self._wakeup.set()
+    
+    @contextlib.contextmanager
+    def hold(self):
+        """Блок, все изменения из которого попадут в одну отправку"""
+        with self._hold_lock:
+            self._holds += 1
+        try:
+            yield
+        finally:
+            with self._hold_lock:
+                self._holds -= 1
+            self._wakeup.set()
+    
+    def stats(self):
+        """Значения счётчиков планировщика"""
+        return {"events_received": self.events_received, "flushes_performed": self.flushes_performed}
+    
+    def _run(self):
+        """Цикл фонового потока"""
+        while True:
+            self._wakeup.wait()
+            # Даём изменениям накопиться до конца текущего кадра
+            delay = self._last_flush + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._wakeup.clear()
+            self.flush_pending()
+    
+    def flush_pending(self):
+        """Применение накопленных изменений и одна отправка в Flet"""
+        batch = []
+        with self._hold_lock:
+            if self._holds:
+                # Отправим после закрытия блока hold()
+                return
+            while self._pending:
+                batch.append(self._pending.popleft())
+        if not batch:
+            return
+        
+        full_update = False
+        dirty = {}
+        for mutation, controls in batch:
+            if mutation is not None:
+                try:
+                    mutation()
+                except Exception as e:
+                    self.logger.error("Ошибка применения изменения интерфейса: %s", e)
+            if not controls:
+                full_update = True
+            for control in controls:
+                dirty[id(control)] = control
+        
+        try:
+            self._flush(None if full_update else list(dirty.values()))
+        except Exception as e:
+            self.logger.error("Ошибка обновления интерфейса: %s", e)
+        self.flushes_performed += 1
+        self._last_flush = time.monotonic()
+
+
+class AttachmentCache:
+    """Локальные копии вложений, скачиваемые по требованию
+    
+    Файл скачивается фоновым потоком при первом отображении сообщения с
+    ним: ответ сервера пишется на диск блоками, без чтения в память целиком,
+    и проверяется по хэшу. Файлы хранятся под своим хэшем, поэтому повторная
+    отрисовка пузыря и перезапуск клиента не обращаются к серверу. Для
+    изображений один раз строится уменьшенная копия (если установлен Pillow).
+    """
+    
+    HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+    DOWNLOAD_TIMEOUT = 30       # секунды
+    BLOCK_SIZE = 64 * 1024
+    
+    def __init__(self, directory, base_url, thumbnail_size):
+        self.directory = directory
+        self.base_url = base_url
+        self.thumbnail_size = thumbnail_size
+        self.logger = logging.getLogger("TelegramChat")
+        # Готовые пути для отображения и ожидающие загрузки обработчики по хэшу
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._waiting = {}
+        self._queue = queue.Queue()
+        self._thread = None
+    
+    def url(self, attachment):
+        """Адрес вложения на сервере"""
+        return f"{self.base_url}/attachments/{attachment['hash']}"
+    
+    def get(self, attachment, callback):
+        """Путь к локальной копии для отображения или None, если она ещё не готова.
+        
+        Во втором случае файл ставится в очередь загрузки (один раз на хэш),
+        а callback(path) вызывается из фонового потока по готовности
+        (path - None, если загрузить не удалось).
+        """
+        digest = attachment["hash"]
+        if not self.HASH_PATTERN.fullmatch(digest):
+            return None
+        with self._lock:
+            path = self._ready.get(digest)
+            if path is not None:
+                return path
+            if digest in self._waiting:
+                self._waiting[digest].append(callback)
+                return None
+            path = self._display_path(attachment)
+            if path is not None:
+                self._ready[digest] = path
+                return path
+            self._waiting[digest] = [callback]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="AttachmentDownloader", daemon=True)
+                self._thread.start()
+        self._queue.put(attachment)
+        return None
+    
+    def _run(self):
+        """Цикл фонового потока: загрузка файлов по очереди"""
+        while True:
+            attachment = self._queue.get()
+            digest = attachment["hash"]
+            try:
+                self._download(attachment)
+                path = self._display_path(attachment)
+            except Exception as e:
+                self.logger.error("Не удалось загрузить вложение %s: %s", attachment.get("name"), e)
+                path = None
+            with self._lock:
+                if path is not None:
+                    self._ready[digest] = path
+                callbacks = self._waiting.pop(digest, [])
+            for callback in callbacks:
+                try:
+                    callback(path)
+                except Exception as e:
+                    self.logger.error("Ошибка отображения вложения: %s", e)
+    
+    def _file_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+    
+    def _display_path(self, attachment):
+        """Путь для отображения (уменьшенная копия изображения, если её можно построить) или None"""
+        path = self._file_path(attachment["hash"])
+        if not os.path.isfile(path):
+            return None
+        if Image is None or not attachment.get("mime", "").startswith("image/"):
+            return path
+        thumbnail = path + ".thumb.png"
+        if not os.path.isfile(thumbnail):
+            try:
+                with Image.open(path) as image:
+                    image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                    image.save(thumbnail, "PNG")
+            except Exception as e:
+                self.logger.warning("Не удалось построить миниатюру %s: %s", attachment.get("name"), e)
+                return path
+        return thumbnail
+    
+    def _download(self, attachment):
+        """Потоковая загрузка файла во временный файл, проверка хэша и перенос на место"""
+        digest = attachment["hash"]
+        path = self._file_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + ".part"
+        hasher = hashlib.sha256()
+        with requests.get(self.url(attachment), stream=True, timeout=self.DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(temporary, "wb") as file:
+                for block in response.iter_content(self.BLOCK_SIZE):
+                    hasher.update(block)
+                    file.write(block)
+        if hasher.hexdigest() != digest:
+            os.remove(temporary)
+            raise ValueError("содержимое не совпадает с хэшем")
+        os.replace(temporary, path)
+
 
 class TelegramChatApp:
     """Класс приложения чата в стиле Telegram"""
@@ -22,43 +355,154 @@ class TelegramChatApp:
         "system": "#7D8E9A",
         "timestamp_other": "#7D8E9A",
         "timestamp_user": "#A1C886",
+        "online": "#A1C886",
         "text": "#FFFFFF"
     }
     
     # Настройки подключения
     SERVER_URL = "http://localhost:4000"
-    MAX_RECONNECT_ATTEMPTS = 3
-    RECONNECT_DELAY = 2  # секунды
+    # Переподключение: пауза перед попыткой n - случайная от 0 до
+    # min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2**n), чтобы клиенты не шли волной
+    RECONNECT_BASE_DELAY = 0.5  # секунды
+    RECONNECT_MAX_DELAY = 30
+    # Очередь исходящих: ожидание ответа сервера на загрузку вложения и частота
+    # отправки (ниже лимита сервера: 5 сообщений в секунду, до 10 подряд)
+    OUTBOX_ACK_TIMEOUT = 5
+    OUTBOX_RATE = 4.0
+    OUTBOX_BURST = 8
+    
+    # Ограничения списка сообщений
+    MAX_STORED_MESSAGES = 5000    # записей в памяти
+    MAX_VISIBLE_MESSAGES = 200    # элементов в списке при прокрутке к концу
+    MESSAGE_PAGE_SIZE = 50        # элементов, подгружаемых при прокрутке вверх
+    SCROLL_LOAD_THRESHOLD = 50    # пикселей до края списка
+    
+    # Минимальный интервал между отправками изменений интерфейса (секунды)
+    FRAME_INTERVAL = 0.033
+    
+    # Пузыри сообщений: ширина, отступ от противоположного края списка и отступы
+    # сверху - перед первым сообщением автора и перед следующими его сообщениями подряд
+    BUBBLE_WIDTH = 300
+    BUBBLE_INDENT = 50
+    BUBBLE_SPACING = 8
+    GROUP_SPACING = 2
+    
+    # Локальный кэш сообщений и участников (записи разделены по SERVER_URL)
+    CACHE_PATH = os.path.join(os.path.expanduser("~"), ".flet_chat", "cache.db")
+    CACHED_MESSAGES_ON_START = 200  # сообщений комнаты, отображаемых из кэша при запуске
+    MEMBERS_SAVE_INTERVAL = 5.0     # сохранение участников после входов и выходов не чаще (секунды)
+    
+    # Поиск по истории: результатов на страницу; "from:имя" в запросе - фильтр по автору
+    SEARCH_PAGE_SIZE = 20
+    SEARCH_AUTHOR_PREFIX = "from:"
+    
+    # Вложения: размер куска загрузки, максимальный размер файла (как на сервере),
+    # каталог локальных копий и размер миниатюр изображений (пиксели)
+    ATTACHMENT_CHUNK_SIZE = 64 * 1024
+    MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024
+    ATTACHMENT_DIR = os.path.join(os.path.expanduser("~"), ".flet_chat", "attachments")
+    THUMBNAIL_SIZE = 320
+    
+    # Эфемерные события: "печатает" отправляется не чаще TYPING_SEND_INTERVAL (сервер
+    # пропускает одно за 3 с) и показывается TYPING_TIMEOUT секунд; отметка прочтения
+    # текущей комнаты - не чаще READ_SEND_INTERVAL; EPHEMERAL_TICK - период фонового потока
+    TYPING_SEND_INTERVAL = 4.0
+    TYPING_TIMEOUT = 6.0
+    READ_SEND_INTERVAL = 2.0
+    EPHEMERAL_TICK = 0.5
+    
+    # Лог: строки JSON вместо текста и выборка частых записей (категория -> N, одна из N)
+    LOG_JSON = False
+    LOG_SAMPLING = {"reconnect": 5}
+    
+    # Комнаты: открытая при входе и допустимые имена (как на сервере)
+    DEFAULT_ROOM = "general"
+    ROOM_PATTERN = re.compile(r"[\w-]{1,32}")
     
     def __init__(self):
         """Инициализация приложения чата"""
         # Настройка логирования
         self._setup_logging()
         
-        # Инициализация SocketIO клиента
-        self.sio = socketio.Client(logger=False, engineio_logger=False)
+        # Инициализация SocketIO клиента: формат JSON или msgpack, если сервер его поддерживает
+        self.packet_class = wire.client_packet_class()
+        # Переподключением управляет собственный фоновый поток, а не socketio.Client
+        self.sio = socketio.Client(
+            reconnection=False, logger=False, engineio_logger=False, serializer=self.packet_class
+        )
         
         # Состояние приложения
         self.username = None
         self.page = None
         
+        # Открытые комнаты (сервер присылает события только их) и текущая комната
+        self.channels = {}
+        self.active = None
+        
+        # Поток рассылок сервера и номер последнего полученного события
+        self.stream_id = None
+        self.last_seq = None
+        
+        # Локальный кэш (открывается в main) и локальные копии вложений
+        self.cache = None
+        self.attachments = AttachmentCache(self.ATTACHMENT_DIR, self.SERVER_URL, self.THUMBNAIL_SIZE)
+        
+        # Текущий поиск (комната, запрос, автор) и id последнего показанного результата
+        self.search = None
+        self.search_before_id = None
+        
+        # Фоновый поток подключения: будится при разрыве и при появлении исходящих.
+        # joined устанавливается после ответа сервера на join (событие resume)
+        self.connection_wakeup = threading.Event()
+        self.connection_thread = None
+        self.joined = threading.Event()
+        # Исходящие события (событие, данные), отправляемые по порядку после входа;
+        # отправленные, но не подтверждённые сервером - в outbox_in_flight (id записи -> запись)
+        self.outbox = collections.deque()
+        self.outbox_lock = threading.Lock()
+        self.outbox_in_flight = {}
+        self.outbox_budget = TokenBucket(self.OUTBOX_RATE, self.OUTBOX_BURST)
+        self.connection_state = "connecting"
+        self.retry_delay = None
+        
+        # Эфемерные события: время последней отправки "печатает" и отметки прочтения,
+        # текст строки активности в заголовке
+        self.typing_sent = 0.0
+        self.read_sent = 0.0
+        # Время последнего сохранения изменившихся списков участников в кэш
+        self.members_saved = 0.0
+        self.activity_text = ""
+        
+        # Планировщик отправки изменений интерфейса
+        self.renderer = RenderScheduler(self._flush_ui, self.FRAME_INTERVAL)
+        
+        # Стили пузырей создаются один раз и используются всеми сообщениями
+        self.bubble_styles = self._build_bubble_styles()
+        
         # Основные UI элементы, которые будут созданы позже
-        self.message_list = None
+        self.message_container = None
         self.message_input = None
-        self.users_list = None
-        self.loading_indicator = None
+        self.file_picker = None
+        self.users_container = None
+        self.users_title = None
+        self.connection_indicator = None
+        self.connection_label = None
+        self.activity_label = None
+        self.channel_tabs = None
+        self.room_input = None
+        self.search_input = None
+        self.search_panel = None
+        self.search_title = None
+        self.search_results = None
+        self.search_more_button = None
         self.username_input = None
         self.username_error = None
         self.join_view = None
         self.chat_view = None
         
     def _setup_logging(self):
-        """Настройка логирования"""
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[logging.StreamHandler(sys.stdout)]
-        )
+        """Настройка логирования: запись в stdout из фонового потока (logpipe)"""
+        logpipe.setup(json_format=self.LOG_JSON, sampling=self.LOG_SAMPLING)
         self.logger = logging.getLogger("TelegramChat")
 
     def _register_socket_handlers(self):
@@ -67,10 +511,30 @@ class TelegramChatApp:
         def on_message(data):
             self._handle_message(data)
 
+        @self.sio.on("message_batch")
+        def on_message_batch(data):
+            self._handle_message_batch(data)
+
+        @self.sio.on("resume")
+        def on_resume(data):
+            self._handle_resume(data)
+
+        @self.sio.on("history")
+        def on_history(data):
+            self._handle_history(data)
+
         @self.sio.on("user_list")
         def on_user_list(data):
             self._handle_user_list(data)
 
+        @self.sio.on("search_results")
+        def on_search_results(data):
+            self._handle_search_results(data)
+
+        @self.sio.on("ephemeral")
+        def on_ephemeral(data):
+            self._handle_ephemeral(data)
+
         @self.sio.on("disconnect")
         def on_disconnect():
             self._handle_disconnect()
@@ -78,86 +542,597 @@ class TelegramChatApp:
     def _handle_message(self, data):
         """Обработка полученных сообщений"""
         try:
+            # Пропускаем события, которые уже были получены
+            seq = data.get("seq")
+            if seq is not None:
+                if self.last_seq is not None and seq <= self.last_seq:
+                    return
+                self.last_seq = seq
+            
+            if data["type"] == "error":
+                self._add_system_message(data["text"], is_error=True)
+                return
+            if data["type"] == "missed":
+                self._add_system_message(f"Соединение не успевает: пропущено сообщений - {data['count']}", is_error=True)
+                return
+            if data["type"] == "direct":
+                # Личное сообщение (или эхо своего) открывает диалог, не переключаясь в него
+                peer = data["to"] if data["from"] == self.username else data["from"]
+                channel = self.channels.get(f"@{peer}") or self._open_direct(peer, switch=False)
+                self._clear_typing(channel, data["from"])
+                timestamp = datetime.datetime.fromtimestamp(data["ts"]).strftime("%H:%M")
+                self._add_chat_message(data["from"], data["text"], timestamp, channel, data.get("attachment"))
+                return
+            
+            # События комнаты, закрытой до их прихода, не отображаются
+            channel = self.channels.get(data.get("room", self.DEFAULT_ROOM))
+            if channel is None:
+                return
             if data["type"] == "message":
-                timestamp = datetime.datetime.now().strftime("%H:%M")
-                is_current_user = data["username"] == self.username
-                self.message_list.controls.append(
-                    self._create_message_bubble(data["username"], data["text"], is_current_user, timestamp)
-                )
+                self._track_message_id(channel, data.get("id"))
+                self._cache_messages(channel, [data])
+                server_time = data.get("ts")
+                moment = datetime.datetime.fromtimestamp(server_time) if server_time else datetime.datetime.now()
+                timestamp = moment.strftime("%H:%M")
+                self._add_chat_message(data["username"], data["text"], timestamp, channel, data.get("attachment"))
+                # Автор прочитал своё сообщение и больше не печатает
+                if data.get("id") is not None:
+                    channel.reads[data["username"]] = data["id"]
+                self._clear_typing(channel, data["username"])
             elif data["type"] == "join":
-                self.message_list.controls.append(
-                    self._create_system_message(f"{data['username']} присоединился к чату")
-                )
+                self._add_system_message(f"{data['username']} присоединился к чату", channel=channel)
             elif data["type"] == "leave":
-                self.message_list.controls.append(
-                    self._create_system_message(f"{data['username']} покинул чат")
-                )
-            elif data["type"] == "error":
-                self.message_list.controls.append(
-                    self._create_system_message(data["text"], is_error=True)
+                self._add_system_message(f"{data['username']} покинул чат", channel=channel)
+        except Exception as e:
+            self.logger.error("Ошибка обработки сообщения: %s", e)
+    
+    def _handle_ephemeral(self, data):
+        """Обработка эфемерного события: набор текста или сводка прочтения комнаты"""
+        try:
+            if data["type"] == "typing":
+                username = data["username"]
+                channel = self.channels.get(data["room"] if "room" in data else f"@{username}")
+                if channel is None or username == self.username:
+                    return
+                channel.typing[username] = time.monotonic() + self.TYPING_TIMEOUT
+            elif data["type"] == "read":
+                channel = self.channels.get(data["room"])
+                if channel is None:
+                    return
+                for username, message_id in data["reads"].items():
+                    if message_id > channel.reads.get(username, 0):
+                        channel.reads[username] = message_id
+            else:
+                return
+            if channel is self.active:
+                self._refresh_activity()
+        except Exception as e:
+            self.logger.error("Ошибка обработки эфемерного события: %s", e)
+    
+    def _clear_typing(self, channel, username):
+        """Снятие отметки набора текста (пользователь отправил сообщение)"""
+        if channel.typing.pop(username, None) is not None and channel is self.active:
+            self._refresh_activity()
+    
+    def _activity_text(self, channel):
+        """Строка активности комнаты: кто печатает, иначе кто прочитал последнее сообщение"""
+        if channel is None:
+            return ""
+        now = time.monotonic()
+        typing = [username for username, expires in list(channel.typing.items()) if expires > now]
+        if typing:
+            names = ", ".join(typing[:3]) + (f" и ещё {len(typing) - 3}" if len(typing) > 3 else "")
+            return f"{names} {'печатает' if len(typing) == 1 else 'печатают'}..."
+        newest = channel.newest_message_id
+        if newest is None:
+            return ""
+        readers = [
+            username for username, message_id in list(channel.reads.items())
+            if message_id >= newest and username != self.username
+        ]
+        if not readers:
+            return ""
+        return "Прочитали: " + ", ".join(readers[:3]) + (f" и ещё {len(readers) - 3}" if len(readers) > 3 else "")
+    
+    def _refresh_activity(self):
+        """Обновление строки активности в заголовке: изменяется только её элемент, без обновления страницы"""
+        text = self._activity_text(self.active)
+        if text == self.activity_text or self.activity_label is None:
+            return
+        self.activity_text = text
+        self.renderer.submit(functools.partial(setattr, self.activity_label, "value", text), self.activity_label)
+    
+    def _ephemeral_loop(self):
+        """Фоновый поток: отметка прочтения текущей комнаты и снятие устаревших отметок набора текста"""
+        while True:
+            time.sleep(self.EPHEMERAL_TICK)
+            try:
+                now = time.monotonic()
+                for channel in list(self.channels.values()):
+                    for username, expires in list(channel.typing.items()):
+                        if expires <= now:
+                            channel.typing.pop(username, None)
+                self._send_read(now)
+                self._refresh_activity()
+                self._save_members(now)
+            except Exception as e:
+                self.logger.error("Ошибка обработки эфемерных событий: %s", e)
+    
+    def _send_read(self, now):
+        """Отметка прочтения текущей комнаты, если пользователь видит конец ленты"""
+        channel = self.active
+        if (
+            channel is None or channel.peer is not None or not self.joined.is_set()
+            or not channel.message_list.auto_scroll or now - self.read_sent < self.READ_SEND_INTERVAL
+        ):
+            return
+        newest = channel.newest_message_id
+        if newest is None or (channel.read_sent_id is not None and newest <= channel.read_sent_id):
+            return
+        self.sio.emit("read", {"room": channel.room, "id": newest})
+        channel.read_sent_id = newest
+        self.read_sent = now
+    
+    def _send_typing(self, e=None):
+        """Отправка события "печатает" при вводе текста: не чаще TYPING_SEND_INTERVAL и только в сети"""
+        now = time.monotonic()
+        channel = self.active
+        if (
+            channel is None or not self.message_input.value or not self.joined.is_set()
+            or now - self.typing_sent < self.TYPING_SEND_INTERVAL
+        ):
+            return
+        self.typing_sent = now
+        try:
+            self.sio.emit("typing", {"to": channel.peer} if channel.peer else {"room": channel.room})
+        except Exception as e:
+            self.logger.warning("Не удалось отправить событие набора текста: %s", e)
+    
+    def _handle_message_batch(self, data):
+        """Обработка пачки рассылок: все события отображаются одной отправкой в Flet"""
+        with self.renderer.hold():
+            for event in data["events"]:
+                self._handle_message(event)
+    
+    def _handle_resume(self, data):
+        """Обработка досылки событий, пропущенных за время отключения"""
+        try:
+            if data["stream"] != self.stream_id:
+                # Сервер перезапускался: прежние номера недействительны
+                self.stream_id = data["stream"]
+                self.last_seq = None
+            if self.last_seq is None:
+                # Новый вход: прошлое придёт в истории, номера считаем с текущего
+                self.last_seq = data["seq"]
+            elif not data["complete"]:
+                self._add_system_message("Часть сообщений за время отключения могла быть пропущена", is_error=True)
+            with self.renderer.hold():
+                for event in data["events"]:
+                    self._handle_message(event)
+            # Сервер принял join: можно отправлять накопленные сообщения
+            self.joined.set()
+            self.connection_wakeup.set()
+        except Exception as e:
+            self.logger.error("Ошибка досылки сообщений: %s", e)
+    
+    def _join_payload(self):
+        """Данные события join: открытые комнаты, номер последнего полученного события
+        и id последнего известного сообщения каждой комнаты (since)"""
+        rooms = [channel for channel in self.channels.values() if channel.peer is None]
+        return {
+            "username": self.username,
+            "rooms": [channel.room for channel in rooms],
+            "last_seq": self.last_seq,
+            "stream": self.stream_id,
+            "since": {
+                channel.room: channel.newest_message_id for channel in rooms if channel.newest_message_id is not None
+            }
+        }
+    
+    def _handle_history(self, data):
+        """Обработка страницы истории: более старые сообщения - в начало, новее кэша (after_id) - в конец"""
+        try:
+            channel = self.channels.get(data.get("room", self.DEFAULT_ROOM))
+            if channel is None:
+                return
+            messages = data["messages"]
+            if data.get("reset"):
+                # Кэш слишком устарел: лента комнаты начинается заново с последних сообщений
+                channel.oldest_message_id = channel.newest_message_id = None
+                self.renderer.submit(functools.partial(self._clear_channel, channel), channel.message_list)
+                if self.cache and channel.peer is None:
+                    self.cache.clear_messages(channel.room)
+            if data.get("after_id") is not None:
+                self._append_newer_messages(channel, messages)
+                return
+            # Отбрасываем сообщения, которые уже есть в списке
+            if channel.oldest_message_id is not None:
+                messages = [message for message in messages if message["id"] < channel.oldest_message_id]
+            records = [self._message_record(message) for message in messages]
+            if messages:
+                channel.oldest_message_id = messages[0]["id"]
+                if channel.newest_message_id is None:
+                    channel.newest_message_id = messages[-1]["id"]
+                self._cache_messages(channel, messages)
+            channel.history_exhausted = not data.get("has_more")
+            channel.history_requested = False
+            if records:
+                # Последние сообщения при входе не сбивают прокрутку к концу списка
+                scroll_back = data.get("before_id") is not None
+                self.renderer.submit(
+                    functools.partial(self._prepend_records, channel, records, scroll_back), channel.message_list
                 )
-            self.page.update()
         except Exception as e:
-            self.logger.error(f"Ошибка обработки сообщения: {e}")
+            self.logger.error("Ошибка загрузки истории: %s", e)
+    
+    def _append_newer_messages(self, channel, messages):
+        """Добавление в конец ленты сообщений новее последнего известного (сверка кэша с сервером)"""
+        if channel.newest_message_id is not None:
+            messages = [message for message in messages if message["id"] > channel.newest_message_id]
+        for message in messages:
+            self._track_message_id(channel, message["id"])
+        self._cache_messages(channel, messages)
+        with self.renderer.hold():
+            for message in messages:
+                self._append_record(self._message_record(message), channel)
+    
+    def _message_record(self, message):
+        """Запись для списка сообщений по сообщению истории или кэша"""
+        return (
+            "message",
+            message["username"],
+            message["text"],
+            datetime.datetime.fromtimestamp(message["ts"]).strftime("%H:%M"),
+            message.get("attachment")
+        )
+    
+    def _clear_channel(self, channel):
+        """Удаление всех записей и элементов ленты комнаты"""
+        channel.message_window = MessageWindow(
+            self.MAX_STORED_MESSAGES, self.MAX_VISIBLE_MESSAGES, self.MESSAGE_PAGE_SIZE
+        )
+        channel.message_list.controls.clear()
+    
+    def _track_message_id(self, channel, message_id):
+        """Запоминание самого старого и самого нового известных id сообщений комнаты"""
+        if message_id is None:
+            return
+        if channel.oldest_message_id is None or message_id < channel.oldest_message_id:
+            channel.oldest_message_id = message_id
+        if channel.newest_message_id is None or message_id > channel.newest_message_id:
+            channel.newest_message_id = message_id
+    
+    def _open_cache(self):
+        """Открытие локального кэша; без него клиент работает как прежде"""
+        try:
+            self.cache = LocalCache(self.CACHE_PATH, self.SERVER_URL)
+        except Exception as e:
+            self.logger.error("Локальный кэш недоступен: %s", e)
+            self.cache = None
+    
+    def _restore_from_cache(self):
+        """Отображение сохранённых комнат, сообщений и участников до подключения к серверу"""
+        if self.cache is None:
+            return
+        try:
+            username, rooms = self.cache.load_state()
+            if username:
+                # Имя нужно до отрисовки: по нему выбирается вид собственных сообщений
+                self.username = username
+                self.username_input.value = username
+            for room in rooms:
+                channel = self.channels.get(room)
+                if channel is None:
+                    channel = self._create_channel(room)
+                    self.channel_tabs.controls.append(self._create_channel_tab(room))
+                messages = self.cache.load_messages(room, self.CACHED_MESSAGES_ON_START)
+                for message in messages:
+                    self._track_message_id(channel, message["id"])
+                self._prepend_records(channel, [self._message_record(message) for message in messages], False)
+                self._update_users_list(channel, self.cache.load_members(room))
+        except Exception as e:
+            self.logger.error("Ошибка чтения локального кэша: %s", e)
+    
+    def _cache_messages(self, channel, messages):
+        """Сохранение сообщений комнаты в локальный кэш (личные диалоги не кэшируются)"""
+        if self.cache is not None and channel.peer is None:
+            self.cache.add_messages(channel.room, [message for message in messages if message.get("id") is not None])
+    
+    def _cache_members(self, channel, snapshot=False):
+        """Сохранение списка участников комнаты в локальный кэш.
+        
+        Полный список сохраняется сразу, а после входа или выхода одного
+        участника комната только помечается: копирование списка - O(N), поэтому
+        изменения сохраняет фоновый поток не чаще MEMBERS_SAVE_INTERVAL (_save_members).
+        """
+        if self.cache is None or channel.peer is not None:
+            return
+        if snapshot:
+            channel.members_dirty = False
+            self.cache.save_members(channel.room, channel.user_items)
+        else:
+            channel.members_dirty = True
+    
+    def _save_members(self, now):
+        """Сохранение участников комнат, изменившихся после прошлого сохранения"""
+        if self.cache is None or now - self.members_saved < self.MEMBERS_SAVE_INTERVAL:
+            return
+        self.members_saved = now
+        for channel in list(self.channels.values()):
+            if channel.members_dirty:
+                channel.members_dirty = False
+                self.cache.save_members(channel.room, channel.user_items)
+    
+    def _save_cache_state(self):
+        """Сохранение имени пользователя и открытых комнат в локальный кэш"""
+        if self.cache is not None:
+            self.cache.save_state(
+                self.username, [room for room, channel in self.channels.items() if channel.peer is None]
+            )
     
     def _handle_user_list(self, data):
-        """Обработка обновления списка пользователей"""
+        """Обработка обновления списка участников комнаты (снимок или изменение)"""
         try:
-            self._update_users_list(data["users"])
+            channel = self.channels.get(data.get("room", self.DEFAULT_ROOM))
+            if channel is None:
+                return
+            update_type = data.get("type", "snapshot")
+            if update_type == "snapshot":
+                channel.presence_version = data.get("version")
+                self.renderer.submit(
+                    functools.partial(self._update_users_list, channel, data["users"]), channel.users_list
+                )
+            else:
+                version = data["version"]
+                # Снимок ещё не получен или изменение уже учтено в нём
+                if channel.presence_version is None or version <= channel.presence_version:
+                    return
+                # Пропущено изменение - запрашиваем полный список
+                if version != channel.presence_version + 1:
+                    self.sio.emit("sync_users", {"room": channel.room})
+                    return
+                channel.presence_version = version
+                if update_type == "presence_add":
+                    self.renderer.submit(
+                        functools.partial(self._add_user_item, channel, data["username"]), channel.users_list
+                    )
+                elif update_type == "presence_remove":
+                    self.renderer.submit(
+                        functools.partial(self._remove_user_item, channel, data["username"]), channel.users_list
+                    )
         except Exception as e:
-            self.logger.error(f"Ошибка обновления списка пользователей: {e}")
+            self.logger.error("Ошибка обновления списка пользователей: %s", e)
     
     def _handle_disconnect(self):
         """Обработка разрыва соединения с сервером"""
         try:
-            self.message_list.controls.append(
-                self._create_system_message("Соединение с сервером разорвано", is_error=True)
-            )
-            self.page.update()
+            self.joined.clear()
+            # Неподтверждённые события уйдут повторно после переподключения
+            with self.outbox_lock:
+                self.outbox_in_flight.clear()
+            self._add_system_message("Соединение с сервером разорвано", is_error=True)
             self._retry_connection()
         except Exception as e:
-            self.logger.error(f"Ошибка при обработке отключения: {e}")
+            self.logger.error("Ошибка при обработке отключения: %s", e)
     
-    def _create_message_bubble(self, username, text, is_current_user, timestamp):
-        """Создание пузыря сообщения"""
-        if is_current_user:
-            return ft.Container(
-                content=ft.Column([
-                    ft.Container(
-                        content=ft.Column([
-                            ft.Text(text, color=self.COLORS["text"], selectable=True),
-                            ft.Container(height=4),
-                            ft.Text(timestamp, color=self.COLORS["timestamp_user"], size=12, text_align=ft.TextAlign.RIGHT)
-                        ]),
-                        bgcolor=self.COLORS["user_msg"],
-                        padding=12,
-                        border_radius=ft.border_radius.only(top_left=12, top_right=12, bottom_left=12, bottom_right=3),
-                        width=300
-                    )
-                ]),
-                margin=ft.margin.only(left=50, right=10, top=5, bottom=5),
-                alignment=ft.alignment.center_right
+    def _add_chat_message(self, username, text, timestamp, channel=None, attachment=None):
+        """Добавление сообщения пользователя в список комнаты (по умолчанию - текущей)"""
+        self._append_record(("message", username, text, timestamp, attachment), channel)
+    
+    def _add_system_message(self, text, is_error=False, channel=None):
+        """Добавление системного сообщения в список комнаты (по умолчанию - текущей)"""
+        self._append_record(("system", text, is_error), channel)
+    
+    def _append_record(self, record, channel=None):
+        """Постановка записи в очередь на отрисовку"""
+        channel = channel or self.active
+        if channel is None:
+            return
+        self.renderer.submit(functools.partial(self._apply_record, channel, record), channel.message_list)
+    
+    def _apply_record(self, channel, record):
+        """Сохранение записи и добавление её элемента с вытеснением старых.
+        
+        Пока пользователь находится в конце списка (auto_scroll), окно
+        удерживается в пределах MAX_VISIBLE_MESSAGES.
+        """
+        window = channel.message_window
+        stale = window.append(record, trim=channel.message_list.auto_scroll)
+        if stale:
+            del channel.message_list.controls[:stale]
+        previous = window.records[-2] if window.visible > 1 else None
+        channel.message_list.controls.append(self._build_message_control(record, previous))
+    
+    def _build_message_control(self, record, previous=None):
+        """Создание элемента списка по записи сообщения.
+        
+        previous - запись предыдущего элемента списка: сообщения автора подряд
+        объединяются в группу, и имя показывается только над первым из них.
+        """
+        if record[0] == "message":
+            _, username, text, timestamp, attachment = record
+            return self._create_message_bubble(
+                username, text, username == self.username, timestamp, attachment, self._same_author(previous, record)
             )
-        else:
-            return ft.Container(
-                content=ft.Column([
-                    ft.Container(
-                        content=ft.Column([
-                            ft.Text(username, style=ft.TextStyle(weight=ft.FontWeight.BOLD, color=self.COLORS["accent"])),
-                            ft.Container(height=4),
-                            ft.Text(text, color=self.COLORS["text"], selectable=True),
-                            ft.Container(height=4),
-                            ft.Text(timestamp, color=self.COLORS["timestamp_other"], size=12, text_align=ft.TextAlign.RIGHT)
-                        ]),
-                        bgcolor=self.COLORS["other_msg"],
-                        padding=12,
-                        border_radius=ft.border_radius.only(top_left=12, top_right=12, bottom_left=3, bottom_right=12),
-                        width=300
-                    )
-                ]),
-                margin=ft.margin.only(left=10, right=50, top=5, bottom=5),
-                alignment=ft.alignment.center_left
+        _, text, is_error = record
+        return self._create_system_message(text, is_error)
+    
+    @staticmethod
+    def _same_author(previous, record):
+        """Продолжает ли запись record группу сообщений того же автора"""
+        return (
+            previous is not None and previous[0] == "message" and record[0] == "message"
+            and previous[1] == record[1]
+        )
+    
+    def _handle_scroll(self, channel, e):
+        """Подгрузка старых сообщений вверху списка и сокращение окна внизу"""
+        if e.pixels <= e.min_scroll_extent + self.SCROLL_LOAD_THRESHOLD:
+            self.renderer.submit(functools.partial(self._load_older_messages, channel), channel.message_list)
+        elif e.pixels >= e.max_scroll_extent - self.SCROLL_LOAD_THRESHOLD:
+            self.renderer.submit(functools.partial(self._trim_message_list, channel), channel.message_list)
+    
+    def _trim_message_list(self, channel):
+        """Возврат к прокрутке к концу и сокращение окна до MAX_VISIBLE_MESSAGES"""
+        channel.message_list.auto_scroll = True
+        stale = channel.message_window.trim()
+        if stale:
+            del channel.message_list.controls[:stale]
+    
+    def _load_older_messages(self, channel):
+        """Добавление страницы более старых сообщений в начало списка.
+        
+        Сначала используются записи в памяти, затем история запрашивается у сервера.
+        """
+        page = channel.message_window.older_page()
+        if not page:
+            self._request_history(channel)
+            return
+        self._insert_older_controls(channel, page)
+    
+    def _prepend_records(self, channel, records, scroll_back=True):
+        """Добавление полученных с сервера записей в начало хранилища и списка"""
+        page = channel.message_window.prepend(records)
+        if page:
+            self._insert_older_controls(channel, page, scroll_back)
+    
+    def _insert_older_controls(self, channel, page, scroll_back=True):
+        """Создание элементов для более старых записей в начале списка"""
+        if scroll_back:
+            # Не прокручиваем к концу, пока пользователь читает историю
+            channel.message_list.auto_scroll = False
+        controls = []
+        previous = None  # запись перед страницей не отображается
+        for record in page:
+            controls.append(self._build_message_control(record, previous))
+            previous = record
+        message_list = channel.message_list
+        message_list.controls[0:0] = controls
+        # Бывший первый элемент мог оказаться продолжением группы последнего сообщения страницы
+        window = channel.message_window
+        following = len(window.records) - window.visible + len(page)
+        if len(message_list.controls) > len(page) and following < len(window.records):
+            record = window.records[following]
+            if self._same_author(page[-1], record):
+                message_list.controls[len(page)] = self._build_message_control(record, page[-1])
+    
+    def _request_history(self, channel):
+        """Запрос у сервера страницы истории комнаты старше самого старого известного сообщения"""
+        if channel.history_exhausted or channel.history_requested or not self.sio.connected:
+            return
+        channel.history_requested = True
+        self.sio.emit("load_history", {
+            "room": channel.room, "before_id": channel.oldest_message_id, "limit": self.MESSAGE_PAGE_SIZE
+        })
+    
+    def _build_bubble_styles(self):
+        """Общие объекты стилей пузырей по ключу (своё сообщение, продолжение группы).
+        
+        Отступы, скругления и стили текста не создаются заново для каждого
+        сообщения: все пузыри ссылаются на одни и те же объекты.
+        """
+        styles = {}
+        for is_current_user in (True, False):
+            for grouped in (True, False):
+                top = self.GROUP_SPACING if grouped else self.BUBBLE_SPACING
+                # Уголок "хвоста" - у края автора; в продолжении группы скруглён и верхний угол с той же стороны
+                near = 3 if grouped else 12
+                if is_current_user:
+                    margin = ft.margin.only(left=self.BUBBLE_INDENT, right=10, top=top)
+                    radius = ft.border_radius.only(top_left=12, top_right=near, bottom_left=12, bottom_right=3)
+                else:
+                    margin = ft.margin.only(left=10, right=self.BUBBLE_INDENT, top=top)
+                    radius = ft.border_radius.only(top_left=near, top_right=12, bottom_left=3, bottom_right=12)
+                styles[is_current_user, grouped] = {
+                    "outer": {
+                        "margin": margin,
+                        "alignment": ft.alignment.center_right if is_current_user else ft.alignment.center_left,
+                    },
+                    "bubble": {
+                        "bgcolor": self.COLORS["user_msg" if is_current_user else "other_msg"],
+                        "padding": 12,
+                        "border_radius": radius,
+                        "width": self.BUBBLE_WIDTH,
+                    },
+                    "timestamp": ft.TextStyle(
+                        size=12, color=self.COLORS["timestamp_user" if is_current_user else "timestamp_other"]
+                    ),
+                }
+        styles["author"] = ft.TextStyle(weight=ft.FontWeight.BOLD, color=self.COLORS["accent"])
+        styles["system_margin"] = ft.margin.symmetric(vertical=5)
+        return styles
+    
+    def _create_message_bubble(self, username, text, is_current_user, timestamp, attachment=None, grouped=False):
+        """Создание пузыря сообщения: два контейнера (выравнивание и фон) и колонка строк.
+        
+        Над сообщением другого пользователя - имя автора, если это не
+        продолжение группы (grouped); вложение - превью изображения или
+        карточка файла над текстом.
+        """
+        style = self.bubble_styles[is_current_user, grouped]
+        lines = []
+        if not is_current_user and not grouped:
+            lines.append(ft.Text(username, style=self.bubble_styles["author"]))
+        if attachment:
+            lines.append(self._create_attachment_view(attachment))
+        if text:
+            lines.append(ft.Text(text, color=self.COLORS["text"], selectable=True))
+        lines.append(ft.Text(timestamp, style=style["timestamp"], text_align=ft.TextAlign.RIGHT))
+        return ft.Container(
+            content=ft.Container(content=ft.Column(lines, spacing=4, tight=True), **style["bubble"]),
+            **style["outer"]
+        )
+    
+    def _create_attachment_view(self, attachment):
+        """Превью изображения (из локальной копии, загружаемой в фоне) или карточка файла"""
+        if attachment.get("mime", "").startswith("image/"):
+            preview = ft.Container(
+                width=self.BUBBLE_WIDTH - 24,  # ширина пузыря без внутренних отступов
+                height=self.THUMBNAIL_SIZE // 2,
+                border_radius=8,
+                bgcolor=self.COLORS["input_bg"],
+                alignment=ft.alignment.center,
+                on_click=lambda e: self.page.launch_url(self.attachments.url(attachment))
+            )
+            path = self.attachments.get(
+                attachment,
+                lambda path: self.renderer.submit(functools.partial(self._show_preview, preview, path), preview)
             )
+            if path:
+                self._show_preview(preview, path)
+            else:
+                preview.content = ft.ProgressRing(width=20, height=20, stroke_width=2)
+            return preview
+        return ft.Container(
+            content=ft.Row([
+                ft.Icon(ft.Icons.INSERT_DRIVE_FILE, color=self.COLORS["accent"]),
+                ft.Column([
+                    ft.Text(attachment["name"], color=self.COLORS["text"], max_lines=1, overflow=ft.TextOverflow.ELLIPSIS),
+                    ft.Text(self._format_size(attachment["size"]), color=self.COLORS["hint"], size=12)
+                ], spacing=0, tight=True, expand=True)
+            ], spacing=8),
+            padding=8,
+            border_radius=8,
+            bgcolor=self.COLORS["input_bg"],
+            tooltip="Открыть файл",
+            on_click=lambda e: self.page.launch_url(self.attachments.url(attachment))
+        )
+    
+    def _show_preview(self, preview, path):
+        """Замена заглушки превью изображением (вызывается планировщиком)"""
+        if path is None:
+            preview.content = ft.Text("Не удалось загрузить изображение", color=self.COLORS["hint"], italic=True, size=12)
+        else:
+            preview.content = ft.Image(src=path, fit=ft.ImageFit.CONTAIN, border_radius=8)
+    
+    @staticmethod
+    def _format_size(size):
+        """Размер файла для отображения: байты, КБ или МБ"""
+        if size < 1024:
+            return f"{size} Б"
+        if size < 1024 * 1024:
+            return f"{size / 1024:.1f} КБ"
+        return f"{size / (1024 * 1024):.1f} МБ"
     
     def _create_system_message(self, text, is_error=False):
         """Создание системного сообщения"""
@@ -168,77 +1143,445 @@ class TelegramChatApp:
                 color=self.COLORS["error"] if is_error else self.COLORS["system"], 
                 text_align=ft.TextAlign.CENTER
             ),
-            margin=ft.margin.symmetric(vertical=5),
+            margin=self.bubble_styles["system_margin"],
             alignment=ft.alignment.center
         )
     
-    def _update_users_list(self, users_data):
-        """Обновление списка пользователей"""
-        self.users_list.controls.clear()
-        for user in users_data:
-            container = ft.Container(
-                content=ft.Row(
-                    [
-                        ft.CircleAvatar(
-                            content=ft.Text(user[0].upper(), weight=ft.FontWeight.BOLD),
-                            bgcolor=self.COLORS["accent"],
-                            color=self.COLORS["text"],
-                            radius=16
-                        ),
-                        ft.Container(width=10),
-                        ft.Text(user, color=self.COLORS["text"])
-                    ],
-                    vertical_alignment=ft.CrossAxisAlignment.CENTER
-                ),
-                padding=5,
-                border_radius=5,
-                bgcolor=self.COLORS["accent"] if user == self.username else self.COLORS["input_bg"]
+    def _create_user_item(self, user):
+        """Создание элемента списка пользователей (нажатие открывает личный диалог)"""
+        item = ft.Container(
+            content=ft.Row(
+                [
+                    ft.CircleAvatar(
+                        content=ft.Text(user[0].upper(), weight=ft.FontWeight.BOLD),
+                        bgcolor=self.COLORS["accent"],
+                        color=self.COLORS["text"],
+                        radius=16
+                    ),
+                    ft.Container(width=10),
+                    ft.Text(user, color=self.COLORS["text"])
+                ],
+                vertical_alignment=ft.CrossAxisAlignment.CENTER
+            ),
+            padding=5,
+            border_radius=5,
+            bgcolor=self._user_item_color(user)
+        )
+        if user != self.username:
+            item.on_click = lambda e: self._open_direct(user)
+        return item
+    
+    def _user_item_color(self, user):
+        """Цвет фона элемента: текущий пользователь выделяется акцентным цветом"""
+        return self.COLORS["accent"] if user == self.username else self.COLORS["input_bg"]
+    
+    def _add_user_item(self, channel, user):
+        """Добавление пользователя в боковую панель комнаты"""
+        if user in channel.user_items:
+            return
+        item = self._create_user_item(user)
+        channel.user_items[user] = item
+        channel.users_list.controls.append(item)
+        self._cache_members(channel)
+    
+    def _remove_user_item(self, channel, user):
+        """Удаление пользователя из боковой панели комнаты"""
+        item = channel.user_items.pop(user, None)
+        if item is None:
+            return
+        channel.users_list.controls.remove(item)
+        self._cache_members(channel)
+    
+    def _update_users_list(self, channel, users_data):
+        """Сверка боковой панели комнаты с полным списком участников.
+        
+        Существующие элементы переиспользуются: создаются только новые,
+        удаляются только ушедшие, у остальных при необходимости меняется выделение.
+        """
+        users = dict.fromkeys(users_data)
+        for user in [user for user in channel.user_items if user not in users]:
+            channel.users_list.controls.remove(channel.user_items.pop(user))
+        for user in users:
+            item = channel.user_items.get(user)
+            if item is None:
+                item = self._create_user_item(user)
+                channel.user_items[user] = item
+                channel.users_list.controls.append(item)
+            else:
+                item.bgcolor = self._user_item_color(user)
+        self._cache_members(channel, snapshot=True)
+    
+    def _create_channel(self, room, peer=None):
+        """Создание состояния и списков комнаты или диалога (без подписки на сервере)"""
+        message_list = ft.ListView(expand=True, spacing=10, auto_scroll=True, on_scroll_interval=100)
+        users_list = ft.ListView(width=200, spacing=5)
+        channel = Channel(room, message_list, users_list, MessageWindow(
+            self.MAX_STORED_MESSAGES, self.MAX_VISIBLE_MESSAGES, self.MESSAGE_PAGE_SIZE
+        ), peer)
+        message_list.on_scroll = functools.partial(self._handle_scroll, channel)
+        if peer is not None:
+            # Личные сообщения сервер не хранит: истории у диалога нет
+            channel.history_exhausted = True
+            self.renderer.submit(
+                functools.partial(self._update_users_list, channel, [self.username, peer]), users_list
             )
-            self.users_list.controls.append(container)
-        self.page.update()
+        self.channels[room] = channel
+        return channel
     
-    def _connect_to_server(self):
-        """Подключение к серверу"""
-        self.page.overlay.append(self.loading_indicator)
-        self.page.update()
+    def _open_direct(self, user, switch=True):
+        """Открытие личного диалога с пользователем (из боковой панели или при входящем сообщении)"""
+        key = f"@{user}"
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self._create_channel(key, peer=user)
+            tab = self._create_channel_tab(key)
+            self.renderer.submit(functools.partial(self.channel_tabs.controls.append, tab), self.channel_tabs)
+        if switch:
+            self._switch_channel(key)
+        return channel
+    
+    def _open_channel(self, room):
+        """Открытие комнаты из переключателя: подписка на сервере и переход в неё"""
+        room = room.strip().casefold()
+        if not self.ROOM_PATTERN.fullmatch(room):
+            self.room_input.error_text = "Буквы, цифры, _ и -"
+            self.page.update()
+            return
+        self.room_input.value = ""
+        self.room_input.error_text = None
+        if room not in self.channels:
+            self._create_channel(room)
+            tab = self._create_channel_tab(room)
+            self.renderer.submit(functools.partial(self.channel_tabs.controls.append, tab), self.channel_tabs)
+            if self.sio.connected and self.username:
+                # Сервер ответит историей и списком участников комнаты
+                self.sio.emit("join_room", {"room": room})
+            self._save_cache_state()
+        self._switch_channel(room)
+    
+    def _close_channel(self, room):
+        """Закрытие комнаты (с отпиской на сервере) или диалога; последнюю комнату закрыть нельзя"""
+        channel = self.channels.get(room)
+        if channel is None:
+            return
+        if channel.peer is None and sum(other.peer is None for other in self.channels.values()) == 1:
+            return
+        del self.channels[room]
+        if channel.peer is None and self.sio.connected:
+            self.sio.emit("leave_room", {"room": room})
+        self.renderer.submit(functools.partial(self._remove_channel_tab, room), self.channel_tabs)
+        if channel.peer is None:
+            self._save_cache_state()
+        if self.active.room == room:
+            self._switch_channel(next(iter(self.channels)))
+    
+    def _remove_channel_tab(self, room):
+        """Удаление вкладки комнаты из переключателя"""
+        self.channel_tabs.controls = [tab for tab in self.channel_tabs.controls if tab.data != room]
+    
+    def _search_history(self, text):
+        """Поиск по истории текущей комнаты; "from:имя" в запросе ограничивает автора"""
+        words = (text or "").split()
+        authors = [word[len(self.SEARCH_AUTHOR_PREFIX):] for word in words if word.startswith(self.SEARCH_AUTHOR_PREFIX)]
+        query = " ".join(word for word in words if not word.startswith(self.SEARCH_AUTHOR_PREFIX))
+        username = authors[-1] if authors and authors[-1] else None
+        if not query and username is None:
+            return
+        if self.active.peer is not None:
+            self._add_system_message("Личные сообщения не сохраняются на сервере, поиск доступен в комнатах", True)
+            return
+        if not self.sio.connected:
+            self._add_system_message("Поиск недоступен без соединения с сервером", True)
+            return
+        self.search = {"room": self.active.room, "query": query, "username": username}
+        self.search_before_id = None
+        title = f"Поиск в #{self.active.room}: {text.strip()}"
+        self.renderer.submit(functools.partial(self._show_search_panel, title), self.search_panel)
+        self._request_search_page()
+    
+    def _request_search_page(self):
+        """Запрос у сервера следующей страницы результатов текущего поиска"""
+        if self.search is None or not self.sio.connected:
+            return
+        self.sio.emit("search", {**self.search, "before_id": self.search_before_id, "limit": self.SEARCH_PAGE_SIZE})
+    
+    def _handle_search_results(self, data):
+        """Обработка страницы результатов поиска: добавление в панель результатов"""
         try:
-            self.sio.connect(self.SERVER_URL)
-        except Exception as e:
-            self.message_list.controls.append(
-                self._create_system_message(f"Ошибка подключения: {e}", is_error=True)
+            search = self.search
+            if search is None or data.get("room") != search["room"] or data.get("query") != search["query"]:
+                return  # ответ на прежний поиск
+            if data.get("before_id") != self.search_before_id:
+                return
+            messages = data["messages"]
+            if messages:
+                self.search_before_id = messages[-1]["id"]
+            self.renderer.submit(
+                functools.partial(self._add_search_results, messages, data.get("has_more", False)), self.search_panel
             )
+        except Exception as e:
+            self.logger.error("Ошибка обработки результатов поиска: %s", e)
+    
+    def _show_search_panel(self, title):
+        """Открытие пустой панели результатов (вызывается планировщиком)"""
+        self.search_title.value = title
+        self.search_results.controls.clear()
+        self.search_more_button.visible = False
+        self.search_panel.visible = True
+    
+    def _add_search_results(self, messages, has_more):
+        """Добавление результатов в панель (вызывается планировщиком)"""
+        for message in messages:
+            timestamp = datetime.datetime.fromtimestamp(message["ts"]).strftime("%d.%m.%Y %H:%M")
+            self.search_results.controls.append(ft.Container(
+                content=ft.Column([
+                    ft.Row([
+                        ft.Text(message["username"], color=self.COLORS["accent"], weight=ft.FontWeight.BOLD, size=13),
+                        ft.Text(timestamp, color=self.COLORS["timestamp_other"], size=12)
+                    ], spacing=10),
+                    ft.Text(
+                        f"📎 {message['attachment']['name']} {message['text']}".strip() if message.get("attachment")
+                        else message["text"],
+                        color=self.COLORS["text"], selectable=True
+                    )
+                ], spacing=2, tight=True),
+                padding=8,
+                border_radius=10,
+                bgcolor=self.COLORS["other_msg"]
+            ))
+        if not self.search_results.controls:
+            self.search_results.controls.append(ft.Text("Ничего не найдено", color=self.COLORS["hint"], italic=True))
+        self.search_more_button.visible = has_more
+    
+    def _close_search(self):
+        """Закрытие панели результатов поиска"""
+        self.search = None
+        self.search_before_id = None
+        self.renderer.submit(functools.partial(setattr, self.search_panel, "visible", False), self.search_panel)
+    
+    def _switch_channel(self, room):
+        """Переход в открытую комнату: подмена списков сообщений и участников"""
+        if self.search is not None and self.search["room"] != room:
+            self._close_search()
+        self.active = self.channels[room]
+        self.renderer.submit(functools.partial(self._show_channel, self.active))
+    
+    def _show_channel(self, channel):
+        """Отображение комнаты в окне чата (вызывается планировщиком)"""
+        self.message_container.content = channel.message_list
+        self.users_container.content = channel.users_list
+        self.users_title.value = f"Диалог с {channel.peer}" if channel.peer else f"Участники #{channel.room}"
+        self.activity_text = self.activity_label.value = self._activity_text(channel)
+        for tab in self.channel_tabs.controls:
+            tab.bgcolor = self._channel_tab_color(tab.data)
+    
+    def _channel_tab_color(self, room):
+        """Цвет вкладки комнаты: текущая выделяется акцентным цветом"""
+        return self.COLORS["accent"] if self.active is not None and room == self.active.room else self.COLORS["input_bg"]
+    
+    def _create_channel_tab(self, room):
+        """Создание вкладки комнаты в переключателе"""
+        close_button = ft.IconButton(
+            icon=ft.Icons.CLOSE,
+            icon_size=14,
+            icon_color=self.COLORS["text"],
+            tooltip="Закрыть комнату"
+        )
+        close_button.on_click = lambda e: self._close_channel(room)
+        tab = ft.Container(
+            content=ft.Row(
+                [ft.Text(room if room.startswith("@") else f"#{room}", color=self.COLORS["text"]), close_button],
+                spacing=0,
+                tight=True,
+                vertical_alignment=ft.CrossAxisAlignment.CENTER
+            ),
+            padding=ft.padding.only(left=10),
+            border_radius=15,
+            bgcolor=self._channel_tab_color(room),
+            data=room
+        )
+        tab.on_click = lambda e: self._switch_channel(room)
+        return tab
+    
+    def _flush_ui(self, controls):
+        """Отправка накопленных изменений в Flet (вызывается планировщиком)"""
+        if controls is None:
             self.page.update()
-            self._retry_connection()
-        finally:
-            self.page.overlay.remove(self.loading_indicator)
-            self.page.update()
+            return
+        # Элементы, ещё не добавленные на страницу, уйдут вместе со сменой экрана
+        mounted = [control for control in controls if control.page is not None]
+        if mounted:
+            self.page.update(*mounted)
+    
+    def _connect_to_server(self):
+        """Запуск фонового потока подключения"""
+        if self.connection_thread is None:
+            self.connection_thread = threading.Thread(
+                target=self._connection_loop, name="ConnectionWorker", daemon=True
+            )
+            self.connection_thread.start()
+        self._retry_connection()
+    
+    def _open_connection(self):
+        """Подключение с запросом компактного формата; до ответа сервера клиент пишет в JSON"""
+        self.packet_class.compact = False
+        self.sio.connect(wire.client_url(self.SERVER_URL))
     
     def _retry_connection(self):
-        """Повторные попытки подключения к серверу"""
-        self.message_list.controls.append(
-            self._create_system_message("Попытка переподключения...")
-        )
-        self.page.update()
+        """Пробуждение фонового потока подключения (не блокирует вызывающий поток)"""
+        self.connection_wakeup.set()
+    
+    def _connection_loop(self):
+        """Фоновый поток: переподключение с экспоненциальной паузой и отправка очереди исходящих"""
+        attempt = 0
+        while True:
+            self.connection_wakeup.wait()
+            self.connection_wakeup.clear()
+            if self.sio.connected:
+                if self.joined.is_set():
+                    try:
+                        self._flush_outbox()
+                    except Exception as e:
+                        # Очередь остаётся на месте и уйдёт при следующем пробуждении
+                        self.logger.error("Ошибка отправки очереди исходящих: %s", e)
+                continue
+            
+            self._set_connection_state("connecting")
+            try:
+                self._open_connection()
+            except Exception as e:
+                delay = random.uniform(0, min(self.RECONNECT_MAX_DELAY, self.RECONNECT_BASE_DELAY * 2 ** attempt))
+                attempt += 1
+                self.logger.warning(
+                    "Не удалось подключиться (%s), повтор через %.1f с", e, delay, extra={"category": "reconnect"}
+                )
+                self._set_connection_state("offline", delay)
+                time.sleep(delay)
+                self.connection_wakeup.set()
+                continue
+            
+            if attempt:
+                self._add_system_message("Подключение восстановлено!")
+            attempt = 0
+            self._set_connection_state("online")
+            if self.username:
+                # Очередь отправится после ответа на join (событие resume)
+                self.sio.emit("join", self._join_payload())
+    
+    def _flush_outbox(self):
+        """Отправка очереди исходящих по порядку, не дожидаясь подтверждения предыдущих событий.
         
-        for attempt in range(self.MAX_RECONNECT_ATTEMPTS):
+        Событие удаляется из очереди по подтверждению сервера (_outbox_acked);
+        при разрыве неподтверждённые остаются в очереди и уйдут повторно после
+        переподключения. Сервер обрабатывает события клиента по порядку, поэтому
+        одновременно отправленные сообщения рассылаются в порядке очереди.
+        """
+        with self.outbox_lock:
+            pending = [entry for entry in self.outbox if id(entry) not in self.outbox_in_flight]
+        for entry in pending:
+            # Накопленная очередь уходит не быстрее лимита сервера
+            while not self.outbox_budget.take():
+                time.sleep(1 / self.OUTBOX_RATE)
+            if not (self.sio.connected and self.joined.is_set()):
+                return
+            event, data = entry
             try:
-                if not self.sio.connected:
-                    self.sio.connect(self.SERVER_URL)
-                    self.message_list.controls.append(
-                        self._create_system_message("Подключение восстановлено!")
-                    )
-                    if self.username:
-                        self.sio.emit("join", {"username": self.username})
-                    self.page.update()
+                if event == "upload":
+                    # Сначала загружается файл (с места остановки), затем уходит сообщение со ссылкой
+                    event, data = self._upload_attachment(data)
+                with self.outbox_lock:
+                    self.outbox_in_flight[id(entry)] = entry
+                self.sio.emit(event, data, callback=functools.partial(self._outbox_acked, entry))
+            except (ValueError, OSError) as e:
+                # Файл не прочитать или сервер его отклонил: повтор не поможет
+                self._remove_outbox_entry(entry)
+                self._add_system_message(f"Не удалось отправить файл: {e}", is_error=True)
+                self._set_connection_state("online")
+            except Exception as e:
+                with self.outbox_lock:
+                    self.outbox_in_flight.pop(id(entry), None)
+                self.logger.warning("Не удалось отправить сообщение, останется в очереди: %s", e)
+                return
+    
+    def _outbox_acked(self, entry, *args):
+        """Подтверждение сервера: событие удаляется из очереди исходящих"""
+        with self.outbox_lock:
+            if self.outbox_in_flight.pop(id(entry), None) is None:
+                # Подтверждение прежнего соединения: событие уже ждёт повторной отправки
+                return
+        self._remove_outbox_entry(entry)
+        self._set_connection_state("online")
+    
+    def _enqueue(self, event, data):
+        """Добавление события в очередь исходящих (под блокировкой: её читают фоновый поток и подтверждения)"""
+        with self.outbox_lock:
+            self.outbox.append((event, data))
+    
+    def _remove_outbox_entry(self, entry):
+        """Удаление записи из очереди исходящих (по identity: одинаковые сообщения - разные записи)"""
+        with self.outbox_lock:
+            for index, queued in enumerate(self.outbox):
+                if queued is entry:
+                    del self.outbox[index]
                     return
-            except Exception:
-                pass
-            time.sleep(self.RECONNECT_DELAY)
+    
+    def _upload_attachment(self, upload):
+        """Загрузка файла вложения кусками. Возвращает событие сообщения со ссылкой на файл.
         
-        self.message_list.controls.append(
-            self._create_system_message("Не удалось подключиться к серверу", is_error=True)
+        Сервер отвечает смещением, с которого передавать данные: после разрыва
+        загрузка продолжается с него, а уже сохранённый файл не передаётся.
+        """
+        if "hash" not in upload:
+            # Хэш считается один раз, в фоновом потоке, а не при выборе файла
+            hasher = hashlib.sha256()
+            with open(upload["path"], "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    hasher.update(block)
+            upload["hash"] = hasher.hexdigest()
+        digest, size = upload["hash"], upload["size"]
+        offset = self._upload_call("upload_start", {"hash": digest, "size": size})
+        with open(upload["path"], "rb") as file:
+            while offset < size:
+                file.seek(offset)
+                chunk = file.read(self.ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    raise ValueError("файл изменился во время отправки")
+                offset = self._upload_call(
+                    "upload_chunk", {"hash": digest, "size": size, "offset": offset, "data": chunk}
+                )
+        attachment = {"hash": digest, "name": upload["name"], "size": size, "mime": upload["mime"]}
+        return upload["event"], dict(upload["data"], attachment=attachment)
+    
+    def _upload_call(self, event, data):
+        """Событие загрузки с ожиданием ответа сервера: смещение или ValueError с причиной отказа"""
+        reply = self.sio.call(event, data, timeout=self.OUTBOX_ACK_TIMEOUT)
+        if not isinstance(reply, dict):
+            raise ValueError("сервер не поддерживает вложения")
+        if reply.get("error"):
+            raise ValueError(reply["error"])
+        return reply["offset"]
+    
+    def _set_connection_state(self, state, delay=None):
+        """Обновление индикатора соединения: online, connecting или offline (с паузой до повтора)"""
+        self.connection_state, self.retry_delay = state, delay
+        with self.outbox_lock:
+            queued = len(self.outbox)
+        if state == "online":
+            text, color = "В сети", self.COLORS["online"]
+        elif state == "connecting":
+            text, color = "Подключение...", self.COLORS["hint"]
+        else:
+            text, color = f"Нет соединения, повтор через {delay:.0f} с", self.COLORS["error"]
+        if queued:
+            text += f" · в очереди: {queued}"
+        self.renderer.submit(
+            functools.partial(self._show_connection_state, text, color), self.connection_indicator
         )
-        self.page.update()
+    
+    def _show_connection_state(self, text, color):
+        """Отображение состояния соединения (вызывается планировщиком)"""
+        self.connection_indicator.controls[0].color = color
+        self.connection_label.value = text
     
     def _join_chat(self, e=None):
         """Функция входа в чат"""
@@ -258,45 +1601,70 @@ class TelegramChatApp:
         
         self.username = username
         self.username_error.visible = False
+        self._save_cache_state()
         
-        if not self.sio.connected:
+        # Без соединения join отправит фоновый поток сразу после подключения
+        if self.sio.connected:
+            self.sio.emit("join", self._join_payload())
+        else:
             self._retry_connection()
-            if not self.sio.connected:
-                self.message_list.controls.append(
-                    self._create_system_message("Невозможно подключиться к серверу", is_error=True)
-                )
-                self.page.update()
-                return
-                
-        self.sio.emit("join", {"username": username})
         self.page.views.clear()
         self.page.views.append(self.chat_view)
         self.page.update()
         self.page.go("/chat")
     
     def _send_message(self, e=None):
-        """Отправка сообщения"""
+        """Постановка сообщения в очередь исходящих (отправляет фоновый поток, в том числе после переподключения)"""
         text = self.message_input.value.strip()
         if not text:
             return
-            
-        if not self.sio.connected:
-            self.message_list.controls.append(
-                self._create_system_message("Нет подключения к серверу", is_error=True)
-            )
-            self.page.update()
-            self._retry_connection()
+        
+        if self.active.peer:
+            self._enqueue("send_direct", {"to": self.active.peer, "text": text})
+        else:
+            self._enqueue("send_message", {"text": text, "room": self.active.room})
+        self.message_input.value = ""
+        self.page.update()
+        if not self.joined.is_set():
+            # Показываем, что сообщение ждёт в очереди
+            self._set_connection_state(self.connection_state, self.retry_delay)
+        self._retry_connection()
+    
+    def _pick_attachment(self, e):
+        """Обработка выбора файла: отправка с текстом из поля ввода в качестве подписи"""
+        if not e.files:
             return
-            
+        caption = self.message_input.value.strip()
+        self.message_input.value = ""
+        for picked in e.files:
+            self._send_attachment(picked.path, caption)
+            caption = ""
+        self.page.update()
+    
+    def _send_attachment(self, path, caption=""):
+        """Постановка файла в очередь исходящих: загрузит и отправит сообщение фоновый поток"""
         try:
-            self.sio.emit("send_message", {"text": text})
-            self.message_input.value = ""
-            self.page.update()
-        except Exception as e:
-            self.message_list.controls.append(
-                self._create_system_message(f"Ошибка отправки: {e}", is_error=True)
+            size = os.path.getsize(path) if path else None
+        except OSError:
+            size = None
+        if not size or size > self.MAX_ATTACHMENT_SIZE:
+            self._add_system_message(
+                f"Можно отправить файл от 1 байта до {self.MAX_ATTACHMENT_SIZE // (1024 * 1024)} МБ", is_error=True
             )
-            self.page.update()
+            return
+        if self.active.peer:
+            event, data = "send_direct", {"to": self.active.peer, "text": caption}
+        else:
+            event, data = "send_message", {"text": caption, "room": self.active.room}
+        name = os.path.basename(path)
+        self._enqueue("upload", {
+            "path": path, "name": name, "size": size,
+            "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "event": event, "data": data
+        })
+        if not self.joined.is_set():
+            self._set_connection_state(self.connection_state, self.retry_delay)
+        self._retry_connection()
     
     def _route_change(self, e):
         """Обработчик изменения маршрута"""
@@ -313,11 +1681,25 @@ class TelegramChatApp:
     
     def _build_ui(self):
         """Создание пользовательского интерфейса"""
-        # Инициализация основных UI-компонентов
-        self.message_list = ft.ListView(expand=True, spacing=10, auto_scroll=True)
-        self.users_list = ft.ListView(width=200, spacing=5)
-        self.loading_indicator = ft.ProgressRing(width=16, height=16, color=self.COLORS["accent"])
+        # Инициализация основных UI-компонентов: списки текущей комнаты подставляются в контейнеры
+        channel = self._create_channel(self.DEFAULT_ROOM)
+        self.active = channel
+        self.message_container = ft.Container(content=channel.message_list, expand=True, bgcolor=self.COLORS["bg"])
+        self.users_container = ft.Container(content=channel.users_list, expand=True)
+        self.users_title = ft.Text(f"Участники #{channel.room}", color=self.COLORS["text"], size=14, weight=ft.FontWeight.BOLD)
+        
+        # Индикатор соединения в верхнем баре
+        self.connection_label = ft.Text("Подключение...", color=self.COLORS["hint"], size=12)
+        self.connection_indicator = ft.Row(
+            [ft.Icon(ft.Icons.CIRCLE, size=10, color=self.COLORS["hint"]), self.connection_label],
+            spacing=5,
+            tight=True,
+            vertical_alignment=ft.CrossAxisAlignment.CENTER
+        )
 
+        # Строка активности текущей комнаты в заголовке: кто печатает или прочитал
+        self.activity_label = ft.Text("", size=12, italic=True, color=self.COLORS["hint"])
+        
         # Поле ввода сообщения
         self.message_input = ft.TextField(
             hint_text="Введите сообщение...", 
@@ -329,6 +1711,7 @@ class TelegramChatApp:
             hint_style=ft.TextStyle(color=self.COLORS["hint"])
         )
         self.message_input.on_submit = self._send_message
+        self.message_input.on_change = self._send_typing
         
         # Создание кнопки отправки
         send_button = ft.IconButton(
@@ -338,6 +1721,65 @@ class TelegramChatApp:
         )
         send_button.on_click = self._send_message
         
+        # Кнопка вложения: выбор файла (FilePicker добавляется в overlay страницы)
+        self.file_picker = ft.FilePicker(on_result=self._pick_attachment)
+        attach_button = ft.IconButton(
+            icon=ft.Icons.ATTACH_FILE,
+            icon_color=self.COLORS["hint"],
+            tooltip="Прикрепить файл",
+            on_click=lambda e: self.file_picker.pick_files(allow_multiple=True)
+        )
+        
+        # Переключатель комнат: вкладки открытых комнат и поле открытия новой
+        self.channel_tabs = ft.Row([self._create_channel_tab(channel.room)], spacing=5, scroll=ft.ScrollMode.AUTO, expand=True)
+        self.room_input = ft.TextField(
+            hint_text="Открыть комнату",
+            width=170,
+            dense=True,
+            border_radius=15,
+            filled=True,
+            bgcolor=self.COLORS["input_bg"],
+            prefix_text="#",
+            text_style=ft.TextStyle(color=self.COLORS["text"]),
+            hint_style=ft.TextStyle(color=self.COLORS["hint"])
+        )
+        self.room_input.on_submit = lambda e: self._open_channel(self.room_input.value)
+        
+        # Поиск по истории текущей комнаты и панель его результатов над списком сообщений
+        self.search_input = ft.TextField(
+            hint_text="Поиск (from:имя)",
+            width=190,
+            dense=True,
+            border_radius=15,
+            filled=True,
+            bgcolor=self.COLORS["input_bg"],
+            prefix_icon=ft.Icons.SEARCH,
+            text_style=ft.TextStyle(color=self.COLORS["text"]),
+            hint_style=ft.TextStyle(color=self.COLORS["hint"])
+        )
+        self.search_input.on_submit = lambda e: self._search_history(self.search_input.value)
+        self.search_title = ft.Text(color=self.COLORS["text"], weight=ft.FontWeight.BOLD, expand=True)
+        self.search_results = ft.ListView(spacing=5, height=220)
+        self.search_more_button = ft.TextButton("Показать ещё", visible=False)
+        self.search_more_button.on_click = lambda e: self._request_search_page()
+        close_search_button = ft.IconButton(icon=ft.Icons.CLOSE, icon_size=16, icon_color=self.COLORS["text"], tooltip="Закрыть поиск")
+        close_search_button.on_click = lambda e: self._close_search()
+        self.search_panel = ft.Container(
+            content=ft.Column(
+                [
+                    ft.Row([self.search_title, close_search_button], vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                    self.search_results,
+                    self.search_more_button
+                ],
+                spacing=5,
+                tight=True
+            ),
+            padding=10,
+            visible=False,
+            bgcolor=self.COLORS["input_bg"],
+            border=ft.border.only(bottom=ft.BorderSide(1, self.COLORS["input_bg"]))
+        )
+        
         # Создание UI входа
         logo = ft.Container(
             content=ft.Icon(ft.Icons.CHAT, size=80, color=self.COLORS["accent"]),
@@ -415,7 +1857,22 @@ class TelegramChatApp:
                 # Верхний бар
                 ft.Container(
                     content=ft.Row(
-                        [ft.Text("Flet Chat", weight=ft.FontWeight.BOLD, color=self.COLORS["text"], size=18), ft.Container(expand=True)],
+                        [
+                            ft.Column(
+                                [
+                                    ft.Text("Flet Chat", weight=ft.FontWeight.BOLD, color=self.COLORS["text"], size=18),
+                                    self.activity_label
+                                ],
+                                spacing=0,
+                                tight=True
+                            ),
+                            ft.Container(width=15),
+                            self.channel_tabs,
+                            self.room_input,
+                            self.search_input,
+                            ft.Container(width=10),
+                            self.connection_indicator
+                        ],
                         vertical_alignment=ft.CrossAxisAlignment.CENTER
                     ),
                     padding=ft.padding.only(left=15, right=15, top=10, bottom=10),
@@ -430,11 +1887,11 @@ class TelegramChatApp:
                             content=ft.Column(
                                 [
                                     ft.Container(
-                                        content=ft.Text("Участники чата", color=self.COLORS["text"], size=14, weight=ft.FontWeight.BOLD),
+                                        content=self.users_title,
                                         padding=10,
                                         border=ft.border.only(bottom=ft.BorderSide(1, self.COLORS["input_bg"]))
                                     ),
-                                    ft.Container(content=self.users_list, expand=True)
+                                    self.users_container
                                 ],
                                 spacing=0,
                                 tight=True
@@ -447,12 +1904,14 @@ class TelegramChatApp:
                         ft.Container(
                             content=ft.Column(
                                 [
+                                    # Результаты поиска
+                                    self.search_panel,
                                     # Список сообщений
-                                    ft.Container(content=self.message_list, expand=True, bgcolor=self.COLORS["bg"]),
+                                    self.message_container,
                                     # Панель ввода сообщений
                                     ft.Container(
                                         content=ft.Row(
-                                            [self.message_input, send_button],
+                                            [attach_button, self.message_input, send_button],
                                             spacing=10,
                                             vertical_alignment=ft.CrossAxisAlignment.CENTER
                                         ),
@@ -487,15 +1946,20 @@ class TelegramChatApp:
         page.window_min_width, page.window_min_height = 500, 500
         page.route = "/"
         
-        # Создание UI
+        # Создание UI и отображение переписки из локального кэша
         self._build_ui()
+        page.overlay.append(self.file_picker)
+        self._open_cache()
+        self._restore_from_cache()
         
         # Регистрация обработчиков событий
+        self.renderer.start()
+        threading.Thread(target=self._ephemeral_loop, name="EphemeralWorker", daemon=True).start()
         self._register_socket_handlers()
         page.on_route_change = self._route_change
         
-        # Инициализация
-        page.go("/join")
+        # Инициализация: с сохранённым именем - сразу в чат, join отправится после подключения
+        page.go("/chat" if self.username else "/join")
         self._connect_to_server()
         
     def run(self):
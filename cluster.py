@@ -0,0 +1,240 @@
+"""Кластерный режим: несколько процессов ChatServer с общей шиной рассылок
+
+Концентратор (ClusterHub) - отдельный процесс на UNIX-сокете. Он
+ретранслирует рассылки всем процессам в едином порядке, присваивая каждой
+возрастающее смещение, и хранит общий реестр имён пользователей и участников комнат.
+Процессы сервера подключаются к нему через HubConnection и HubManager -
+менеджер клиентов python-socketio.
+
+Запуск концентратора:
+    python cluster.py --socket /tmp/flet-chat-hub.sock
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+import uuid
+from multiprocessing.connection import Client, Listener
+
+import socketio
+
+import logpipe
+from registry import RoomRegistry, UserRegistry
+
+DEFAULT_AUTHKEY = b"flet-chat"
+
+
+class ClusterHub:
+    """Концентратор кластера: шина рассылок, общий реестр имён и индекс комнат"""
+
+    def __init__(self, path, authkey=DEFAULT_AUTHKEY):
+        self.logger = logging.getLogger("ClusterHub")
+        self.path = path
+        self.authkey = authkey
+        self.stream_id = uuid.uuid4().hex
+        # Смещение начинается с текущего времени в микросекундах,
+        # чтобы номера рассылок не повторялись после перезапуска концентратора
+        self.offset = int(time.time() * 1_000_000)
+        self.subscribers = []
+        self.publish_lock = threading.Lock()
+
+        # Общий реестр: "sid" в нём - пара (id процесса, sid)
+        self.users = UserRegistry()
+        self.rooms = RoomRegistry()
+        self.worker_sids = {}
+        self.users_lock = threading.Lock()
+
+    def serve_forever(self):
+        """Приём подключений процессов сервера"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = Listener(self.path, family="AF_UNIX", authkey=self.authkey)
+        self.logger.info("Концентратор кластера слушает %s", self.path)
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as e:
+                self.logger.error("Ошибка подключения к концентратору: %s", e)
+                continue
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        """Обработка запросов одного подключения"""
+        worker_id = None
+        try:
+            while True:
+                request = connection.recv()
+                op = request[0]
+                if op == "subscribe":
+                    # Подключение становится каналом доставки рассылок
+                    with self.publish_lock:
+                        connection.send((self.stream_id, self.offset))
+                        self.subscribers.append(connection)
+                    return
+                if op == "publish":
+                    self._publish(request[1])
+                elif op == "hello":
+                    worker_id = request[1]
+                    connection.send((self.stream_id, self.offset))
+                else:
+                    connection.send(self._call(worker_id, op, *request[1:]))
+        except (EOFError, OSError):
+            pass
+        finally:
+            if worker_id is not None:
+                self._forget_worker(worker_id)
+
+    def _publish(self, message):
+        """Ретрансляция рассылки всем процессам в едином порядке"""
+        with self.publish_lock:
+            self.offset += 1
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.send((self.offset, message))
+                except (EOFError, OSError):
+                    self.subscribers.remove(subscriber)
+
+    def _call(self, worker_id, op, *args):
+        """Операции с общим реестром имён и индексом комнат"""
+        with self.users_lock:
+            if op == "reserve":
+                sid, username = args
+                reserved = self.users.reserve((worker_id, sid), username)
+                if reserved:
+                    self.worker_sids.setdefault(worker_id, set()).add(sid)
+                return reserved
+            if op == "release":
+                sid, = args
+                self.worker_sids.get(worker_id, set()).discard(sid)
+                return self.users.release((worker_id, sid))
+            if op == "snapshot":
+                return self.users.snapshot()
+            if op == "lookup":
+                owner = self.users.get_sid(args[0])
+                return owner[1] if owner else None
+            if op == "count":
+                return len(self.users)
+            if op == "room_join":
+                room, sid, username = args
+                return self.rooms.join(room, (worker_id, sid), username)
+            if op == "room_leave":
+                room, sid = args
+                return self.rooms.leave(room, (worker_id, sid))
+            if op == "room_leave_all":
+                return self.rooms.leave_all((worker_id, args[0]))
+            if op == "room_snapshot":
+                return self.rooms.snapshot(args[0])
+        raise ValueError(f"Неизвестная операция концентратора: {op}")
+
+    def _forget_worker(self, worker_id):
+        """Освобождение имён и мест в комнатах отключившегося процесса сервера"""
+        with self.users_lock:
+            sids = self.worker_sids.pop(worker_id, set())
+            for sid in sids:
+                self.rooms.leave_all((worker_id, sid))
+                self.users.release((worker_id, sid))
+        if sids:
+            self.logger.info("Процесс %s отключился, освобождено имён: %s", worker_id, len(sids))
+
+
+class HubConnection:
+    """Подключение процесса сервера к концентратору для запросов и публикаций"""
+
+    def __init__(self, path, authkey=DEFAULT_AUTHKEY):
+        self.path = path
+        self.authkey = authkey
+        self.worker_id = uuid.uuid4().hex
+        self._connection = Client(path, family="AF_UNIX", authkey=authkey)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.send(("hello", self.worker_id))
+            self.stream_id, _ = self._connection.recv()
+
+    def call(self, op, *args):
+        """Запрос к концентратору с ожиданием ответа"""
+        with self._lock:
+            self._connection.send((op, *args))
+            return self._connection.recv()
+
+    def publish(self, message):
+        """Публикация рассылки (без ожидания ответа)"""
+        with self._lock:
+            self._connection.send(("publish", message))
+
+    def subscribe(self):
+        """Отдельное подключение для получения рассылок: (подключение, stream_id, смещение)"""
+        connection = Client(self.path, family="AF_UNIX", authkey=self.authkey)
+        connection.send(("subscribe",))
+        stream_id, offset = connection.recv()
+        return connection, stream_id, offset
+
+
+class HubManager(socketio.PubSubManager):
+    """Менеджер клиентов python-socketio поверх концентратора кластера
+
+    Обычные рассылки работают как в других PubSub-менеджерах: обрабатываются
+    локально и публикуются для остальных процессов. Упорядочиваемые рассылки
+    (sequenced_event в комнаты с префиксом sequenced_prefix) обрабатываются только после
+    ретрансляции, в том числе отправителем, - так все процессы видят их в
+    одном порядке. Перед локальной отправкой вызывается
+    on_sequenced(payload, offset) под блокировкой lock.
+    """
+
+    name = "hub"
+
+    def __init__(self, hub, sequenced_event, sequenced_prefix, on_sequenced, lock):
+        super().__init__(channel="flet-chat")
+        self.hub = hub
+        self.sequenced_event = sequenced_event
+        self.sequenced_prefix = sequenced_prefix
+        self.on_sequenced = on_sequenced
+        self.lock = lock
+        self._subscription = None
+        self.start_offset = None
+
+    def initialize(self):
+        """Подписка на рассылки до запуска потока их обработки"""
+        self._subscription, _, self.start_offset = self.hub.subscribe()
+        super().initialize()
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if (event == self.sequenced_event and isinstance(room, str) and room.startswith(self.sequenced_prefix)
+                and not kwargs.get("ignore_queue")):
+            # Порядок задаёт концентратор: здесь сообщение обработается после ретрансляции
+            self._publish({
+                "method": "emit", "event": event, "data": [data], "binary": False,
+                "namespace": namespace or "/", "room": room, "skip_sid": skip_sid,
+                "callback": None, "host_id": self.host_id, "sequenced": True
+            })
+            return
+        return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                            callback=callback, **kwargs)
+
+    def _publish(self, data):
+        self.hub.publish(data)
+
+    def _listen(self):
+        while True:
+            offset, message = self._subscription.recv()
+            if message.get("sequenced"):
+                # Упорядочиваемые рассылки обрабатывает и процесс-отправитель
+                message = dict(message, host_id=None, offset=offset)
+            yield message
+
+    def _handle_emit(self, message):
+        if "offset" not in message:
+            return super()._handle_emit(message)
+        with self.lock:
+            self.on_sequenced(message["data"][0], message["offset"])
+            super()._handle_emit(message)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Концентратор кластера чата")
+    parser.add_argument("--socket", default="/tmp/flet-chat-hub.sock", help="путь к UNIX-сокету")
+    args = parser.parse_args()
+
+    logpipe.setup()
+    ClusterHub(args.socket).serve_forever()
@@ -0,0 +1,276 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from engineio import packet as eio_packet
+from flask import Flask, Response, abort, request, send_file
+from flask_socketio import SocketIO
+from socketio import packet as sio_packet
+
+import wire
+from outbound import AsyncOutboundQueue, ThreadingOutboundQueue
+
+# События жизненного цикла соединения: обработчик получает только sid
+LIFECYCLE_EVENTS = ("connect", "disconnect")
+
+# Файлы маршрутов add_file_route: тип содержимого не угадывается браузером, кэш на год
+FILE_CONTENT_TYPE = "application/octet-stream"
+FILE_MAX_AGE = 365 * 24 * 3600
+
+
+def encode_event(server, event, data):
+    """Готовый пакет Engine.IO с событием Socket.IO в пространстве имён по умолчанию"""
+    encoded = server.packet_class(sio_packet.EVENT, data=[event, data], namespace="/").encode()
+    return eio_packet.Packet(eio_packet.MESSAGE, data=encoded)
+
+
+def outbound_stats(server):
+    """Глубина исходящей очереди и число отброшенных сообщений по sid клиентов"""
+    stats = []
+    for eio_sid, socket in list(server.eio.sockets.items()):
+        if hasattr(socket.queue, "depth"):
+            sid = server.manager.sid_from_eio_sid(eio_sid, "/")
+            stats.append({"sid": sid, "depth": socket.queue.depth(), "dropped": socket.queue.dropped})
+    return stats
+
+
+class ThreadingEngine:
+    """Транспорт на Flask + Flask-SocketIO (поток на каждое соединение)
+
+    Обработчики ChatServer вызываются как handler(sid, *args), рассылка -
+    через emit(event, data, to, skip_sid), как и в AsyncEngine.
+    """
+
+    name = "threading"
+
+    def __init__(self, client_manager=None):
+        self.app = Flask("server")
+        # События клиента обрабатываются по порядку в потоке его соединения:
+        # сообщения, отправленные клиентом подряд, рассылаются в том же порядке
+        self.socketio = SocketIO(
+            self.app, cors_allowed_origins="*", client_manager=client_manager, async_handlers=False
+        )
+        # JSON для всех клиентов и msgpack для запросивших его (см. wire.py)
+        wire.install(self.socketio.server)
+        if client_manager is not None:
+            # Менеджер инициализируется сразу, а не при первом событии:
+            # рассылки других процессов должны доходить с момента запуска
+            self.socketio.server.manager_initialized = True
+            client_manager.initialize()
+
+    def on(self, event, handler):
+        """Регистрация обработчика события"""
+        def wrapper(*args):
+            if event in LIFECYCLE_EVENTS:
+                args = ()
+            return handler(request.sid, *args)
+        self.socketio.on_event(event, wrapper)
+
+    def emit(self, event, data, to=None, skip_sid=None):
+        """Отправка события клиенту, комнате (to) или всем"""
+        self.socketio.emit(event, data, to=to, skip_sid=skip_sid)
+
+    def enter_room(self, sid, room):
+        """Добавление клиента в комнату"""
+        self.socketio.server.enter_room(sid, room)
+
+    def leave_room(self, sid, room):
+        """Удаление клиента из комнаты"""
+        self.socketio.server.leave_room(sid, room)
+
+    def add_route(self, path, handler):
+        """HTTP-маршрут GET: handler() возвращает (тело, тип содержимого)"""
+        def view():
+            body, content_type = handler()
+            return Response(body, content_type=content_type)
+        self.app.add_url_rule(path, path, view)
+
+    def add_file_route(self, prefix, resolve):
+        """HTTP-маршрут GET prefix/<имя>: файл по пути resolve(имя) (None - 404).
+
+        Файл отдаётся с диска без чтения в память (wsgi.file_wrapper), с
+        поддержкой Range-запросов; содержимое по имени неизменно, поэтому
+        ответ кэшируется клиентом.
+        """
+        def view(name):
+            path = resolve(name)
+            if path is None:
+                abort(404)
+            response = send_file(path, mimetype=FILE_CONTENT_TYPE, conditional=True, etag=name, max_age=FILE_MAX_AGE)
+            response.headers["X-Content-Type-Options"] = "nosniff"
+            return response
+        self.app.add_url_rule(f"{prefix}/<name>", prefix, view)
+
+    def limit_outbound(self, limit, policy, marker, on_drop):
+        """Ограничение исходящих очередей клиентов (см. outbound.py).
+
+        marker(count) возвращает (событие, данные) отметки о пропущенных сообщениях.
+        """
+        server = self.socketio.server
+
+        def create_queue(*args, **kwargs):
+            return ThreadingOutboundQueue(
+                limit, policy, lambda count: encode_event(server, *marker(count)), on_drop,
+                lambda overflowed: self.socketio.start_background_task(self._disconnect_slow, overflowed)
+            )
+        server.eio.create_queue = create_queue
+
+    def outbound_stats(self):
+        """Состояние исходящих очередей клиентов"""
+        return outbound_stats(self.socketio.server)
+
+    def _disconnect_slow(self, overflowed):
+        """Отключение клиента, чья исходящая очередь переполнилась"""
+        eio = self.socketio.server.eio
+        for eio_sid, socket in list(eio.sockets.items()):
+            if socket.queue is overflowed:
+                # Без ожидания отправки очереди: клиент её всё равно не разбирает
+                socket.close(wait=False, abort=True)
+                eio.sockets.pop(eio_sid, None)
+
+    def run(self, host, port, debug=False):
+        """Запуск сервера (блокирующий)"""
+        # Встроенный сервер Werkzeug - штатный для этого режима, в том числе без терминала
+        self.socketio.run(self.app, host=host, port=port, debug=debug, allow_unsafe_werkzeug=True)
+
+
+class AsyncEngine:
+    """Транспорт на python-socketio AsyncServer + aiohttp (один поток, asyncio)
+
+    Обработчики ChatServer остаются синхронными и могут блокироваться (чтение
+    истории, поиск, запись вложений), поэтому выполняются в пуле потоков, а не
+    в цикле событий. Отправки и изменения комнат складываются в очередь и
+    выполняются одной задачей строго по порядку, поэтому гарантии порядка те
+    же, что у ThreadingEngine.
+    """
+
+    name = "asyncio"
+
+    # Потоков для синхронных обработчиков событий
+    HANDLER_THREADS = 32
+
+    def __init__(self, client_manager=None):
+        # aiohttp нужен только для этого режима
+        import socketio
+        from aiohttp import web
+
+        self.logger = logging.getLogger("ChatServer")
+        # События клиента обрабатываются по порядку, как в ThreadingEngine
+        self.socketio = socketio.AsyncServer(
+            async_mode="aiohttp", cors_allowed_origins="*", client_manager=client_manager, async_handlers=False
+        )
+        wire.install_async(self.socketio)
+        self.app = web.Application()
+        self.socketio.attach(self.app)
+
+        self._loop = None
+        self._loop_thread = None
+        self._outbox = None
+        self._executor = ThreadPoolExecutor(self.HANDLER_THREADS, thread_name_prefix="Handler")
+        self.app.on_startup.append(self._start_outbox)
+
+    def on(self, event, handler):
+        """Регистрация обработчика события (выполняется в пуле потоков)"""
+        async def wrapper(sid, *args):
+            if event in LIFECYCLE_EVENTS:
+                args = ()
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(handler, sid, *args)
+            )
+        self.socketio.on(event, wrapper)
+
+    def emit(self, event, data, to=None, skip_sid=None):
+        """Постановка отправки события в очередь"""
+        self._submit(self.socketio.emit, event, data, to=to, skip_sid=skip_sid)
+
+    def enter_room(self, sid, room):
+        """Постановка добавления клиента в комнату в очередь"""
+        self._submit(self.socketio.enter_room, sid, room)
+
+    def leave_room(self, sid, room):
+        """Постановка удаления клиента из комнаты в очередь"""
+        self._submit(self.socketio.leave_room, sid, room)
+
+    def add_route(self, path, handler):
+        """HTTP-маршрут GET: handler() возвращает (тело, тип содержимого)"""
+        from aiohttp import web
+
+        async def view(request):
+            body, content_type = handler()
+            return web.Response(body=body.encode("utf-8"), headers={"Content-Type": content_type})
+        self.app.router.add_get(path, view)
+
+    def add_file_route(self, prefix, resolve):
+        """HTTP-маршрут GET prefix/<имя>: файл по пути resolve(имя) (None - 404), через sendfile"""
+        from aiohttp import web
+
+        async def view(request):
+            path = resolve(request.match_info["name"])
+            if path is None:
+                raise web.HTTPNotFound()
+            return web.FileResponse(path, headers={
+                "Content-Type": FILE_CONTENT_TYPE,
+                "Cache-Control": f"public, max-age={FILE_MAX_AGE}, immutable",
+                "X-Content-Type-Options": "nosniff",
+            })
+        self.app.router.add_get(prefix + "/{name}", view)
+
+    def limit_outbound(self, limit, policy, marker, on_drop):
+        """Ограничение исходящих очередей клиентов (см. outbound.py)"""
+        server = self.socketio
+
+        def create_queue(*args, **kwargs):
+            return AsyncOutboundQueue(
+                limit, policy, lambda count: encode_event(server, *marker(count)), on_drop,
+                lambda overflowed: self._submit(self._disconnect_slow, overflowed)
+            )
+        server.eio.create_queue = create_queue
+
+    def outbound_stats(self):
+        """Состояние исходящих очередей клиентов"""
+        return outbound_stats(self.socketio)
+
+    async def _disconnect_slow(self, overflowed):
+        """Отключение клиента, чья исходящая очередь переполнилась"""
+        eio = self.socketio.eio
+        for eio_sid, socket in list(eio.sockets.items()):
+            if socket.queue is overflowed:
+                await socket.close(wait=False, abort=True)
+                eio.sockets.pop(eio_sid, None)
+
+    def run(self, host, port, debug=False):
+        """Запуск сервера (блокирующий)"""
+        from aiohttp import web
+        web.run_app(self.app, host=host, port=port, print=None)
+
+    def _submit(self, func, *args, **kwargs):
+        """Добавление операции в очередь из цикла событий или из другого потока"""
+        item = (func, args, kwargs)
+        if threading.get_ident() == self._loop_thread:
+            self._outbox.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._outbox.put_nowait, item)
+
+    async def _start_outbox(self, app):
+        """Создание очереди и задачи отправки при старте приложения"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._outbox = asyncio.Queue()
+        app["outbox_task"] = asyncio.create_task(self._drain_outbox())
+
+    async def _drain_outbox(self):
+        """Последовательное выполнение операций из очереди"""
+        while True:
+            func, args, kwargs = await self._outbox.get()
+            try:
+                await func(*args, **kwargs)
+            except Exception as e:
+                self.logger.error("Ошибка отправки события: %s", e)
+
+
+ENGINES = {
+    ThreadingEngine.name: ThreadingEngine,
+    AsyncEngine.name: AsyncEngine,
+}
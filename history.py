@@ -0,0 +1,276 @@
+import collections
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+# Комната, в которую попадают сообщения без явной комнаты (и записи старых баз)
+DEFAULT_ROOM = "general"
+
+# Столбцы сообщения в порядке _message_row и _row_message
+MESSAGE_COLUMNS = "id, ts, username, text, room, attachment"
+
+
+def _message_row(message):
+    """Строка таблицы messages по словарю сообщения (ссылка на вложение - в JSON)"""
+    attachment = message.get("attachment")
+    return (
+        message["id"], message["ts"], message["username"], message["text"], message["room"],
+        json.dumps(attachment, ensure_ascii=False) if attachment else None
+    )
+
+
+def _row_message(row):
+    """Словарь сообщения по строке таблицы messages"""
+    message = {"id": row[0], "ts": row[1], "username": row[2], "text": row[3], "room": row[4]}
+    if row[5]:
+        message["attachment"] = json.loads(row[5])
+    return message
+
+
+class HistoryStore:
+    """Хранилище истории сообщений на SQLite (режим WAL)
+
+    Добавление сообщения не обращается к диску: запись получает id, попадает
+    в кэш последних сообщений своей комнаты и в очередь фонового потока,
+    который сохраняет очередь пачками - одна транзакция (и один fsync) на пачку.
+    id сквозные для всех комнат, страницы истории выбираются по комнате.
+    """
+
+    # Максимальное ожидание записи очереди при чтении старых сообщений (секунды)
+    READ_WAIT_TIMEOUT = 1.0
+
+    def __init__(self, path="chat_history.db", batch_size=256, flush_interval=0.05, cache_size=1000):
+        """Открытие базы и запуск фонового потока записи"""
+        self.logger = logging.getLogger("ChatServer")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # Одно соединение на запись и чтение, доступ через блокировку
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Коммит пачки - точка сохранности, поэтому fsync на каждый коммит
+            self._db.execute("PRAGMA synchronous=FULL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY, ts REAL NOT NULL, username TEXT NOT NULL, text TEXT NOT NULL, "
+                f"room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}', attachment TEXT)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+            if "room" not in columns:
+                # База до появления комнат: все сообщения относятся к общей комнате
+                self._db.execute(f"ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'")
+            if "attachment" not in columns:
+                # База до появления вложений
+                self._db.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+            self._db.execute("CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id)")
+            self._db.commit()
+            last_id, = self._db.execute("SELECT MAX(id) FROM messages").fetchone()
+            first_ids = dict(self._db.execute("SELECT room, MIN(id) FROM messages GROUP BY room"))
+
+        # id назначаются при добавлении, не дожидаясь записи на диск
+        self._id_lock = threading.Lock()
+        self._first_ids = first_ids  # комната -> id её первого сообщения
+        self._last_id = last_id or 0
+
+        # Число добавленных и уже записанных на диск сообщений
+        self._committed = threading.Condition()
+        self._appended = 0
+        self._committed_count = 0
+
+        # Последние сообщения каждой комнаты в памяти: в них же находятся ещё не записанные
+        self._recent = collections.defaultdict(lambda: collections.deque(maxlen=cache_size))
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="HistoryWriter", daemon=True)
+        self._writer.start()
+
+    def append(self, username, text, message_id=None, ts=None, room=DEFAULT_ROOM, attachment=None):
+        """Добавление сообщения в комнату room. Возвращает словарь с назначенными id и ts
+
+        message_id и ts можно задать явно (id должен быть больше всех прежних) -
+        так процессы кластера хранят сообщения под общими номерами.
+        attachment - ссылка на вложение (словарь), хранится вместе с сообщением.
+        """
+        with self._id_lock:
+            self._last_id = self._last_id + 1 if message_id is None else message_id
+            self._first_ids.setdefault(room, self._last_id)
+            message = {
+                "id": self._last_id, "ts": ts or time.time(), "username": username, "text": text, "room": room
+            }
+            if attachment:
+                message["attachment"] = attachment
+            self._appended += 1
+            self._recent[room].append(message)
+            # Очередь упорядочена по id, поэтому записанные id растут монотонно
+            self._queue.put(message)
+        return message
+
+    def last_id(self):
+        """id последнего добавленного сообщения (0 - история пуста)"""
+        return self._last_id
+
+    def cached_after(self, after_id, room=DEFAULT_ROOM):
+        """Сообщения комнаты с id больше after_id из кэша, без ожидания записи на диск.
+
+        None, если часть таких сообщений уже вытеснена из кэша.
+        """
+        recent = self._recent.get(room)
+        if recent is None:
+            return []
+        cached = list(recent)
+        if len(cached) == recent.maxlen and cached[0]["id"] > after_id:
+            return None
+        return [message for message in cached if message["id"] > after_id]
+
+    def recent(self, limit, room=DEFAULT_ROOM):
+        """Последние limit сообщений комнаты в порядке возрастания id"""
+        return self.page(None, limit, room)
+
+    def page(self, before_id, limit, room=DEFAULT_ROOM):
+        """Страница из limit сообщений комнаты с id меньше before_id (None - с конца истории)"""
+        if limit <= 0 or room not in self._first_ids:
+            return []
+
+        # Сначала пробуем ответить из кэша последних сообщений комнаты
+        cached = list(self._recent.get(room, ()))
+        if cached:
+            if before_id is None:
+                candidates = cached
+            else:
+                candidates = [message for message in cached if message["id"] < before_id]
+            # Кэш покрывает запрос, если в нём достаточно сообщений или он начинается с начала истории
+            if len(candidates) >= limit or (candidates and candidates[0]["id"] == self._first_ids[room]):
+                return candidates[-limit:]
+            if candidates:
+                before_id = candidates[0]["id"]
+                limit -= len(candidates)
+            elif before_id is None or before_id > cached[0]["id"]:
+                before_id = cached[0]["id"]
+        else:
+            candidates = []
+
+        # Сообщения старше кэша могут быть ещё в очереди - дожидаемся их записи
+        target = self._appended
+        with self._committed:
+            self._committed.wait_for(lambda: self._committed_count >= target, timeout=self.READ_WAIT_TIMEOUT)
+
+        with self._db_lock:
+            if before_id is None:
+                rows = self._db.execute(
+                    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?",
+                    (room, limit)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? AND id < ? "
+                    "ORDER BY id DESC LIMIT ?",
+                    (room, before_id, limit)
+                ).fetchall()
+        older = [_row_message(row) for row in reversed(rows)]
+        return older + candidates
+
+    def page_after(self, after_id, limit, room=DEFAULT_ROOM):
+        """Первые limit сообщений комнаты с id больше after_id в порядке возрастания id"""
+        if limit <= 0 or room not in self._first_ids:
+            return []
+
+        # Кэш содержит все сообщения комнаты новее своего первого
+        cached = list(self._recent.get(room, ()))
+        if cached and (cached[0]["id"] <= after_id or cached[0]["id"] == self._first_ids[room]):
+            return [message for message in cached if message["id"] > after_id][:limit]
+
+        target = self._appended
+        with self._committed:
+            self._committed.wait_for(lambda: self._committed_count >= target, timeout=self.READ_WAIT_TIMEOUT)
+
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? AND id > ? ORDER BY id LIMIT ?",
+                (room, after_id, limit)
+            ).fetchall()
+        return [_row_message(row) for row in rows]
+
+    def messages(self, ids, room=DEFAULT_ROOM):
+        """Сообщения комнаты с заданными id в порядке ids (отсутствующие пропускаются)"""
+        found = {message["id"]: message for message in list(self._recent.get(room, ())) if message["id"] in ids}
+        missing = [message_id for message_id in ids if message_id not in found]
+        if missing:
+            target = self._appended
+            with self._committed:
+                self._committed.wait_for(lambda: self._committed_count >= target, timeout=self.READ_WAIT_TIMEOUT)
+            with self._db_lock:
+                rows = self._db.execute(
+                    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? AND id IN ({','.join('?' * len(missing))})",
+                    (room, *missing)
+                ).fetchall()
+            for row in rows:
+                found[row[0]] = _row_message(row)
+        return [found[message_id] for message_id in ids if message_id in found]
+
+    def iter_messages(self, batch_size=10000):
+        """Все записанные сообщения всех комнат в порядке возрастания id (чтение пачками)"""
+        last_id = 0
+        while True:
+            with self._db_lock:
+                rows = self._db.execute(
+                    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+            for row in rows:
+                yield _row_message(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def flush(self):
+        """Ожидание записи на диск всех добавленных сообщений"""
+        self._queue.join()
+
+    def close(self):
+        """Запись оставшихся сообщений, остановка потока и закрытие базы"""
+        self._queue.put(None)
+        self._writer.join()
+        with self._db_lock:
+            self._db.close()
+
+    def _write_loop(self):
+        """Цикл фонового потока: сохранение очереди пачками"""
+        while True:
+            batch = [self._queue.get()]
+            # Добираем пачку тем, что успело накопиться за flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            messages = [message for message in batch if message is not None]
+            if messages:
+                try:
+                    with self._db_lock:
+                        self._db.executemany(
+                            f"INSERT INTO messages ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                            [_message_row(message) for message in messages]
+                        )
+                        self._db.commit()
+                except Exception as e:
+                    self.logger.error("Ошибка записи истории сообщений: %s", e)
+                # Неудачная пачка тоже считается обработанной, чтобы чтение не ждало её
+                with self._committed:
+                    self._committed_count += len(messages)
+                    self._committed.notify_all()
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
@@ -0,0 +1,184 @@
+"""Локальный кэш клиента: последние сообщения и участники комнат на диске
+
+Один файл SQLite на пользователя, записи в нём разделены по адресу сервера.
+При запуске клиент сразу отображает сохранённую переписку, а после входа
+запрашивает у сервера только сообщения новее кэша. Запись выполняется
+фоновым потоком пачками, поэтому обработчики событий не ждут диска.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class LocalCache:
+    """Кэш последних сообщений, участников комнат и состояния входа для одного сервера"""
+
+    # Сообщений, хранимых на комнату
+    MESSAGES_PER_ROOM = 500
+
+    def __init__(self, path, server, flush_interval=0.5):
+        """Открытие (создание) файла кэша и запуск фонового потока записи"""
+        self.logger = logging.getLogger("TelegramChat")
+        self.server = server
+        self.flush_interval = flush_interval
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Потеря последних записей при сбое допустима: кэш сверяется с сервером
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "server TEXT NOT NULL, room TEXT NOT NULL, id INTEGER NOT NULL, ts REAL NOT NULL, "
+                "username TEXT NOT NULL, text TEXT NOT NULL, attachment TEXT, PRIMARY KEY (server, room, id)) WITHOUT ROWID"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+            if "attachment" not in columns:
+                # Кэш до появления вложений
+                self._db.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                "server TEXT NOT NULL, room TEXT NOT NULL, users TEXT NOT NULL, PRIMARY KEY (server, room))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "server TEXT PRIMARY KEY, username TEXT, rooms TEXT NOT NULL)"
+            )
+            self._db.commit()
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="CacheWriter", daemon=True)
+        self._writer.start()
+
+    def load_state(self):
+        """Имя пользователя и открытые комнаты прошлого сеанса: (имя или None, список комнат)"""
+        with self._db_lock:
+            row = self._db.execute("SELECT username, rooms FROM state WHERE server = ?", (self.server,)).fetchone()
+        if row is None:
+            return None, []
+        return row[0], json.loads(row[1])
+
+    def load_messages(self, room, limit):
+        """Последние limit сообщений комнаты в порядке возрастания id"""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT id, ts, username, text, attachment FROM messages WHERE server = ? AND room = ? "
+                "ORDER BY id DESC LIMIT ?",
+                (self.server, room, limit)
+            ).fetchall()
+        messages = []
+        for row in reversed(rows):
+            message = {"id": row[0], "ts": row[1], "username": row[2], "text": row[3]}
+            if row[4]:
+                message["attachment"] = json.loads(row[4])
+            messages.append(message)
+        return messages
+
+    def load_members(self, room):
+        """Последний известный список участников комнаты"""
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT users FROM members WHERE server = ? AND room = ?", (self.server, room)
+            ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def save_state(self, username, rooms):
+        """Сохранение имени пользователя и списка открытых комнат"""
+        self._queue.put(("state", username, list(rooms)))
+
+    def add_messages(self, room, messages):
+        """Добавление сообщений комнаты (уже сохранённые id перезаписываются)"""
+        if messages:
+            self._queue.put(("messages", room, [
+                (
+                    message["id"], message["ts"], message["username"], message["text"],
+                    json.dumps(message["attachment"], ensure_ascii=False) if message.get("attachment") else None
+                )
+                for message in messages
+            ]))
+
+    def clear_messages(self, room):
+        """Удаление всех сообщений комнаты (кэш устарел, и сервер прислал ленту заново)"""
+        self._queue.put(("clear", room))
+
+    def save_members(self, room, users):
+        """Сохранение списка участников комнаты"""
+        self._queue.put(("members", room, list(users)))
+
+    def flush(self):
+        """Ожидание записи всех поставленных изменений"""
+        self._queue.join()
+
+    def close(self):
+        """Запись оставшихся изменений, остановка потока и закрытие файла"""
+        self._queue.put(None)
+        self._writer.join()
+        with self._db_lock:
+            self._db.close()
+
+    def _write_loop(self):
+        """Цикл фонового потока: применение изменений пачками в одной транзакции"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            try:
+                self._apply([op for op in batch if op is not None])
+            except Exception as e:
+                self.logger.error("Ошибка записи локального кэша: %s", e)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _apply(self, ops):
+        """Применение пачки изменений и обрезка комнат до MESSAGES_PER_ROOM сообщений"""
+        if not ops:
+            return
+        touched = set()
+        with self._db_lock:
+            for op in ops:
+                if op[0] == "messages":
+                    _, room, rows = op
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO messages (server, room, id, ts, username, text, attachment) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(self.server, room, *row) for row in rows]
+                    )
+                    touched.add(room)
+                elif op[0] == "clear":
+                    self._db.execute("DELETE FROM messages WHERE server = ? AND room = ?", (self.server, op[1]))
+                elif op[0] == "members":
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO members (server, room, users) VALUES (?, ?, ?)",
+                        (self.server, op[1], json.dumps(op[2], ensure_ascii=False))
+                    )
+                elif op[0] == "state":
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO state (server, username, rooms) VALUES (?, ?, ?)",
+                        (self.server, op[1], json.dumps(op[2], ensure_ascii=False))
+                    )
+            for room in touched:
+                self._db.execute(
+                    "DELETE FROM messages WHERE server = ? AND room = ? AND id <= ("
+                    "SELECT id FROM messages WHERE server = ? AND room = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (self.server, room, self.server, room, self.MESSAGES_PER_ROOM)
+                )
+            self._db.commit()
@@ -0,0 +1,140 @@
+"""Неблокирующее логирование для сервера и клиента
+
+Обработчик корневого логгера только кладёт запись в очередь в памяти;
+форматирование и запись в поток вывода выполняет фоновый поток
+QueueListener. Поэтому медленный stdout (например, канал в сборщик логов)
+не задерживает обработчики событий. Сообщения передаются в %-стиле
+(logger.info("... %s", value)) и форматируются только в фоновом потоке и
+только если запись прошла по уровню.
+
+Для частых событий можно включить выборку: запись с extra={"category": ...}
+из категории с частотой N выводится одна из N (с полем sample_rate).
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Максимум записей в очереди: при переполнении новые записи отбрасываются, а не ждут вывода
+QUEUE_SIZE = 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись одной строкой JSON: время, уровень, логгер, сообщение, категория"""
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("category", "sample_rate"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Выборка записей по категориям: rates - категория -> N (пропускается одна из N)"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {category: rate for category, rate in rates.items() if rate > 1}
+        self._counters = {category: itertools.count() for category in self.rates}
+
+    def filter(self, record):
+        category = getattr(record, "category", None)
+        rate = self.rates.get(category)
+        if rate is None:
+            return True
+        # next() у itertools.count атомарен, отдельная блокировка не нужна
+        if next(self._counters[category]) % rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, не форматирующий запись в потоке вызывающего
+
+    Стандартный QueueHandler.prepare подставляет аргументы в сообщение до
+    постановки в очередь; здесь запись передаётся как есть, и форматирование
+    выполняет фоновый поток. Переполненная очередь не блокирует: запись
+    отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(logging.handlers.QueueListener):
+    """QueueListener, дожидающийся места в очереди для отметки остановки"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+_listener = None
+
+
+def setup(json_format=False, sampling=None, level=logging.INFO, stream=None):
+    """Настройка корневого логгера процесса через очередь и фоновый поток вывода.
+
+    json_format - выводить записи строками JSON, sampling - частоты выборки
+    по категориям, stream - поток вывода (по умолчанию sys.stdout).
+    Повторный вызов заменяет прежнюю настройку. Возвращает обработчик очереди.
+    """
+    global _listener
+    stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = LazyQueueHandler(log_queue)
+    if sampling:
+        handler.addFilter(SamplingFilter(sampling))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    _listener = _Listener(log_queue, output)
+    _listener.start()
+    return handler
+
+
+def stop():
+    """Вывод оставшихся записей и остановка фонового потока"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def sampling_arg(value):
+    """Тип аргумента командной строки "категория=N" -> (категория, N)"""
+    category, separator, rate = value.partition("=")
+    if not category or not separator or int(rate) < 1:
+        raise ValueError(value)
+    return category, int(rate)
+
+
+atexit.register(stop)
@@ -0,0 +1,160 @@
+import bisect
+import time
+
+# Границы корзин гистограмм
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FANOUT_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+# Тип содержимого текстового формата Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """Счётчик с необязательной меткой
+
+    Значения метки задаются заранее: все серии создаются при инициализации,
+    и на горячем пути остаётся только увеличение элемента словаря.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, label=None, values=(None,)):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = dict.fromkeys(values, 0)
+
+    def inc(self, value=None, amount=1):
+        self._values[value] += amount
+
+    def value(self, value=None):
+        return self._values[value]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for value, amount in self._values.items():
+            lines.append(f"{self.name}{_labels(self.label, value)} {amount}")
+        return lines
+
+
+class Gauge(Counter):
+    """Значение, которое может уменьшаться"""
+
+    kind = "gauge"
+
+    def dec(self, value=None, amount=1):
+        self._values[value] -= amount
+
+    def set(self, amount, value=None):
+        self._values[value] = amount
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами и необязательной меткой"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets, label=None, values=(None,)):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        # Для каждой серии: счётчики корзин (последняя - +Inf) и сумма наблюдений
+        self._series = {value: [[0] * (len(self.buckets) + 1), 0.0] for value in values}
+
+    def observe(self, amount, value=None):
+        series = self._series[value]
+        series[0][bisect.bisect_left(self.buckets, amount)] += 1
+        series[1] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for value, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.label, value, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label, value)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label, value)} {cumulative}")
+        return lines
+
+
+def _labels(label, value, le=None):
+    """Метки серии в формате Prometheus"""
+    pairs = []
+    if label is not None:
+        pairs.append(f'{label}="{value}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class ServerMetrics:
+    """Метрики сервера чата для маршрута /metrics
+
+    Обновление метрик не берёт блокировок: при одновременном обновлении из
+    нескольких потоков отдельные инкременты могут потеряться, что для
+    мониторинга допустимо и не замедляет обработчики.
+    """
+
+    # События, для которых измеряется время обработки
+    TIMED_EVENTS = ("join", "send_message", "send_direct", "search", "disconnect")
+
+    # Причины отклонения входящих событий
+    REJECTION_REASONS = (
+        "malformed", "not_joined", "username_invalid", "username_taken", "message_invalid",
+        "rate_limited", "broadcast_budget", "room_invalid", "room_limit", "not_in_room",
+        "recipient_offline", "attachment_invalid",
+    )
+
+    def __init__(self):
+        self.handler_seconds = Histogram(
+            "chat_handler_seconds", "Время обработки события сервером",
+            LATENCY_BUCKETS, label="event", values=self.TIMED_EVENTS
+        )
+        self.broadcast_seconds = Histogram(
+            "chat_broadcast_seconds", "Время рассылки события message", LATENCY_BUCKETS
+        )
+        self.broadcast_fanout = Histogram(
+            "chat_broadcast_fanout", "Число получателей рассылки", FANOUT_BUCKETS
+        )
+        self.connected_sids = Gauge("chat_connected_sids", "Подключенные сокеты")
+        self.joined_users = Gauge("chat_joined_users", "Вошедшие в чат пользователи этого процесса")
+        self.messages = Counter("chat_messages_total", "Принятые сообщения пользователей")
+        self.rejections = Counter(
+            "chat_rejections_total", "Отклонённые события по причинам",
+            label="reason", values=self.REJECTION_REASONS
+        )
+        self.outbound_dropped = Counter(
+            "chat_outbound_dropped_total", "Сообщения, отброшенные из-за медленных клиентов"
+        )
+        self.outbound_depth = Gauge("chat_outbound_queue_depth", "Пакеты в исходящих очередях клиентов")
+        self.outbound_depth_max = Gauge(
+            "chat_outbound_queue_depth_max", "Наибольшая глубина исходящей очереди клиента"
+        )
+        self._metrics = (
+            self.handler_seconds, self.broadcast_seconds, self.broadcast_fanout,
+            self.connected_sids, self.joined_users, self.messages, self.rejections,
+            self.outbound_dropped, self.outbound_depth, self.outbound_depth_max,
+        )
+        # Функции, обновляющие метрики перед выдачей (значения, которые дорого вести на горячем пути)
+        self.collectors = []
+
+    def timed(self, event, handler):
+        """Обёртка обработчика, измеряющая время его выполнения"""
+        def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                self.handler_seconds.observe(time.perf_counter() - start, event)
+        return wrapper
+
+    def render(self):
+        """Текст метрик и тип содержимого для HTTP-ответа"""
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n", CONTENT_TYPE
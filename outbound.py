@@ -0,0 +1,106 @@
+import asyncio
+import queue
+
+from engineio import packet as eio_packet
+
+# Политики переполнения исходящей очереди клиента
+DROP_OLDEST = "drop_oldest"   # вытеснять самые старые сообщения
+COALESCE = "coalesce"         # отбрасывать новые и затем отправить отметку "пропущено N"
+DISCONNECT = "disconnect"     # отключить клиента
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class OutboundPolicy:
+    """Ограничение исходящей очереди Engine.IO одного клиента
+
+    Engine.IO складывает пакеты для клиента в очередь сокета, из которой их
+    забирает поток (задача) отправки. Для медленного клиента эта очередь
+    растёт без ограничений. Класс-примесь ограничивает число пакетов-сообщений
+    в ней значением limit и применяет policy при переполнении; служебные
+    пакеты (ping, закрытие) проходят всегда.
+
+    marker(count) - пакет отметки о пропущенных сообщениях (политика coalesce),
+    on_drop() вызывается на каждое отброшенное сообщение,
+    on_overflow(очередь) - при первом переполнении (политика disconnect).
+    """
+
+    def _setup(self, limit, policy, marker, on_drop, on_overflow):
+        self.limit = limit
+        self.policy = policy
+        self.marker = marker
+        self.on_drop = on_drop
+        self.on_overflow = on_overflow
+        self.dropped = 0
+        self.missed = 0
+        self.overflowed = False
+
+    def depth(self):
+        """Текущее число пакетов в очереди"""
+        return len(self._items())
+
+    def _put(self, item):
+        items = self._items()
+        if not self._is_message(item) or len(items) < self.limit:
+            items.append(item)
+            return
+
+        # put() засчитает пакет как незавершённую задачу: выбрасываемый пакет
+        # никто не заберёт, поэтому счётчик уменьшается, иначе join() при
+        # закрытии сокета ждал бы вечно. При drop_oldest выбрасывается
+        # вытесненный пакет, а новый занимает его задачу
+        self._add_tasks(-1)
+        self.dropped += 1
+        self.on_drop()
+        if self.policy == DROP_OLDEST:
+            for index, queued in enumerate(items):
+                if self._is_message(queued):
+                    del items[index]
+                    break
+            items.append(item)
+        elif self.policy == COALESCE:
+            self.missed += 1
+        elif not self.overflowed:
+            self.overflowed = True
+            self.on_overflow(self)
+
+    def _get(self):
+        items = self._items()
+        item = items.popleft()
+        if self.missed and not items:
+            # Клиент разобрал очередь: сообщаем, сколько он пропустил
+            items.append(self.marker(self.missed))
+            self._add_tasks(1)
+            self.missed = 0
+        return item
+
+    @staticmethod
+    def _is_message(item):
+        return item is not None and item.packet_type == eio_packet.MESSAGE
+
+
+class ThreadingOutboundQueue(OutboundPolicy, queue.Queue):
+    """Ограниченная исходящая очередь для режима threading"""
+
+    def __init__(self, limit, policy, marker, on_drop, on_overflow):
+        queue.Queue.__init__(self)
+        self._setup(limit, policy, marker, on_drop, on_overflow)
+
+    def _items(self):
+        return self.queue
+
+    def _add_tasks(self, count):
+        self.unfinished_tasks += count
+
+
+class AsyncOutboundQueue(OutboundPolicy, asyncio.Queue):
+    """Ограниченная исходящая очередь для режима asyncio"""
+
+    def __init__(self, limit, policy, marker, on_drop, on_overflow):
+        asyncio.Queue.__init__(self)
+        self._setup(limit, policy, marker, on_drop, on_overflow)
+
+    def _items(self):
+        return self._queue
+
+    def _add_tasks(self, count):
+        self._unfinished_tasks += count
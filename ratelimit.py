@@ -0,0 +1,116 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Корзина токенов: до burst событий подряд, затем не чаще rate в секунду"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "limited")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+        # Было ли отклонено предыдущее событие (для единственного ответа об ошибке)
+        self.limited = False
+
+    def take(self, now=None):
+        """Попытка потратить токен. Возвращает True, если событие разрешено"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.limited = False
+            return True
+        return False
+
+    def is_full(self, now=None):
+        """Восстановилась ли корзина полностью"""
+        now = time.monotonic() if now is None else now
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Набор корзин токенов по ключу (sid, имя пользователя)
+
+    Проверка - O(1): поиск корзины в словаре и её пополнение по прошедшему
+    времени. Блокировки не используются: при гонке двух событий одного ключа
+    лимит может быть превышен на единицу, что допустимо.
+
+    Корзины отключившихся ключей (release) удаляются, когда заведомо
+    восстановятся - через burst / rate секунд, - поэтому число корзин
+    ограничено активными ключами и отключениями за это время.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        # Освобождённые ключи -> момент удаления корзины, в порядке освобождения
+        self._released = {}
+        self._released_lock = threading.Lock()
+
+    def check(self, key, now=None):
+        """Проверка события по ключу.
+
+        Возвращает (разрешено, первое_отклонение): первое_отклонение истинно
+        только для первого отклонённого события подряд, чтобы отвечать
+        клиенту об ошибке один раз, а остальные события отбрасывать молча.
+        """
+        now = time.monotonic() if now is None else now
+        if self._released:
+            self.purge(now)
+            if key in self._released:
+                # Ключ снова активен (переподключение): корзина больше не удаляется
+                with self._released_lock:
+                    self._released.pop(key, None)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+        if bucket.take(now):
+            return True, False
+        first = not bucket.limited
+        bucket.limited = True
+        return False, first
+
+    def discard(self, key):
+        """Удаление корзины ключа"""
+        self._buckets.pop(key, None)
+        with self._released_lock:
+            self._released.pop(key, None)
+
+    def release(self, key, now=None):
+        """Освобождение корзины ключа при отключении.
+
+        Восстановившаяся корзина удаляется сразу. Неполная остаётся, чтобы
+        переподключение не сбрасывало лимит, и удаляется через burst / rate
+        секунд, если ключ не вернётся раньше.
+        """
+        now = time.monotonic() if now is None else now
+        self.purge(now)
+        bucket = self._buckets.get(key)
+        with self._released_lock:
+            self._released.pop(key, None)
+            if bucket is None:
+                return
+            if bucket.is_full(now):
+                self._buckets.pop(key, None)
+            else:
+                self._released[key] = now + self.burst / self.rate
+
+    def purge(self, now=None):
+        """Удаление корзин освобождённых ключей, которые уже восстановились"""
+        now = time.monotonic() if now is None else now
+        with self._released_lock:
+            # Срок у всех одинаковой длины, поэтому истёкшие - в начале словаря
+            while self._released:
+                key, deadline = next(iter(self._released.items()))
+                if deadline > now:
+                    break
+                del self._released[key]
+                self._buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,143 @@
+"""Запись входящего трафика сервера для воспроизведения (benchmarks/replay.py)
+
+Записываются события connect, join, send_message и disconnect: время от
+начала записи, номер соединения и обезличенные данные. Имена
+пользователей и комнат заменяются на user-N и room-N в порядке появления,
+а текст сообщения - его длиной, поэтому журнал передаёт форму нагрузки
+(кто, когда, куда и сколько пишет), но не содержание переписки.
+
+Формат - строки JSON: заголовок {"format", "version", "started"}, затем
+по строке на событие: [время, соединение, событие] или [время, соединение,
+событие, данные]. Запись в файл выполняет фоновый поток, обработчики
+событий только ставят строку в очередь.
+"""
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+
+FORMAT = "flet-chat-traffic"
+VERSION = 1
+
+RECORDED_EVENTS = ("connect", "join", "send_message", "disconnect")
+
+
+class TrafficRecorder:
+    """Журнал входящих событий сервера с обезличенными именами и текстами"""
+
+    # Период записи накопленных строк на диск (секунды)
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, default_room="general"):
+        """Создание файла журнала и запуск фонового потока записи"""
+        self.logger = logging.getLogger("ChatServer")
+        self.path = path
+        self.default_room = default_room
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write(json.dumps({"format": FORMAT, "version": VERSION, "started": time.time()}) + "\n")
+
+        # Время и номера соединений назначаются под блокировкой, чтобы строки шли по порядку
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._clients = {}  # sid -> номер соединения
+        self._client_numbers = itertools.count(1)
+        # Псевдонимы: имя пользователя (casefold) -> user-N, комната -> room-N (общая комната - как есть)
+        self._users = {}
+        self._rooms = {}
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="TrafficRecorder", daemon=True)
+        self._writer.start()
+
+    def recorded(self, event, handler):
+        """Обёртка обработчика, записывающая событие перед его обработкой"""
+        def wrapper(sid, *args):
+            self.record(event, sid, args[0] if args else None)
+            return handler(sid, *args)
+        return wrapper
+
+    def record(self, event, sid, data=None):
+        """Запись события соединения sid (события других соединений до connect не записываются)"""
+        try:
+            with self._lock:
+                if event == "connect":
+                    client = self._clients[sid] = next(self._client_numbers)
+                elif event == "disconnect":
+                    client = self._clients.pop(sid, None)
+                else:
+                    client = self._clients.get(sid)
+                if client is None:
+                    return
+                entry = [round(time.monotonic() - self._start, 3), client, event]
+                payload = self._anonymize(event, data)
+                if payload is not None:
+                    entry.append(payload)
+                self._queue.put(entry)
+        except Exception as e:
+            self.logger.error("Ошибка записи трафика: %s", e)
+
+    def close(self):
+        """Запись оставшихся строк, остановка потока и закрытие файла"""
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+
+    def _anonymize(self, event, data):
+        """Данные события без имён и текстов; None - для событий без данных"""
+        if event == "join":
+            data = data if isinstance(data, dict) else {}
+            payload = {"username": self._alias(self._users, "user", data.get("username"))}
+            if isinstance(data.get("rooms"), list):
+                payload["rooms"] = [self._room(room) for room in data["rooms"]]
+            elif "room" in data:
+                payload["room"] = self._room(data["room"])
+            return payload
+        if event == "send_message":
+            data = data if isinstance(data, dict) else {}
+            text = data.get("text")
+            return {
+                "room": self._room(data.get("room", self.default_room)),
+                "length": len(text) if isinstance(text, str) else 0,
+            }
+        return None
+
+    def _room(self, room):
+        if isinstance(room, str) and room.strip().casefold() == self.default_room:
+            return self.default_room
+        return self._alias(self._rooms, "room", room)
+
+    @staticmethod
+    def _alias(aliases, prefix, value):
+        """Псевдоним значения: одно и то же значение (без учёта регистра) - один псевдоним"""
+        key = value.strip().casefold() if isinstance(value, str) else None
+        alias = aliases.get(key)
+        if alias is None:
+            alias = aliases[key] = f"{prefix}-{len(aliases) + 1}"
+        return alias
+
+    def _write_loop(self):
+        """Цикл фонового потока: запись строк пачками раз в FLUSH_INTERVAL"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            lines = [json.dumps(entry, ensure_ascii=False, separators=(",", ":")) for entry in batch if entry is not None]
+            try:
+                if lines:
+                    self._file.write("\n".join(lines) + "\n")
+                    self._file.flush()
+            except Exception as e:
+                self.logger.error("Ошибка записи журнала трафика: %s", e)
+            if stop:
+                return
@@ -0,0 +1,237 @@
+import threading
+import unicodedata
+
+
+class UserRegistry:
+    """Двунаправленный реестр sid <-> имя пользователя
+
+    Поиск в обе стороны выполняется за O(1). Имена сравниваются без учёта
+    регистра (после NFKC-нормализации), а резервирование имени атомарно,
+    поэтому два сокета не могут одновременно занять одно имя.
+    Версии списков присутствия ведёт RoomRegistry - отдельно для каждой комнаты.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usernames = {}  # sid -> имя в исходном написании
+        self._sids = {}       # нормализованное имя -> sid
+
+    @staticmethod
+    def normalize(username):
+        """Приведение имени к ключу для сравнения"""
+        return unicodedata.normalize("NFKC", username).casefold()
+
+    def reserve(self, sid, username):
+        """Закрепление имени за sid.
+
+        Возвращает False, если имя занято другим sid. Если у sid было
+        другое имя, оно освобождается.
+        """
+        key = self.normalize(username)
+        with self._lock:
+            owner = self._sids.get(key)
+            if owner is not None and owner != sid:
+                return False
+            previous = self._usernames.get(sid)
+            if previous == username:
+                return True
+            # Освобождаем прежнее имя этого sid, если оно было
+            if previous is not None:
+                self._sids.pop(self.normalize(previous), None)
+            self._usernames[sid] = username
+            self._sids[key] = sid
+            return True
+
+    def release(self, sid):
+        """Освобождение имени, закреплённого за sid. Возвращает имя или None"""
+        with self._lock:
+            username = self._usernames.pop(sid, None)
+            if username is not None:
+                self._sids.pop(self.normalize(username), None)
+            return username
+
+    def snapshot(self):
+        """Список имён всех зарегистрированных пользователей"""
+        with self._lock:
+            return list(self._usernames.values())
+
+    def get_username(self, sid):
+        """Имя пользователя по sid"""
+        return self._usernames.get(sid)
+
+    def get_sid(self, username):
+        """sid пользователя по имени (без учёта регистра)"""
+        return self._sids.get(self.normalize(username))
+
+    def __contains__(self, username):
+        return self.normalize(username) in self._sids
+
+    def __len__(self):
+        return len(self._usernames)
+
+
+class SharedUserRegistry:
+    """Реестр пользователей, общий для всех процессов кластера
+
+    Интерфейс совпадает с UserRegistry. Резервирование, освобождение и поиск
+    по имени выполняются концентратором кластера (cluster.ClusterHub), поэтому
+    уникальность имён соблюдается между процессами. Имена своих sid
+    дополнительно хранятся локально, чтобы get_username не обращался к сети.
+    """
+
+    def __init__(self, hub):
+        self._hub = hub
+        self._usernames = {}  # sid этого процесса -> имя
+
+    normalize = staticmethod(UserRegistry.normalize)
+
+    def reserve(self, sid, username):
+        """Закрепление имени за sid в кластере"""
+        reserved = self._hub.call("reserve", sid, username)
+        if reserved:
+            self._usernames[sid] = username
+        return reserved
+
+    def release(self, sid):
+        """Освобождение имени sid в кластере"""
+        if self._usernames.pop(sid, None) is None:
+            return None
+        return self._hub.call("release", sid)
+
+    def snapshot(self):
+        """Список всех пользователей кластера"""
+        return self._hub.call("snapshot")
+
+    def get_username(self, sid):
+        """Имя пользователя по sid этого процесса"""
+        return self._usernames.get(sid)
+
+    def get_sid(self, username):
+        """sid пользователя по имени (в любом процессе кластера)"""
+        return self._hub.call("lookup", username)
+
+    def __contains__(self, username):
+        return self.get_sid(username) is not None
+
+    def __len__(self):
+        return self._hub.call("count")
+
+
+class RoomRegistry:
+    """Индекс комнат: комната -> участники (sid -> имя) и sid -> комнаты
+
+    Вход, выход и проверка участия выполняются за O(1), список участников
+    комнаты строится без обхода остальных комнат. У каждой комнаты своя
+    версия списка участников; опустевшая комната удаляется вместе с версией -
+    следующий вошедший всё равно получает полный снимок.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = {}   # комната -> {sid: имя}
+        self._rooms = {}     # sid -> множество комнат
+        self._versions = {}  # комната -> версия списка участников
+
+    def join(self, room, sid, username):
+        """Вход sid в комнату. Возвращает версию списка комнаты или None, если sid уже в ней"""
+        with self._lock:
+            members = self._members.setdefault(room, {})
+            if sid in members:
+                return None
+            members[sid] = username
+            self._rooms.setdefault(sid, set()).add(room)
+            return self._bump(room)
+
+    def leave(self, room, sid):
+        """Выход sid из комнаты. Возвращает версию списка комнаты или None, если sid не в ней"""
+        with self._lock:
+            return self._leave(room, sid)
+
+    def leave_all(self, sid):
+        """Выход sid из всех комнат. Возвращает список пар (комната, версия)"""
+        with self._lock:
+            rooms = list(self._rooms.get(sid, ()))
+            return [(room, self._leave(room, sid)) for room in rooms]
+
+    def snapshot(self, room):
+        """Имена участников комнаты и версия списка"""
+        with self._lock:
+            return list(self._members.get(room, {}).values()), self._versions.get(room, 0)
+
+    def rooms_of(self, sid):
+        """Комнаты, в которых состоит sid"""
+        return set(self._rooms.get(sid, ()))
+
+    def is_member(self, room, sid):
+        """Состоит ли sid в комнате"""
+        return room in self._rooms.get(sid, ())
+
+    def count(self, room):
+        """Число участников комнаты"""
+        return len(self._members.get(room, ()))
+
+    def _bump(self, room):
+        self._versions[room] = self._versions.get(room, 0) + 1
+        return self._versions[room]
+
+    def _leave(self, room, sid):
+        members = self._members.get(room)
+        if members is None or members.pop(sid, None) is None:
+            return None
+        rooms = self._rooms[sid]
+        rooms.discard(room)
+        if not rooms:
+            del self._rooms[sid]
+        version = self._bump(room)
+        if not members:
+            del self._members[room]
+            del self._versions[room]
+        return version
+
+
+class SharedRoomRegistry:
+    """Индекс комнат, общий для всех процессов кластера
+
+    Интерфейс совпадает с RoomRegistry. Списки участников и их версии хранит
+    концентратор кластера; комнаты своих sid и число их участников в этом
+    процессе хранятся локально, чтобы проверка участия и подсчёт получателей
+    рассылки не обращались к сети.
+    """
+
+    def __init__(self, hub):
+        self._hub = hub
+        self._local = RoomRegistry()
+
+    def join(self, room, sid, username):
+        """Вход sid в комнату кластера"""
+        if self._local.join(room, sid, username) is None:
+            return None
+        return self._hub.call("room_join", room, sid, username)
+
+    def leave(self, room, sid):
+        """Выход sid из комнаты кластера"""
+        if self._local.leave(room, sid) is None:
+            return None
+        return self._hub.call("room_leave", room, sid)
+
+    def leave_all(self, sid):
+        """Выход sid из всех комнат кластера"""
+        if not self._local.leave_all(sid):
+            return []
+        return self._hub.call("room_leave_all", sid)
+
+    def snapshot(self, room):
+        """Участники комнаты во всём кластере и версия списка"""
+        return self._hub.call("room_snapshot", room)
+
+    def rooms_of(self, sid):
+        """Комнаты sid этого процесса"""
+        return self._local.rooms_of(sid)
+
+    def is_member(self, room, sid):
+        """Состоит ли sid этого процесса в комнате"""
+        return self._local.is_member(room, sid)
+
+    def count(self, room):
+        """Число участников комнаты в этом процессе"""
+        return self._local.count(room)
@@ -0,0 +1,131 @@
+import array
+import bisect
+import re
+import threading
+
+from registry import UserRegistry
+
+# Слово - последовательность букв (любого алфавита), цифр и "_"
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Различные слова текста в нормализованном виде: casefold и ё -> е"""
+    return list(dict.fromkeys(TOKEN_PATTERN.findall(text.casefold().replace("ё", "е"))))
+
+
+def _contains(docs, doc, start, stop):
+    """Есть ли номер doc в отсортированном срезе docs[start:stop]"""
+    position = bisect.bisect_left(docs, doc, start, stop)
+    return position < stop and docs[position] == doc
+
+
+def _intersect(lists, end, window=4096):
+    """Номера меньше end, входящие во все отсортированные списки lists, по убыванию.
+
+    Списки пересекаются окнами номеров от конца к началу: срезы окна
+    находятся двоичным поиском и пересекаются как множества (или, если
+    кандидатов мало, кандидаты ищутся в срезе двоичным поиском), окно
+    удваивается, пока совпадений не хватает, а участки, где в каком-либо
+    списке нет номеров, пропускаются. Так и частые слова, и редкие
+    сочетания обрабатываются без перебора каждого номера в Python.
+    """
+    lists = sorted(lists, key=len)
+    high = end
+    while high > 0:
+        # Окно начинается с наименьшего из последних номеров списков: выше него совпадений нет
+        stops = []
+        for docs in lists:
+            stop = bisect.bisect_left(docs, high)
+            if stop == 0:
+                return
+            high = min(high, docs[stop - 1] + 1)
+            stops.append(stop)
+        low = max(0, high - window)
+        found = lists[0][bisect.bisect_left(lists[0], low, 0, stops[0]):stops[0]]
+        for docs, stop in zip(lists[1:], stops[1:]):
+            start = bisect.bisect_left(docs, low, 0, stop)
+            if stop - start > 16 * len(found):
+                # Мало кандидатов при длинном срезе: проверяем каждый двоичным поиском
+                found = [doc for doc in found if _contains(docs, doc, start, stop)]
+            else:
+                found = set(found).intersection(docs[start:stop])
+            if not found:
+                break
+        yield from sorted(found, reverse=True)
+        high = low
+        window *= 2
+
+
+class SearchIndex:
+    """Обратный индекс сообщений в памяти: слово -> номера сообщений
+
+    Сообщения добавляются в порядке возрастания id и получают номера по
+    порядку, поэтому каждый список номеров (слова, комнаты, автора) уже
+    отсортирован и пополняется добавлением в конец. Списки хранятся в
+    array - 4 байта на вхождение. Поиск пересекает списки всех условий
+    окнами с конца, так что стоимость запроса зависит от числа совпадений
+    и редкости условий, а не от размера истории.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = array.array("q")   # номер -> id сообщения
+        self._ts = array.array("d")    # номер -> время сообщения
+        self._postings = {}            # слово -> номера сообщений
+        self._room_postings = {}       # комната -> номера сообщений
+        self._user_postings = {}       # имя автора (UserRegistry.normalize) -> номера сообщений
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, message):
+        """Добавление сообщения (id должен быть больше id всех добавленных)
+
+        Слова имени файла вложения индексируются вместе со словами текста.
+        """
+        text = message["text"]
+        if message.get("attachment"):
+            text = f"{text} {message['attachment']['name']}"
+        tokens = tokenize(text)
+        with self._lock:
+            doc = len(self._ids)
+            self._ids.append(message["id"])
+            self._ts.append(message["ts"])
+            for postings, key in (
+                *((self._postings, token) for token in tokens),
+                (self._room_postings, message["room"]),
+                (self._user_postings, UserRegistry.normalize(message["username"])),
+            ):
+                docs = postings.get(key)
+                if docs is None:
+                    docs = postings[key] = array.array("i")
+                docs.append(doc)
+
+    def search(self, query, room, username=None, since=None, until=None, before_id=None, limit=20):
+        """Поиск сообщений комнаты, содержащих все слова query, от новых к старым.
+
+        username - только сообщения этого автора (имена сравниваются как в UserRegistry),
+        since/until - границы времени сообщения, before_id - продолжение
+        выдачи после последнего полученного id. Возвращает (список id, есть ли ещё).
+        """
+        tokens = tokenize(query)
+        if not tokens and username is None:
+            return [], False
+        with self._lock:
+            lists = [self._postings.get(token) for token in tokens]
+            lists.append(self._room_postings.get(room))
+            if username is not None:
+                lists.append(self._user_postings.get(UserRegistry.normalize(username)))
+            if any(docs is None for docs in lists):
+                return [], False
+            end = len(self._ids) if before_id is None else bisect.bisect_left(self._ids, before_id)
+            found = []
+            for doc in _intersect(lists, end):
+                ts = self._ts[doc]
+                if (since is not None and ts < since) or (until is not None and ts > until):
+                    continue
+                if len(found) == limit:
+                    return found, True
+                found.append(self._ids[doc])
+            return found, False
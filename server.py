@@ -1,7 +1,24 @@
-from flask import Flask, request
-from flask_socketio import SocketIO, emit
+import argparse
+import collections
+import json
 import logging
-import sys
+import os
+import re
+import threading
+import time
+import uuid
+
+import logpipe
+from attachments import AttachmentStore
+from engines import ENGINES
+from history import DEFAULT_ROOM, HistoryStore
+from metrics import ServerMetrics
+from outbound import COALESCE, POLICIES
+from ratelimit import RateLimiter, TokenBucket
+from recorder import TrafficRecorder
+from registry import RoomRegistry, SharedRoomRegistry, SharedUserRegistry, UserRegistry
+from search import SearchIndex
+
 
 class ChatServer:
     """Класс управления серверной частью чата"""
@@ -10,149 +27,1003 @@ class ChatServer:
     MAX_MESSAGE_LENGTH = 1000
     MAX_USERNAME_LENGTH = 50
     
-    def __init__(self, host="0.0.0.0", port=4000, debug=False):
-        """Инициализация сервера чата"""
+    # Комнаты чата: имя из букв, цифр, "_" и "-" (без учёта регистра).
+    # Клиенты, не указывающие комнату, попадают в DEFAULT_ROOM
+    DEFAULT_ROOM = DEFAULT_ROOM
+    ROOM_PATTERN = re.compile(r"[\w-]{1,32}")
+    MAX_ROOMS_PER_USER = 20
+    # Префикс комнат Socket.IO, соответствующих комнатам чата
+    ROOM_PREFIX = "room:"
+    
+    # Количество последних рассылок, хранимых для досылки после переподключения
+    RESUME_BUFFER_SIZE = 1000
+    
+    # Настройки истории сообщений
+    HISTORY_ON_JOIN = 50        # сообщений, отправляемых при входе
+    MAX_HISTORY_PAGE = 100      # максимальный размер страницы по запросу клиента
+    
+    # Настройки поиска по истории
+    SEARCH_PAGE = 20            # результатов на страницу по умолчанию
+    MAX_SEARCH_PAGE = 50        # максимальный размер страницы результатов
+    MAX_QUERY_LENGTH = 200
+    
+    # Ссылка на вложение в сообщении: имя файла и MIME-тип
+    MAX_ATTACHMENT_NAME = 255
+    MAX_MIME_LENGTH = 100
+    
+    # Ограничение частоты send_message (сообщений в секунду и допустимая серия подряд)
+    MESSAGE_RATE = 5.0          # на сокет и на имя пользователя
+    MESSAGE_BURST = 10
+    BROADCAST_RATE = 200.0      # общий бюджет рассылок сообщений сервера
+    BROADCAST_BURST = 400
+    # Отвечать ли ошибкой на первое отклонённое сообщение серии (остальные отбрасываются молча)
+    RATE_LIMIT_NOTIFY = True
+    
+    # Эфемерные события (набор текста, прочтение) - событие ephemeral, не сохраняются и не досылаются
+    TYPING_INTERVAL = 3.0       # не больше одного события "печатает" от пользователя за столько секунд
+    READ_SUMMARY_INTERVAL = 2.0 # период сводок прочтения по комнатам (секунды)
+    
+    # Максимум сообщений в исходящей очереди одного клиента
+    OUTBOUND_QUEUE_LIMIT = 256
+    
+    # Максимум событий в одной пачке message_batch (при включённом batch_interval)
+    BATCH_MAX_EVENTS = 100
+    
+    # Выборка частых записей лога: категория -> N (выводится одна запись из N)
+    LOG_SAMPLING = {}
+    
+    def __init__(self, host="0.0.0.0", port=4000, debug=False, history_path="chat_history.db",
+                 engine="threading", cluster=None, rate_limit=True, outbound_policy=COALESCE,
+                 batch_interval=None, log_json=False, log_sampling=None, attachments_path="attachments",
+                 record_path=None):
+        """Инициализация сервера чата
+        
+        engine - транспорт: "threading" (Flask + Flask-SocketIO) или
+        "asyncio" (python-socketio AsyncServer + aiohttp).
+        cluster - путь к UNIX-сокету концентратора кластера (cluster.py);
+        если задан, процесс работает как один из серверов кластера.
+        rate_limit - ограничивать ли частоту сообщений (отключается для бенчмарков).
+        outbound_policy - что делать при переполнении исходящей очереди клиента:
+        "drop_oldest", "coalesce" (отметка "пропущено N") или "disconnect".
+        batch_interval - окно объединения рассылок в пачки message_batch (секунды);
+        None - каждая рассылка отправляется отдельным событием message.
+        log_json - выводить лог строками JSON; log_sampling - частоты выборки
+        частых записей по категориям ("connect", "disconnect"), по умолчанию LOG_SAMPLING.
+        attachments_path - каталог хранилища вложений (в кластере общий для процессов).
+        record_path - файл журнала входящего трафика для benchmarks/replay.py
+        (connect, join, send_message, disconnect с обезличенными именами и текстами).
+        """
         # Настройка логирования
-        self._setup_logging()
+        self._setup_logging(log_json, self.LOG_SAMPLING if log_sampling is None else log_sampling)
         
-        # Создание и настройка Flask и SocketIO
-        self.app = Flask(__name__)
-        self.socketio = SocketIO(self.app, cors_allowed_origins="*")
         self.host = host
         self.port = port
         self.debug = debug
         
-        # Список для хранения подключенных пользователей
-        self.users = {}
+        # Блокировки: presence_lock упорядочивает изменения списка пользователей,
+        # broadcast_lock - рассылки сообщений
+        self.presence_lock = threading.RLock()
+        self.broadcast_lock = threading.RLock()
+        
+        # Поток рассылок: порядковые номера и буфер последних событий для досылки.
+        # stream_id меняется при перезапуске, чтобы клиенты сбросили номер;
+        # досылка возможна только для номеров после evicted_seq
+        self.seq = 0
+        self.evicted_seq = 0
+        self.recent_broadcasts = collections.deque(maxlen=self.RESUME_BUFFER_SIZE)
+        
+        if cluster:
+            # Реестр имён и порядок рассылок общие для всех процессов кластера
+            from cluster import HubConnection, HubManager
+            if engine != "threading":
+                raise ValueError("Кластерный режим поддерживается только для engine='threading'")
+            if batch_interval:
+                raise ValueError("Пачки рассылок в кластерном режиме не поддерживаются")
+            self.cluster = HubConnection(cluster)
+            self.users = SharedUserRegistry(self.cluster)
+            self.rooms = SharedRoomRegistry(self.cluster)
+            client_manager = HubManager(
+                self.cluster, "message", self.ROOM_PREFIX, self._record_broadcast, self.broadcast_lock
+            )
+        else:
+            self.cluster = None
+            # Реестр подключенных пользователей (sid <-> имя) и индекс комнат (комната <-> sid)
+            self.users = UserRegistry()
+            self.rooms = RoomRegistry()
+            client_manager = None
+        
+        # Создание транспорта: self.app - Flask или aiohttp приложение
+        self.engine = ENGINES[engine](client_manager=client_manager)
+        self.app = self.engine.app
+        self.socketio = self.engine.socketio
+        
+        if self.cluster:
+            self.stream_id = self.cluster.stream_id
+            self.seq = self.evicted_seq = client_manager.start_offset
+        else:
+            self.stream_id = uuid.uuid4().hex
+        
+        # Хранилище истории сообщений
+        self.history = HistoryStore(history_path)
+        
+        # Обратный индекс для поиска по истории: строится из базы и пополняется новыми сообщениями
+        self.search_index = SearchIndex()
+        self._build_search_index()
+        
+        # Вложения: загрузка кусками через upload_start/upload_chunk, скачивание - GET /attachments/<хэш>
+        self.attachments = AttachmentStore(attachments_path)
+        self.engine.add_file_route("/attachments", self.attachments.path)
+        
+        # Ограничители частоты сообщений: по sid, по имени и общий бюджет рассылок
+        self.rate_limit = rate_limit
+        self.sid_limiter = RateLimiter(self.MESSAGE_RATE, self.MESSAGE_BURST)
+        self.user_limiter = RateLimiter(self.MESSAGE_RATE, self.MESSAGE_BURST)
+        self.broadcast_budget = TokenBucket(self.BROADCAST_RATE, self.BROADCAST_BURST)
+        
+        # Метрики для Prometheus: GET /metrics
+        self.metrics = ServerMetrics()
+        self.engine.add_route("/metrics", self.metrics.render)
+        
+        # Ограниченные исходящие очереди: медленный клиент не копит буферы сервера
+        self.engine.limit_outbound(
+            self.OUTBOUND_QUEUE_LIMIT, outbound_policy, self._missed_marker, self.metrics.outbound_dropped.inc
+        )
+        self.metrics.collectors.append(self._collect_outbound)
+        self.engine.add_route("/outbound", self._outbound_report)
+        
+        # Пачки рассылок: события окна batch_interval уходят одним message_batch на комнату
+        self.batch_interval = batch_interval
+        self.pending_batch = {}  # комната -> события
+        self.pending_count = 0
+        self.batch_ready = threading.Condition(self.broadcast_lock)
+        if batch_interval:
+            threading.Thread(target=self._batch_loop, name="BroadcastBatcher", daemon=True).start()
+        
+        # Эфемерные события: ограничитель "печатает" по имени и отметки прочтения до очередной сводки
+        self.typing_limiter = RateLimiter(1 / self.TYPING_INTERVAL, 1)
+        self.pending_reads = {}  # комната -> {имя: id последнего прочитанного сообщения}
+        self.reads_lock = threading.Lock()
+        # Поток сводок запускается в run() и останавливается при его завершении
+        self.stopped = threading.Event()
+        
+        # Запись входящего трафика для воспроизведения
+        self.recorder = TrafficRecorder(record_path, self.DEFAULT_ROOM) if record_path else None
         
         # Регистрация обработчиков событий SocketIO
         self._register_handlers()
         
-    def _setup_logging(self):
-        """Настройка логирования"""
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[logging.StreamHandler(sys.stdout)]
-        )
+    def _setup_logging(self, json_format=False, sampling=None):
+        """Настройка логирования: запись в stdout из фонового потока (logpipe)"""
+        logpipe.setup(json_format=json_format, sampling=sampling)
         self.logger = logging.getLogger("ChatServer")
         
     def _register_handlers(self):
         """Регистрация обработчиков событий SocketIO"""
-        @self.socketio.on("connect")
-        def handle_connect():
-            self._handle_connect()
-            
-        @self.socketio.on("join")
-        def handle_join(data):
-            self._handle_join(data)
-            
-        @self.socketio.on("send_message")
-        def handle_message(data):
-            self._handle_message(data)
-            
-        @self.socketio.on("disconnect")
-        def handle_disconnect():
-            self._handle_disconnect()
+        timed = self.metrics.timed
+        # В режиме записи события RECORDED_EVENTS попадают в журнал до обработки
+        record = self.recorder.recorded if self.recorder else lambda event, handler: handler
+        self.engine.on("connect", record("connect", self._handle_connect))
+        self.engine.on("join", record("join", timed("join", self._handle_join)))
+        self.engine.on("send_message", record("send_message", timed("send_message", self._handle_message)))
+        self.engine.on("send_direct", timed("send_direct", self._handle_direct))
+        self.engine.on("join_room", self._handle_join_room)
+        self.engine.on("leave_room", self._handle_leave_room)
+        self.engine.on("sync_users", self._handle_sync_users)
+        self.engine.on("load_history", self._handle_load_history)
+        self.engine.on("search", timed("search", self._handle_search))
+        self.engine.on("upload_start", self._handle_upload_start)
+        self.engine.on("upload_chunk", self._handle_upload_chunk)
+        self.engine.on("typing", self._handle_typing)
+        self.engine.on("read", self._handle_read)
+        self.engine.on("disconnect", record("disconnect", timed("disconnect", self._handle_disconnect)))
     
-    def _handle_connect(self):
+    def _handle_connect(self, sid):
         """Обработка подключения клиента"""
-        client_id = request.sid
-        self.logger.info(f"Клиент подключился: {client_id}")
+        self.metrics.connected_sids.inc()
+        self.logger.info("Клиент подключился: %s", sid, extra={"category": "connect"})
     
-    def _handle_join(self, data):
-        """Обработка присоединения пользователя к чату"""
+    def _handle_join(self, sid, data):
+        """Обработка присоединения пользователя к чату и к комнатам room/rooms"""
         try:
             if not isinstance(data, dict) or "username" not in data:
+                self.metrics.rejections.inc("malformed")
                 return
             
             username = data["username"].strip()
             
-            # Валидация имени пользователя
-            if not self._validate_username(username):
+            # Валидация имени пользователя и комнат
+            if not self._validate_username(sid, username):
                 return
-                
-            # Проверка уникальности имени
-            if username in self.users.values():
-                # Отправляем только этому клиенту сообщение об ошибке
-                emit("message", {"type": "error", "text": "Это имя уже используется. Пожалуйста, выберите другое."})
+            rooms = data.get("rooms", [data.get("room", self.DEFAULT_ROOM)])
+            if not isinstance(rooms, list) or not rooms:
+                self.metrics.rejections.inc("malformed")
                 return
-                
-            # Связываем сессию с именем пользователя
-            self.users[request.sid] = username
+            rooms = [self._parse_room(room) for room in rooms[:self.MAX_ROOMS_PER_USER]]
+            if None in rooms:
+                self._reject_room(sid)
+                return
+            rooms = list(dict.fromkeys(rooms))
             
-            # Отправляем сообщение всем о новом пользователе
-            emit("message", {"type": "join", "username": username}, broadcast=True)
+            # История читается до блокировок: чтение может ждать записи на диск.
+            # Если досылка, скорее всего, будет полной, история не понадобится
+            last_seq = data.get("last_seq")
+            resumable = (
+                data.get("stream") == self.stream_id and isinstance(last_seq, int)
+                and self.evicted_seq <= last_seq <= self.seq
+            )
+            pages = None if resumable else self._prefetch_history(rooms, data.get("since"))
+                
+            left = []
+            with self.presence_lock:
+                previous = self.users.get_username(sid)
+                
+                # Проверка уникальности имени и связывание сессии с именем
+                if not self.users.reserve(sid, username):
+                    self.metrics.rejections.inc("username_taken")
+                    # Отправляем только этому клиенту сообщение об ошибке
+                    self.engine.emit("message", {"type": "error", "text": "Это имя уже используется. Пожалуйста, выберите другое."}, to=sid)
+                    return
+                
+                if previous is None:
+                    self.metrics.joined_users.inc()
+                
+                # Повторный вход под другим именем: прежнее имя уходит из всех комнат
+                if previous is not None and previous != username:
+                    left = self.rooms.leave_all(sid)
+                    for room, room_version in left:
+                        self.engine.leave_room(sid, self._room_key(room))
+                        self._update_user_list(room, "presence_remove", previous, room_version, skip_sid=sid)
+                
+                # Вход в комнаты и досылка пропущенного атомарны относительно рассылок:
+                # каждое событие придёт клиенту ровно один раз
+                joined = []
+                with self.broadcast_lock:
+                    for room in rooms:
+                        room_version = self.rooms.join(room, sid, username)
+                        if room_version is not None:
+                            self.engine.enter_room(sid, self._room_key(room))
+                            joined.append((room, room_version))
+                    self._send_resume(sid, last_seq, data.get("stream"), rooms, data.get("since"), pages)
+                
+                # Отправляем новому пользователю полные списки участников его комнат,
+                # остальным - только изменение
+                for room, room_version in joined:
+                    self._send_user_snapshot(sid, room)
+                    self._update_user_list(room, "presence_add", username, room_version, skip_sid=sid)
             
-            # Отправляем новому пользователю список активных пользователей
-            self._update_user_list()
+            # Прежнее имя уходит из комнат так же, как при отключении
+            for room, _ in left:
+                self._broadcast_message(room, {"type": "leave", "username": previous})
+            # Сообщаем участникам комнат о новом пользователе
+            for room, _ in joined:
+                self._broadcast_message(room, {"type": "join", "username": username})
             
         except Exception as e:
-            self.logger.error(f"Ошибка при подключении пользователя: {e}")
+            self.logger.error("Ошибка при подключении пользователя: %s", e)
     
-    def _validate_username(self, username):
+    def _validate_username(self, sid, username):
         """Проверка валидности имени пользователя"""
         if not username or len(username) > self.MAX_USERNAME_LENGTH:
-            emit("message", {"type": "error", "text": f"Имя пользователя должно быть не пустым и не длиннее {self.MAX_USERNAME_LENGTH} символов"})
+            self.metrics.rejections.inc("username_invalid")
+            self.engine.emit("message", {"type": "error", "text": f"Имя пользователя должно быть не пустым и не длиннее {self.MAX_USERNAME_LENGTH} символов"}, to=sid)
             return False
         return True
     
-    def _handle_message(self, data):
+    def _parse_room(self, room):
+        """Нормализованное имя комнаты или None, если имя недопустимо"""
+        if not isinstance(room, str):
+            return None
+        room = room.strip().casefold()
+        return room if self.ROOM_PATTERN.fullmatch(room) else None
+    
+    def _reject_room(self, sid):
+        """Ответ клиенту на недопустимое имя комнаты"""
+        self.metrics.rejections.inc("room_invalid")
+        self.engine.emit("message", {"type": "error", "text": "Имя комнаты может содержать только буквы, цифры, _ и - (до 32 символов)"}, to=sid)
+    
+    def _room_key(self, room):
+        """Комната Socket.IO для комнаты чата"""
+        return self.ROOM_PREFIX + room
+    
+    def _handle_join_room(self, sid, data):
+        """Вход вошедшего пользователя в ещё одну комнату: история, участники, уведомление"""
+        try:
+            if not isinstance(data, dict) or "room" not in data:
+                self.metrics.rejections.inc("malformed")
+                return
+            username = self.users.get_username(sid)
+            if not username:
+                self.metrics.rejections.inc("not_joined")
+                return
+            room = self._parse_room(data["room"])
+            if room is None:
+                self._reject_room(sid)
+                return
+            since = data.get("since")
+            pages = self._prefetch_history([room], {room: since} if isinstance(since, int) else None)
+            
+            with self.presence_lock:
+                if len(self.rooms.rooms_of(sid)) >= self.MAX_ROOMS_PER_USER:
+                    self.metrics.rejections.inc("room_limit")
+                    self.engine.emit("message", {"type": "error", "text": f"Можно состоять не более чем в {self.MAX_ROOMS_PER_USER} комнатах"}, to=sid)
+                    return
+                # Вход в комнату и страница истории атомарны относительно рассылок
+                with self.broadcast_lock:
+                    version = self.rooms.join(room, sid, username)
+                    if version is None:
+                        return
+                    self.engine.enter_room(sid, self._room_key(room))
+                    self._send_prefetched_history(sid, room, pages[room])
+                self._send_user_snapshot(sid, room)
+                self._update_user_list(room, "presence_add", username, version, skip_sid=sid)
+            
+            self._broadcast_message(room, {"type": "join", "username": username})
+        except Exception as e:
+            self.logger.error("Ошибка при входе в комнату: %s", e)
+    
+    def _handle_leave_room(self, sid, data):
+        """Выход пользователя из комнаты"""
+        try:
+            if not isinstance(data, dict):
+                self.metrics.rejections.inc("malformed")
+                return
+            username = self.users.get_username(sid)
+            room = self._parse_room(data.get("room"))
+            if not username or room is None:
+                return
+            
+            with self.presence_lock:
+                version = self.rooms.leave(room, sid)
+                if version is None:
+                    return
+                self.engine.leave_room(sid, self._room_key(room))
+                self._update_user_list(room, "presence_remove", username, version)
+            
+            self._broadcast_message(room, {"type": "leave", "username": username})
+        except Exception as e:
+            self.logger.error("Ошибка при выходе из комнаты: %s", e)
+    
+    def _handle_message(self, sid, data):
         """Обработка сообщений пользователя"""
         try:
             if not isinstance(data, dict) or "text" not in data:
+                self.metrics.rejections.inc("malformed")
                 return
                 
-            username = self.users.get(request.sid)
+            username = self.users.get_username(sid)
             if not username:
+                self.metrics.rejections.inc("not_joined")
+                return
+            
+            # Писать можно только в комнату, в которой состоишь
+            room = self._parse_room(data.get("room", self.DEFAULT_ROOM))
+            if room is None or not self.rooms.is_member(room, sid):
+                self.metrics.rejections.inc("not_in_room")
+                self.engine.emit("message", {"type": "error", "text": "Вы не состоите в этой комнате"}, to=sid)
                 return
                 
-            # Валидация текста сообщения
+            # Валидация текста сообщения и вложения (с вложением текст может быть пустым)
+            attachment = self._parse_attachment(sid, data.get("attachment"))
+            if attachment is False:
+                return
             message_text = data["text"].strip()
-            if not self._validate_message(message_text):
+            if not self._validate_message(sid, message_text, attachment):
+                return
+            
+            # Ограничение частоты до рассылки: каждое сообщение - это N отправок
+            if self.rate_limit and not self._check_rate(sid, username):
                 return
+            self.metrics.messages.inc()
                 
-            # Отправляем сообщение всем клиентам
-            emit("message", {
+            # Отправляем сообщение участникам комнаты (id в истории назначается при рассылке)
+            payload = {
                 "type": "message", 
                 "username": username, 
                 "text": message_text
-            }, broadcast=True)
+            }
+            if attachment:
+                payload["attachment"] = attachment
+            self._broadcast_message(room, payload)
+            
+        except Exception as e:
+            self.logger.error("Ошибка при отправке сообщения: %s", e)
+    
+    def _handle_direct(self, sid, data):
+        """Личное сообщение: доставка только сокету получателя и эхо отправителю"""
+        try:
+            if not isinstance(data, dict) or "text" not in data or not isinstance(data.get("to"), str):
+                self.metrics.rejections.inc("malformed")
+                return
+            
+            username = self.users.get_username(sid)
+            if not username:
+                self.metrics.rejections.inc("not_joined")
+                return
+            
+            attachment = self._parse_attachment(sid, data.get("attachment"))
+            if attachment is False:
+                return
+            message_text = data["text"].strip()
+            if not self._validate_message(sid, message_text, attachment):
+                return
+            
+            # Поиск получателя по имени за O(1) (в кластере - в любом процессе)
+            recipient = data["to"].strip()
+            target_sid = self.users.get_sid(recipient)
+            if target_sid is None:
+                self.metrics.rejections.inc("recipient_offline")
+                self.engine.emit("message", {"type": "error", "text": f"Пользователь {recipient} не в сети"}, to=sid)
+                return
+            
+            if self.rate_limit and not self._check_rate(sid, username):
+                return
+            self.metrics.messages.inc()
             
+            # Личные сообщения не сохраняются в истории и не получают seq
+            payload = {
+                "type": "direct",
+                "from": username,
+                "to": self.users.get_username(target_sid) or recipient,
+                "text": message_text,
+                "ts": time.time()
+            }
+            if attachment:
+                payload["attachment"] = attachment
+            self.engine.emit("message", payload, to=[target_sid] if target_sid == sid else [target_sid, sid])
+            
+        except Exception as e:
+            self.logger.error("Ошибка при отправке личного сообщения: %s", e)
+    
+    def _validate_message(self, sid, message_text, attachment=None):
+        """Проверка валидности сообщения (текст сообщения с вложением может быть пустым)"""
+        if (not message_text and not attachment) or len(message_text) > self.MAX_MESSAGE_LENGTH:
+            self.metrics.rejections.inc("message_invalid")
+            self.engine.emit("message", {"type": "error", "text": f"Сообщение должно быть не пустым и не длиннее {self.MAX_MESSAGE_LENGTH} символов"}, to=sid)
+            return False
+        return True
+    
+    def _parse_attachment(self, sid, value):
+        """Проверка ссылки на вложение в сообщении.
+        
+        Возвращает None без вложения, нормализованную ссылку {"hash", "name",
+        "size", "mime"} для загруженного файла или False (ошибка уже отправлена).
+        """
+        if value is None:
+            return None
+        error = None
+        if not isinstance(value, dict) or not isinstance(value.get("name"), str):
+            error = "Некорректное вложение"
+        else:
+            size = self.attachments.size(value.get("hash"))
+            name = os.path.basename(value["name"].replace("\\", "/")).strip()
+            mime = value.get("mime") or "application/octet-stream"
+            if size is None or value.get("size") != size:
+                error = "Вложение не загружено"
+            elif not name or len(name) > self.MAX_ATTACHMENT_NAME:
+                error = f"Имя файла должно быть не пустым и не длиннее {self.MAX_ATTACHMENT_NAME} символов"
+            elif not isinstance(mime, str) or len(mime) > self.MAX_MIME_LENGTH:
+                error = "Некорректный тип вложения"
+        if error:
+            self.metrics.rejections.inc("attachment_invalid")
+            self.engine.emit("message", {"type": "error", "text": error}, to=sid)
+            return False
+        return {"hash": value["hash"], "name": name, "size": size, "mime": mime}
+    
+    def _handle_upload_start(self, sid, data):
+        """Начало (или продолжение) загрузки вложения: ответ {"offset"} - с какого байта передавать"""
+        try:
+            if not self.users.get_username(sid):
+                self.metrics.rejections.inc("not_joined")
+                return {"error": "Сначала войдите в чат"}
+            if not isinstance(data, dict):
+                self.metrics.rejections.inc("malformed")
+                return {"error": "Некорректный запрос"}
+            return {"offset": self.attachments.begin(data.get("hash"), data.get("size"), sid)}
+        except ValueError as e:
+            self.metrics.rejections.inc("attachment_invalid")
+            return {"error": f"Вложение отклонено: {e}"}
+        except Exception as e:
+            self.logger.error("Ошибка при начале загрузки вложения: %s", e)
+            return {"error": "Ошибка сервера"}
+    
+    def _handle_upload_chunk(self, sid, data):
+        """Кусок загружаемого вложения: ответ {"offset"} - смещение следующего куска"""
+        try:
+            if not self.users.get_username(sid):
+                self.metrics.rejections.inc("not_joined")
+                return {"error": "Сначала войдите в чат"}
+            if not isinstance(data, dict) or not isinstance(data.get("data"), bytes):
+                self.metrics.rejections.inc("malformed")
+                return {"error": "Некорректный запрос"}
+            offset = self.attachments.write(
+                data.get("hash"), data.get("size"), data.get("offset"), data["data"], sid
+            )
+            return {"offset": offset}
+        except ValueError as e:
+            self.metrics.rejections.inc("attachment_invalid")
+            return {"error": f"Вложение отклонено: {e}"}
         except Exception as e:
-            self.logger.error(f"Ошибка при отправке сообщения: {e}")
+            self.logger.error("Ошибка при загрузке вложения: %s", e)
+            return {"error": "Ошибка сервера"}
     
-    def _validate_message(self, message_text):
-        """Проверка валидности сообщения"""
-        if not message_text or len(message_text) > self.MAX_MESSAGE_LENGTH:
-            emit("message", {"type": "error", "text": f"Сообщение должно быть не пустым и не длиннее {self.MAX_MESSAGE_LENGTH} символов"})
+    def _check_rate(self, sid, username):
+        """Проверка лимитов сокета, имени пользователя и общего бюджета рассылок"""
+        now = time.monotonic()
+        allowed, first = self.sid_limiter.check(sid, now)
+        if allowed:
+            allowed, first = self.user_limiter.check(self.users.normalize(username), now)
+        if not allowed:
+            self.metrics.rejections.inc("rate_limited")
+            if first and self.RATE_LIMIT_NOTIFY:
+                self.engine.emit("message", {"type": "error", "text": "Слишком много сообщений. Подождите немного."}, to=sid)
+            return False
+        if not self.broadcast_budget.take(now):
+            # Перегрузка сервера в целом: отбрасываем молча
+            self.metrics.rejections.inc("broadcast_budget")
             return False
         return True
     
-    def _handle_disconnect(self):
+    def _broadcast_message(self, room, payload):
+        """Рассылка события message участникам комнаты room.
+        
+        Номера seq общие для всех комнат. В кластере номер назначает
+        концентратор, и _record_broadcast вызывается каждым процессом при
+        получении ретранслированной рассылки.
+        """
+        payload["room"] = room
+        payload["ts"] = time.time()
+        if self.cluster:
+            self._emit_broadcast("message", payload, room)
+            return
+        with self.broadcast_lock:
+            self._record_broadcast(payload, self.seq + 1)
+            if not self.batch_interval:
+                self._emit_broadcast("message", payload, room)
+                return
+            # Номер и буфер досылки назначены сразу, отправка - с пачкой комнаты
+            events = self.pending_batch.setdefault(room, [])
+            events.append(payload)
+            self.pending_count += 1
+            if self.pending_count == 1 or len(events) >= self.BATCH_MAX_EVENTS:
+                self.batch_ready.notify()
+    
+    def _batch_loop(self):
+        """Фоновый поток: отправка накопленных рассылок пачками по окну или по размеру"""
+        while True:
+            with self.batch_ready:
+                self.batch_ready.wait_for(lambda: self.pending_batch)
+                deadline = time.monotonic() + self.batch_interval
+                while max(map(len, self.pending_batch.values())) < self.BATCH_MAX_EVENTS:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.batch_ready.wait(remaining)
+                batches, self.pending_batch = self.pending_batch, {}
+                self.pending_count = 0
+                for room, events in batches.items():
+                    try:
+                        # Пачка сериализуется один раз для всех участников комнаты
+                        self._emit_broadcast("message_batch", {"room": room, "events": events}, room)
+                    except Exception as e:
+                        self.logger.error("Ошибка отправки пачки рассылок: %s", e)
+    
+    def _emit_broadcast(self, event, payload, room):
+        """Отправка рассылки участникам комнаты с замером времени и числа получателей.
+        
+        В кластере измеряется публикация в концентратор, а получатели - участники
+        комнаты в этом процессе.
+        """
+        start = time.perf_counter()
+        self.engine.emit(event, payload, to=self._room_key(room))
+        self.metrics.broadcast_seconds.observe(time.perf_counter() - start)
+        self.metrics.broadcast_fanout.observe(self.rooms.count(room))
+    
+    def _record_broadcast(self, payload, seq):
+        """Присвоение рассылке номера seq, запись сообщения в историю комнаты и в буфер досылки.
+        
+        Вызывается под broadcast_lock.
+        """
+        self.seq = seq
+        payload["seq"] = seq
+        if payload["type"] == "message":
+            # Сохраняем сообщение в истории (запись на диск идёт в фоне);
+            # в кластере id сообщения - его номер, общий для всех процессов
+            record = self.history.append(
+                payload["username"], payload["text"],
+                message_id=seq if self.cluster else None, ts=payload["ts"], room=payload["room"],
+                attachment=payload.get("attachment")
+            )
+            payload["id"] = record["id"]
+            self.search_index.add(record)
+        if len(self.recent_broadcasts) == self.recent_broadcasts.maxlen:
+            self.evicted_seq = self.recent_broadcasts[0]["seq"]
+        self.recent_broadcasts.append(payload)
+    
+    def _send_resume(self, sid, last_seq, stream, rooms, since=None, pages=None):
+        """Досылка текущему клиенту рассылок комнат rooms после last_seq одним событием resume.
+        
+        Если клиент новый, сервер перезапускался или пропущенное уже вытеснено
+        из буфера, дополнительно отправляется история каждой комнаты: только
+        сообщения новее since[комната] (id последнего сообщения в кэше клиента)
+        или, без него, последние сообщения. pages - страницы, заранее
+        прочитанные _prefetch_history. Вызывается под broadcast_lock.
+        """
+        events = []
+        complete = False
+        if stream == self.stream_id and isinstance(last_seq, int) and last_seq <= self.seq:
+            complete = last_seq >= self.evicted_seq
+            for event in reversed(self.recent_broadcasts):
+                if event["seq"] <= last_seq:
+                    break
+                if event["room"] in rooms:
+                    events.append(event)
+            events.reverse()
+        self.engine.emit("resume", {
+            "stream": self.stream_id,
+            "seq": self.seq,
+            "events": events,
+            "complete": complete
+        }, to=sid)
+        if not complete:
+            since = since if isinstance(since, dict) else {}
+            for room in rooms:
+                if pages:
+                    self._send_prefetched_history(sid, room, pages[room])
+                    continue
+                # Досылка ожидалась полной, но пропущенное успели вытеснить (редкий случай)
+                after_id = since.get(room)
+                if isinstance(after_id, int):
+                    self._send_history_after(sid, room, after_id)
+                else:
+                    self._send_history(sid, room, None, self.HISTORY_ON_JOIN)
+    
+    def _handle_load_history(self, sid, data):
+        """Обработка запроса страницы истории комнаты (room, before_id, limit)"""
+        try:
+            if not isinstance(data, dict) or not self.users.get_username(sid):
+                return
+            room = self._parse_room(data.get("room", self.DEFAULT_ROOM))
+            before_id = data.get("before_id")
+            limit = data.get("limit", self.HISTORY_ON_JOIN)
+            if room is None or not self.rooms.is_member(room, sid):
+                return
+            if before_id is not None and not isinstance(before_id, int):
+                return
+            if not isinstance(limit, int):
+                return
+            self._send_history(sid, room, before_id, max(0, min(limit, self.MAX_HISTORY_PAGE)))
+        except Exception as e:
+            self.logger.error("Ошибка при загрузке истории: %s", e)
+    
+    def _build_search_index(self):
+        """Заполнение поискового индекса сообщениями из базы истории"""
+        start = time.perf_counter()
+        for message in self.history.iter_messages():
+            self.search_index.add(message)
+        self.logger.info(
+            "Поисковый индекс построен: %s сообщений за %.1f с", len(self.search_index), time.perf_counter() - start
+        )
+    
+    def _handle_search(self, sid, data):
+        """Обработка поиска по истории комнаты (room, query, username, since, until, before_id, limit)"""
+        try:
+            if not isinstance(data, dict) or not self.users.get_username(sid):
+                return
+            room = self._parse_room(data.get("room", self.DEFAULT_ROOM))
+            if room is None or not self.rooms.is_member(room, sid):
+                self.metrics.rejections.inc("not_in_room")
+                self.engine.emit("message", {"type": "error", "text": "Вы не состоите в этой комнате"}, to=sid)
+                return
+            query = data.get("query", "")
+            username = data.get("username")
+            before_id = data.get("before_id")
+            limit = data.get("limit", self.SEARCH_PAGE)
+            bounds = [data.get("since"), data.get("until")]
+            if (
+                not isinstance(query, str) or len(query) > self.MAX_QUERY_LENGTH
+                or (username is not None and not isinstance(username, str))
+                or (before_id is not None and not isinstance(before_id, int))
+                or not isinstance(limit, int)
+                or any(bound is not None and not isinstance(bound, (int, float)) for bound in bounds)
+            ):
+                self.metrics.rejections.inc("malformed")
+                return
+            
+            limit = max(1, min(limit, self.MAX_SEARCH_PAGE))
+            ids, has_more = self.search_index.search(
+                query, room, username=username.strip() if username else None,
+                since=bounds[0], until=bounds[1], before_id=before_id, limit=limit
+            )
+            self.engine.emit("search_results", {
+                "room": room,
+                "query": query,
+                "messages": self.history.messages(ids, room),
+                "before_id": before_id,
+                "has_more": has_more
+            }, to=sid)
+        except Exception as e:
+            self.logger.error("Ошибка при поиске по истории: %s", e)
+    
+    def _prefetch_history(self, rooms, since=None):
+        """Страницы истории комнат для входа, прочитанные до захвата блокировок.
+        
+        Чтение может ждать записи очереди истории на диск (до READ_WAIT_TIMEOUT),
+        поэтому выполняется без presence_lock и broadcast_lock. Страница
+        запоминает последний id истории на момент чтения: более новые сообщения
+        _send_prefetched_history добавляет из кэша уже под блокировкой.
+        """
+        since = since if isinstance(since, dict) else {}
+        pages = {}
+        for room in rooms:
+            mark = self.history.last_id()
+            after_id = since.get(room)
+            if isinstance(after_id, int):
+                messages = self.history.page_after(after_id, self.MAX_HISTORY_PAGE + 1, room)
+                if len(messages) <= self.MAX_HISTORY_PAGE:
+                    pages[room] = {"mark": mark, "after_id": after_id, "messages": messages, "reset": False}
+                    continue
+            pages[room] = {
+                "mark": mark, "after_id": None, "reset": isinstance(after_id, int),
+                "messages": self.history.recent(self.HISTORY_ON_JOIN, room)
+            }
+        return pages
+    
+    def _send_prefetched_history(self, sid, room, page):
+        """Отправка страницы _prefetch_history вместе с сообщениями, добавленными после чтения.
+        
+        Вызывается под broadcast_lock, поэтому история уходит клиенту раньше
+        рассылок, которые он получит как участник комнаты.
+        """
+        newer = self.history.cached_after(page["mark"], room)
+        if newer is None:
+            # После чтения добавилось больше, чем помещается в кэш: читаем заново
+            if page["after_id"] is not None:
+                self._send_history_after(sid, room, page["after_id"])
+            else:
+                self._send_history(sid, room, None, self.HISTORY_ON_JOIN, reset=page["reset"])
+            return
+        known = {message["id"] for message in page["messages"]}
+        messages = page["messages"] + [message for message in newer if message["id"] not in known]
+        if page["after_id"] is not None:
+            if len(messages) > self.MAX_HISTORY_PAGE:
+                self._send_history_after(sid, room, page["after_id"])
+                return
+            self.engine.emit("history", {
+                "room": room,
+                "messages": messages,
+                "after_id": page["after_id"],
+                "has_more": False
+            }, to=sid)
+            return
+        messages = messages[-self.HISTORY_ON_JOIN:]
+        payload = {
+            "room": room,
+            "messages": messages,
+            "before_id": None,
+            "has_more": len(messages) == self.HISTORY_ON_JOIN
+        }
+        if page["reset"]:
+            payload["reset"] = True
+        self.engine.emit("history", payload, to=sid)
+    
+    def _send_history(self, sid, room, before_id, limit, reset=False):
+        """Отправка клиенту страницы истории комнаты одним событием history"""
+        messages = self.history.page(before_id, limit, room)
+        payload = {
+            "room": room,
+            "messages": messages,
+            "before_id": before_id,
+            "has_more": len(messages) == limit
+        }
+        if reset:
+            payload["reset"] = True
+        self.engine.emit("history", payload, to=sid)
+    
+    def _send_history_after(self, sid, room, after_id):
+        """Отправка клиенту сообщений комнаты новее его кэша (after_id).
+        
+        Если новых сообщений больше MAX_HISTORY_PAGE, кэш клиента слишком
+        устарел: вместо ленты с разрывом клиент получает последние сообщения
+        с флагом reset и заменяет ими кэш.
+        """
+        messages = self.history.page_after(after_id, self.MAX_HISTORY_PAGE + 1, room)
+        if len(messages) > self.MAX_HISTORY_PAGE:
+            self._send_history(sid, room, None, self.HISTORY_ON_JOIN, reset=True)
+            return
+        self.engine.emit("history", {
+            "room": room,
+            "messages": messages,
+            "after_id": after_id,
+            "has_more": False
+        }, to=sid)
+    
+    def _handle_disconnect(self, sid):
         """Обработка отключения пользователя"""
+        self.metrics.connected_sids.dec()
         try:
-            username = self.users.pop(request.sid, None)
+            with self.presence_lock:
+                left = self.rooms.leave_all(sid)
+                username = self.users.release(sid)
+                self.sid_limiter.discard(sid)
+                self.attachments.release(sid)
+                if username:
+                    self.user_limiter.release(self.users.normalize(username))
+                    self.typing_limiter.release(self.users.normalize(username))
+                    self.metrics.joined_users.dec()
+                    # Обновляем списки участников комнат пользователя
+                    for room, version in left:
+                        self._update_user_list(room, "presence_remove", username, version)
             if username:
-                # Уведомляем всех об уходе пользователя
-                emit("message", {"type": "leave", "username": username}, broadcast=True)
-                self.logger.info(f"Пользователь отключился: {username}")
-                # Обновляем список пользователей у всех клиентов
-                self._update_user_list()
+                # Уведомляем участников комнат об уходе пользователя
+                for room, _ in left:
+                    self._broadcast_message(room, {"type": "leave", "username": username})
+                self.logger.info("Пользователь отключился: %s", username, extra={"category": "disconnect"})
+        except Exception as e:
+            self.logger.error("Ошибка при отключении пользователя: %s", e)
+    
+    def _handle_typing(self, sid, data):
+        """Набор текста в комнате room или в личном диалоге с to.
+        
+        Событие typing уходит участникам комнаты (или собеседнику) мимо потока
+        рассылок: без seq, истории и досылки. От одного пользователя
+        пропускается не больше одного события за TYPING_INTERVAL, остальные
+        отбрасываются молча.
+        """
+        try:
+            if not isinstance(data, dict):
+                self.metrics.rejections.inc("malformed")
+                return
+            username = self.users.get_username(sid)
+            if not username:
+                self.metrics.rejections.inc("not_joined")
+                return
+            
+            if isinstance(data.get("to"), str):
+                target_sid = self.users.get_sid(data["to"].strip())
+                if target_sid is None or target_sid == sid:
+                    return
+                target, skip_sid, payload = target_sid, None, {"type": "typing", "username": username}
+            else:
+                room = self._parse_room(data.get("room", self.DEFAULT_ROOM))
+                if room is None or not self.rooms.is_member(room, sid):
+                    self.metrics.rejections.inc("not_in_room")
+                    return
+                target, skip_sid = self._room_key(room), sid
+                payload = {"type": "typing", "room": room, "username": username}
+            
+            allowed, _ = self.typing_limiter.check(self.users.normalize(username))
+            if allowed:
+                self.engine.emit("ephemeral", payload, to=target, skip_sid=skip_sid)
+        except Exception as e:
+            self.logger.error("Ошибка при обработке набора текста: %s", e)
+    
+    def _handle_read(self, sid, data):
+        """Отметка прочтения комнаты до сообщения id: копится до сводки, а не рассылается сразу"""
+        try:
+            if not isinstance(data, dict) or not isinstance(data.get("id"), int):
+                self.metrics.rejections.inc("malformed")
+                return
+            username = self.users.get_username(sid)
+            if not username:
+                self.metrics.rejections.inc("not_joined")
+                return
+            room = self._parse_room(data.get("room", self.DEFAULT_ROOM))
+            if room is None or not self.rooms.is_member(room, sid):
+                self.metrics.rejections.inc("not_in_room")
+                return
+            with self.reads_lock:
+                reads = self.pending_reads.setdefault(room, {})
+                if data["id"] > reads.get(username, 0):
+                    reads[username] = data["id"]
         except Exception as e:
-            self.logger.error(f"Ошибка при отключении пользователя: {e}")
+            self.logger.error("Ошибка при обработке отметки прочтения: %s", e)
     
-    def _update_user_list(self):
-        """Обновление списка пользователей"""
-        active_users = list(self.users.values())
-        emit("user_list", {"users": active_users}, broadcast=True)
+    def _read_summary_loop(self):
+        """Фоновый поток: раз в READ_SUMMARY_INTERVAL - одна сводка прочтения на комнату.
+
+        Заодно удаляются восстановившиеся корзины отключившихся пользователей,
+        даже если новых событий "печатает" и сообщений не приходит.
+        """
+        while not self.stopped.wait(self.READ_SUMMARY_INTERVAL):
+            try:
+                self.typing_limiter.purge()
+                self.user_limiter.purge()
+            except Exception as e:
+                self.logger.error("Ошибка очистки корзин ограничителей: %s", e)
+            with self.reads_lock:
+                summaries, self.pending_reads = self.pending_reads, {}
+            for room, reads in summaries.items():
+                try:
+                    self.engine.emit("ephemeral", {"type": "read", "room": room, "reads": reads}, to=self._room_key(room))
+                except Exception as e:
+                    self.logger.error("Ошибка отправки сводки прочтения: %s", e)
+    
+    def _handle_sync_users(self, sid, data=None):
+        """Запрос полного списка участников комнаты (после пропуска версии)"""
+        room = self._parse_room(data.get("room", self.DEFAULT_ROOM) if isinstance(data, dict) else self.DEFAULT_ROOM)
+        if room is not None and self.rooms.is_member(room, sid):
+            self._send_user_snapshot(sid, room)
+    
+    def _send_user_snapshot(self, sid, room):
+        """Отправка клиенту полного списка участников комнаты"""
+        with self.presence_lock:
+            active_users, version = self.rooms.snapshot(room)
+            self.engine.emit("user_list", {
+                "type": "snapshot",
+                "room": room,
+                "users": active_users,
+                "version": version
+            }, to=sid)
+    
+    def _update_user_list(self, room, op, username, version, skip_sid=None):
+        """Рассылка изменения списка участников комнаты (presence_add/presence_remove).
+        
+        Вызывается под presence_lock, чтобы версии уходили клиентам по порядку.
+        """
+        self.engine.emit("user_list", {
+            "type": op,
+            "room": room,
+            "username": username,
+            "version": version
+        }, to=self._room_key(room), skip_sid=skip_sid)
+    
+    def _missed_marker(self, count):
+        """Событие для клиента, пропустившего count сообщений из-за переполнения очереди"""
+        return "message", {"type": "missed", "count": count}
+    
+    def _collect_outbound(self):
+        """Обновление метрик исходящих очередей перед выдачей /metrics"""
+        depths = [entry["depth"] for entry in self.engine.outbound_stats()]
+        self.metrics.outbound_depth.set(sum(depths))
+        self.metrics.outbound_depth_max.set(max(depths, default=0))
+    
+    def _outbound_report(self):
+        """GET /outbound: клиенты с непустой очередью или отброшенными сообщениями, медленные первыми"""
+        report = []
+        for entry in self.engine.outbound_stats():
+            if entry["depth"] or entry["dropped"]:
+                entry["username"] = self.users.get_username(entry["sid"])
+                report.append(entry)
+        report.sort(key=lambda entry: (entry["depth"], entry["dropped"]), reverse=True)
+        return json.dumps(report, ensure_ascii=False), "application/json"
     
     def run(self):
         """Запуск сервера"""
-        self.logger.info(f"Запуск сервера на порту {self.port}...")
-        self.socketio.run(self.app, host=self.host, port=self.port, debug=self.debug)
+        self.logger.info("Запуск сервера на порту %s (режим %s)...", self.port, self.engine.name)
+        threading.Thread(target=self._read_summary_loop, name="ReadSummaries", daemon=True).start()
+        try:
+            self.engine.run(self.host, self.port, debug=self.debug)
+        finally:
+            self.stopped.set()
+            self.history.close()
+            if self.recorder:
+                self.recorder.close()
 
 
 if __name__ == "__main__":
-    server = ChatServer(port=4000)
+    parser = argparse.ArgumentParser(description="Сервер чата")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="threading")
+    parser.add_argument("--history", default="chat_history.db", help="путь к базе истории сообщений")
+    parser.add_argument("--cluster", help="путь к UNIX-сокету концентратора кластера")
+    parser.add_argument("--no-rate-limit", action="store_true", help="не ограничивать частоту сообщений")
+    parser.add_argument("--outbound-policy", choices=POLICIES, default=COALESCE,
+                        help="политика при переполнении исходящей очереди клиента")
+    parser.add_argument("--batch-ms", type=float, default=0,
+                        help="окно объединения рассылок в пачки, мс (0 - без пачек)")
+    parser.add_argument("--log-json", action="store_true", help="выводить лог строками JSON")
+    parser.add_argument("--log-sample", type=logpipe.sampling_arg, action="append", metavar="КАТЕГОРИЯ=N",
+                        help="выводить одну запись из N для категории (connect, disconnect)")
+    parser.add_argument("--attachments", default="attachments", help="каталог хранилища вложений")
+    parser.add_argument("--record", help="записывать входящий трафик в файл (для benchmarks/replay.py)")
+    args = parser.parse_args()
+    
+    server = ChatServer(
+        host=args.host, port=args.port, history_path=args.history, engine=args.engine, cluster=args.cluster,
+        rate_limit=not args.no_rate_limit, outbound_policy=args.outbound_policy,
+        batch_interval=args.batch_ms / 1000 or None, log_json=args.log_json,
+        log_sampling=dict(args.log_sample) if args.log_sample else None, attachments_path=args.attachments,
+        record_path=args.record
+    )
     server.run()
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули сервера лежат в корне репозитория, как и для benchmarks/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from attachments import AttachmentStore
+
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_partial_uploads_per_owner_are_capped(tmp_path):
+    """Соединение не может держать больше MAX_PARTIAL_PER_OWNER незавершённых загрузок"""
+    store = AttachmentStore(str(tmp_path))
+    files = [os.urandom(16) for _ in range(store.MAX_PARTIAL_PER_OWNER + 1)]
+    for data in files[:-1]:
+        assert store.write(digest_of(data), len(data), 0, data[:8], "sid-1") == 8
+    with pytest.raises(ValueError):
+        store.begin(digest_of(files[-1]), len(files[-1]), "sid-1")
+    # Другое соединение и продолжение своей загрузки не ограничены
+    assert store.begin(digest_of(files[-1]), len(files[-1]), "sid-2") == 0
+    assert store.begin(digest_of(files[0]), len(files[0]), "sid-1") == 8
+    # Завершённая загрузка освобождает место
+    assert store.write(digest_of(files[0]), len(files[0]), 8, files[0][8:], "sid-1") == 16
+    assert store.uploads("sid-1") == store.MAX_PARTIAL_PER_OWNER - 1
+    assert store.begin(digest_of(files[-1]), len(files[-1]), "sid-1") == 0
+
+
+def test_rejected_chunks_leave_no_locks(tmp_path):
+    """Отклонённые куски со случайными хэшами не оставляют блокировок"""
+    store = AttachmentStore(str(tmp_path))
+    for _ in range(store.MAX_PARTIAL_PER_OWNER):
+        data = os.urandom(16)
+        store.write(digest_of(data), len(data), 0, data[:8], "sid-1")
+    for _ in range(1000):
+        data = os.urandom(16)
+        # Сверх лимита владельца
+        with pytest.raises(ValueError):
+            store.write(digest_of(data), len(data), 0, data[:8], "sid-1")
+        # Не с начала загрузки, которой нет
+        assert store.write(digest_of(data), len(data), 8, data[8:]) == 0
+    assert len(store._locks) <= store.MAX_PARTIAL_PER_OWNER
+    now = time.monotonic()
+    store.release("sid-1", now)
+    store.reap(now + store.RESUME_GRACE)
+    assert len(store._locks) == 0
+
+
+def test_released_partials_are_reaped(tmp_path):
+    """Загрузки отключившегося соединения удаляются, если их не продолжили за RESUME_GRACE"""
+    store = AttachmentStore(str(tmp_path))
+    kept, dropped = os.urandom(16), os.urandom(16)
+    store.write(digest_of(kept), len(kept), 0, kept[:8], "sid-1")
+    store.write(digest_of(dropped), len(dropped), 0, dropped[:8], "sid-1")
+    now = time.monotonic()
+    store.release("sid-1", now)
+    assert store.uploads("sid-1") == 0
+    # После переподключения загрузка продолжается с прежнего места
+    assert store.begin(digest_of(kept), len(kept), "sid-2") == 8
+    store.reap(now + store.RESUME_GRACE)
+    assert store.begin(digest_of(kept), len(kept), "sid-2") == 8
+    assert store.begin(digest_of(dropped), len(dropped), "sid-3") == 0
+    assert sorted(os.listdir(store.partial)) == [digest_of(kept)]
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+import pytest
+from engineio import packet as eio_packet
+
+from outbound import COALESCE, DROP_OLDEST, AsyncOutboundQueue, ThreadingOutboundQueue
+
+
+def message(text):
+    return eio_packet.Packet(eio_packet.MESSAGE, data=text)
+
+
+def make_queue(cls, policy, dropped):
+    return cls(2, policy, lambda count: message(f"missed {count}"), lambda: dropped.append(1), lambda queue: None)
+
+
+@pytest.mark.parametrize("policy", [DROP_OLDEST, COALESCE])
+def test_threading_queue_join_after_drain(policy):
+    """После разбора переполненной очереди join() возвращается (как в Socket.close(wait=True))"""
+    dropped = []
+    outbound = make_queue(ThreadingOutboundQueue, policy, dropped)
+    for i in range(5):
+        outbound.put(message(f"m{i}"))
+    assert len(dropped) == 3
+
+    received = []
+    while not outbound.empty():
+        received.append(outbound.get().data)
+        outbound.task_done()
+    if policy == DROP_OLDEST:
+        assert received == ["m3", "m4"]
+    else:
+        assert received == ["m0", "m1", "missed 3"]
+    assert outbound.unfinished_tasks == 0
+
+    joiner = threading.Thread(target=outbound.join, daemon=True)
+    joiner.start()
+    joiner.join(1)
+    assert not joiner.is_alive()
+
+
+@pytest.mark.parametrize("policy", [DROP_OLDEST, COALESCE])
+def test_async_queue_join_after_drain(policy):
+    async def scenario():
+        dropped = []
+        outbound = make_queue(AsyncOutboundQueue, policy, dropped)
+        for i in range(5):
+            outbound.put_nowait(message(f"m{i}"))
+        while not outbound.empty():
+            outbound.get_nowait()
+            outbound.task_done()
+        await asyncio.wait_for(outbound.join(), 1)
+        return len(dropped)
+
+    assert asyncio.run(scenario()) == 3
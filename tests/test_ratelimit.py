@@ -0,0 +1,57 @@
+import time
+
+from ratelimit import RateLimiter
+
+
+def test_released_buckets_stay_bounded():
+    """Корзины пользователей, написавших и отключившихся, не копятся"""
+    limiter = RateLimiter(rate=1.0, burst=5)
+    now = time.monotonic()
+    sizes = []
+    for i in range(10_000):
+        # Каждые 10 мс новый пользователь пишет сообщение и отключается
+        now += 0.01
+        allowed, _ = limiter.check(f"user-{i}", now)
+        assert allowed
+        limiter.release(f"user-{i}", now)
+        sizes.append(len(limiter))
+    # Корзина восстанавливается за burst / rate = 5 с, то есть живёт не дольше 500 отключений
+    assert max(sizes) <= 501
+    limiter.purge(now + 5)
+    assert len(limiter) == 0
+
+
+def test_reconnect_keeps_limit():
+    """Переподключение до восстановления корзины не сбрасывает лимит"""
+    limiter = RateLimiter(rate=1.0, burst=2)
+    now = time.monotonic()
+    assert limiter.check("alice", now)[0]
+    assert limiter.check("alice", now)[0]
+    limiter.release("alice", now)
+    assert limiter.check("alice", now + 0.5) == (False, True)
+    # Вернувшийся ключ не удаляется по сроку прежнего освобождения
+    limiter.purge(now + 10)
+    assert len(limiter) == 1
+
+
+def test_full_bucket_released_immediately():
+    limiter = RateLimiter(rate=1.0, burst=2)
+    now = time.monotonic()
+    limiter.check("bob", now)
+    limiter.release("bob", now + 10)
+    assert len(limiter) == 0
+
+
+def test_typing_buckets_stay_bounded():
+    """Лимитер "печатает" (одно событие за 3 с): корзины ушедших сразу после набора не копятся"""
+    limiter = RateLimiter(rate=1 / 3.0, burst=1)
+    now = time.monotonic()
+    for i in range(1_000):
+        now += 0.1
+        assert limiter.check(f"user-{i}", now)[0]
+        # Отключение сразу после события: корзина пуста и не удаляется на месте
+        limiter.release(f"user-{i}", now)
+        assert len(limiter) <= 31
+    # Периодическая очистка без новых событий удаляет оставшиеся корзины
+    limiter.purge(now + 3)
+    assert len(limiter) == 0
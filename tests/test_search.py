@@ -0,0 +1,10 @@
+from search import SearchIndex
+
+
+def test_author_filter_matches_registry_normalization():
+    """Фильтр по автору сравнивает имена так же, как UserRegistry (NFKC + casefold)"""
+    index = SearchIndex()
+    index.add({"id": 1, "ts": 1.0, "room": "general", "username": "ＡＬＩＣＥ", "text": "привет"})
+    index.add({"id": 2, "ts": 2.0, "room": "general", "username": "bob", "text": "привет"})
+    assert index.search("привет", "general", username="alice") == ([1], False)
+    assert index.search("", "general", username="Alice") == ([1], False)
@@ -0,0 +1,237 @@
+"""Компактный формат событий: msgpack с короткими числовыми кодами
+
+Клиент, поддерживающий формат, подключается с параметром ?codec=msgpack.
+Сервер, знающий формат, отвечает такому клиенту бинарными кадрами msgpack,
+остальным - как раньше, текстом JSON. Клиент переходит на msgpack, только
+получив от сервера бинарный кадр, поэтому старый сервер и старый клиент
+продолжают работать в JSON.
+
+В msgpack имена событий и значения поля "type" заменяются числовыми кодами
+из EVENT_CODES и TYPE_CODES; имена, которых нет в таблицах, передаются как есть.
+"""
+from urllib.parse import parse_qs
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+try:
+    import msgpack
+except ImportError:  # без msgpack остаётся только JSON
+    msgpack = None
+
+CODEC = "msgpack"
+CODEC_PARAM = "codec"
+
+# Коды имён событий и типов сообщений (только добавлять новые, не менять существующие)
+EVENT_CODES = {
+    "message": 1, "message_batch": 2, "resume": 3, "history": 4, "user_list": 5,
+    "join": 6, "send_message": 7, "sync_users": 8, "load_history": 9, "join_room": 10, "leave_room": 11,
+    "send_direct": 12, "search": 13, "search_results": 14,
+    "upload_start": 15, "upload_chunk": 16, "typing": 17, "read": 18, "ephemeral": 19,
+}
+TYPE_CODES = {
+    "message": 1, "join": 2, "leave": 3, "error": 4, "missed": 5,
+    "snapshot": 6, "presence_add": 7, "presence_remove": 8, "direct": 9, "typing": 10, "read": 11,
+}
+EVENT_NAMES = {code: name for name, code in EVENT_CODES.items()}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+def available():
+    """Установлен ли msgpack"""
+    return msgpack is not None
+
+
+# Бинарные типы пакетов Socket.IO и их обычные аналоги для msgpack
+BINARY_TYPES = {packet.BINARY_EVENT: packet.EVENT, packet.BINARY_ACK: packet.ACK}
+
+
+# Поля со списками событий, внутри которых тоже заменяются коды "type"
+NESTED_EVENTS = ("events",)
+
+
+def _recode(payload, codes):
+    """Замена значения "type" по таблице codes в данных события и в списках NESTED_EVENTS"""
+    if not isinstance(payload, dict):
+        return payload
+    result = payload
+    code = codes.get(payload.get("type"))
+    if code is not None:
+        result = dict(payload, type=code)
+    for key in NESTED_EVENTS:
+        events = payload.get(key)
+        if isinstance(events, list):
+            if result is payload:
+                result = dict(payload)
+            result[key] = [_recode(event, codes) for event in events]
+    return result
+
+
+def _pack_data(data):
+    if not isinstance(data, list):
+        return data
+    code = EVENT_CODES.get(data[0]) if data else None
+    if code is None:
+        return data
+    return [code, *(_recode(item, TYPE_CODES) for item in data[1:])]
+
+
+def _unpack_data(data):
+    if not isinstance(data, list):
+        return data
+    if not data or not isinstance(data[0], int):
+        return data
+    return [EVENT_NAMES.get(data[0], data[0]), *(_recode(item, TYPE_NAMES) for item in data[1:])]
+
+
+class EncodedJSON(str):
+    """Текст JSON-пакета со ссылкой на исходный пакет для перекодирования"""
+
+    __slots__ = ("source",)
+
+
+class DualPacket(packet.Packet):
+    """Пакет Socket.IO, читающий оба формата: текст - JSON, байты - msgpack
+
+    Кодирует в msgpack, если у класса compact = True, иначе в JSON.
+    """
+
+    compact = False
+
+    def encode(self):
+        if self.compact:
+            return self.encode_compact()
+        encoded = super().encode()
+        if isinstance(encoded, str):
+            encoded = EncodedJSON(encoded)
+            encoded.source = self
+        return encoded
+
+    def encode_compact(self, cache=True):
+        """Кодирование в msgpack (результат кэшируется в пакете, если cache)"""
+        cached = getattr(self, "_compact", None) if cache else None
+        if cached is None:
+            # msgpack передаёт байты внутри пакета: отдельных бинарных вложений нет
+            packet_type = BINARY_TYPES.get(self.packet_type, self.packet_type)
+            out = {"type": packet_type, "nsp": self.namespace}
+            if self.data is not None:
+                # Коды имён заменяются только в событиях; подтверждения (ACK) - ответы обработчиков как есть
+                out["data"] = _pack_data(self.data) if packet_type == packet.EVENT else self.data
+            if self.id is not None:
+                out["id"] = self.id
+            cached = msgpack.dumps(out)
+            if cache:
+                self._compact = cached
+        return cached
+
+    def decode(self, encoded_packet):
+        if not isinstance(encoded_packet, bytes):
+            return super().decode(encoded_packet)
+        decoded = msgpack.loads(encoded_packet)
+        self.packet_type = decoded["type"]
+        data = decoded.get("data")
+        self.data = _unpack_data(data) if self.packet_type == packet.EVENT else data
+        self.id = decoded.get("id")
+        self.namespace = decoded["nsp"]
+        self.on_compact()
+        return 0
+
+    def on_compact(self):
+        """Вызывается при получении пакета msgpack"""
+
+
+def client_packet_class():
+    """Класс пакетов для одного socketio.Client: переходит на msgpack после первого
+    бинарного пакета от сервера"""
+
+    class ClientPacket(DualPacket):
+        def on_compact(self):
+            ClientPacket.compact = True
+
+    return ClientPacket
+
+
+def client_url(url):
+    """Адрес подключения с запросом компактного формата (если msgpack установлен)"""
+    if not available():
+        return url
+    separator = "&" if "?" in url else "?"
+    return f"{url}{separator}{CODEC_PARAM}={CODEC}"
+
+
+# Ключ в environ соединения, под которым запоминается выбранный формат
+ENVIRON_KEY = "flet_chat.compact"
+
+
+def is_compact(server, eio_sid):
+    """Запросил ли клиент соединения eio_sid компактный формат"""
+    environ = server.environ.get(eio_sid)
+    if environ is None:
+        return False
+    compact = environ.get(ENVIRON_KEY)
+    if compact is None:
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        compact = environ[ENVIRON_KEY] = available() and query.get(CODEC_PARAM) == [CODEC]
+    return compact
+
+
+def compact_packet(server, eio_sid, eio_pkt):
+    """Пакет Engine.IO для клиента: для msgpack-клиентов - перекодированный.
+
+    Возвращает None, если пакет этому клиенту отправлять не нужно (бинарные
+    вложения JSON-пакета - в msgpack они уже внутри основного пакета).
+    """
+    if not is_compact(server, eio_sid):
+        return eio_pkt
+    data = eio_pkt.data
+    if isinstance(data, EncodedJSON):
+        return type(eio_pkt)(eio_pkt.packet_type, data.source.encode_compact())
+    if isinstance(data, bytes):
+        return None
+    if isinstance(data, str) and eio_pkt.packet_type == eio_packet.MESSAGE:
+        # Пакет собран не через DualPacket (например, служебный): перекодируем из JSON
+        source = DualPacket(encoded_packet=data)
+        return type(eio_pkt)(eio_pkt.packet_type, source.encode_compact())
+    return eio_pkt
+
+
+def install(server):
+    """Поддержка компактного формата на socketio.Server"""
+    server.packet_class = DualPacket
+    send_eio_packet = server._send_eio_packet
+    send_packet = server._send_packet
+
+    def _send_eio_packet(eio_sid, eio_pkt):
+        eio_pkt = compact_packet(server, eio_sid, eio_pkt)
+        if eio_pkt is not None:
+            send_eio_packet(eio_sid, eio_pkt)
+
+    def _send_packet(eio_sid, pkt):
+        if is_compact(server, eio_sid):
+            server.eio.send(eio_sid, pkt.encode_compact())
+        else:
+            send_packet(eio_sid, pkt)
+
+    server._send_eio_packet = _send_eio_packet
+    server._send_packet = _send_packet
+
+
+def install_async(server):
+    """Поддержка компактного формата на socketio.AsyncServer"""
+    server.packet_class = DualPacket
+    send_eio_packet = server._send_eio_packet
+    send_packet = server._send_packet
+
+    async def _send_eio_packet(eio_sid, eio_pkt):
+        eio_pkt = compact_packet(server, eio_sid, eio_pkt)
+        if eio_pkt is not None:
+            await send_eio_packet(eio_sid, eio_pkt)
+
+    async def _send_packet(eio_sid, pkt):
+        if is_compact(server, eio_sid):
+            await server.eio.send(eio_sid, pkt.encode_compact())
+        else:
+            await send_packet(eio_sid, pkt)
+
+    server._send_eio_packet = _send_eio_packet
+    server._send_packet = _send_packet